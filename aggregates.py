@@ -0,0 +1,276 @@
+"""
+Rollups of how often each species is reported, by county and state and by ISO week and month, so questions like "how
+often is species X reported in county Y by week" can be answered without touching the observation table.
+
+There are two tables:
+    aggregate_region: for each region and period, the number of checklists, and of complete checklists.
+    aggregate_species: for each species, region and period, the number of checklists reporting it (detections), and of
+        complete checklists reporting it.
+A species' frequency is its detections over the region's checklists for the same period, see frequency().
+
+build() works them out from scratch after a load. After that, loads keep them up to date as they go, in the same
+transaction as each batch. Every count is a sum over checklists, so the checklists a batch touches have what they
+add to the rollups taken off before the batch is merged, and put back, as they are now, after it. Rows that are new,
+rows that are already there and edits from incremental loads, including to a checklist's date or location, all come
+out right that way. Only the difference is written to the rollups. Each batch takes a transaction level advisory
+lock on its checklists first, so two writers of the async loader with parts of the same checklist take turns.
+Deletions aren't followed, so build() again after those.
+
+Weeks and months are those of the checklists' start times in the database session's time zone, which is how the
+parsed times, which have no time zone, were stored.
+"""
+import argparse
+from datetime import date
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+from models import AggregateRegion, AggregateSpecies
+
+# Regions and periods the rollups are kept for.
+LEVELS = ("county", "state")
+PERIODS = ("week", "month")
+
+# The checklists the current batch touches, and what they change in the rollups, emptied when it commits.
+CREATE_BATCH_TABLES_SQL = (
+    "CREATE TEMP TABLE IF NOT EXISTS aggregate_batch (checklist bigint PRIMARY KEY) ON COMMIT DELETE ROWS",
+    """CREATE TEMP TABLE IF NOT EXISTS aggregate_species_delta (
+        species_id text, region_level text, region_code text, period text, period_start date, detections bigint,
+        complete_detections bigint) ON COMMIT DELETE ROWS""",
+    """CREATE TEMP TABLE IF NOT EXISTS aggregate_region_delta (
+        region_level text, region_code text, period text, period_start date, checklists bigint,
+        complete_checklists bigint) ON COMMIT DELETE ROWS""",
+)
+
+# The bulk loader's checklists, including those its observations are on now, in case an edit moves them.
+RECORD_BATCH_SQL = """INSERT INTO aggregate_batch (checklist)
+    SELECT checklist FROM stage_checklist
+    UNION SELECT checklist_id FROM stage_observation
+    UNION SELECT o.checklist_id FROM observation o JOIN stage_observation s ON s.observation = o.observation
+    ON CONFLICT DO NOTHING"""
+
+# In checklist order, so writers waiting on each other can't deadlock over them.
+LOCK_BATCH_SQL = """SELECT pg_advisory_xact_lock(checklist)
+    FROM (SELECT checklist FROM aggregate_batch ORDER BY checklist) b"""
+
+# Every (checklist, species) and every checklist, for the batch's checklists.
+BATCH_DETECTIONS = """SELECT DISTINCT o.checklist_id, o.species_id
+    FROM observation o JOIN aggregate_batch b ON b.checklist = o.checklist_id
+    WHERE o.species_id IS NOT NULL"""
+BATCH_CHECKLISTS = """SELECT DISTINCT o.checklist_id
+    FROM observation o JOIN aggregate_batch b ON b.checklist = o.checklist_id"""
+
+# The same for everything.
+ALL_DETECTIONS = "SELECT DISTINCT checklist_id, species_id FROM observation WHERE species_id IS NOT NULL"
+ALL_CHECKLISTS = "SELECT DISTINCT checklist_id FROM observation"
+
+# Each checklist once for each level and period.
+REGION_PERIODS = f"""JOIN checklist c ON c.checklist = d.checklist_id
+    JOIN location l ON l.id = c.location_id
+    CROSS JOIN LATERAL (VALUES ('county', l.county_id), ('state', l.state_province_id)) AS r(level, code)
+    CROSS JOIN (VALUES {", ".join(f"('{p}')" for p in PERIODS)}) AS p(period)
+    WHERE c.start_date_time IS NOT NULL AND r.code <> ''"""
+
+
+def species_sql(detections, table="aggregate_species", sign=1):
+    """
+    Adds the detections to table, or takes them off with a sign of -1.
+    """
+    return f"""INSERT INTO {table} (
+        species_id, region_level, region_code, period, period_start, detections, complete_detections)
+    SELECT d.species_id, r.level, r.code, p.period, date_trunc(p.period, c.start_date_time)::date,
+        {sign} * count(*), {sign} * count(*) FILTER (WHERE c.complete_checklist)
+    FROM ({detections}) d
+    {REGION_PERIODS}
+    GROUP BY 1, 2, 3, 4, 5"""
+
+
+def region_sql(checklists, table="aggregate_region", sign=1):
+    return f"""INSERT INTO {table} (
+        region_level, region_code, period, period_start, checklists, complete_checklists)
+    SELECT r.level, r.code, p.period, date_trunc(p.period, c.start_date_time)::date,
+        {sign} * count(*), {sign} * count(*) FILTER (WHERE c.complete_checklist)
+    FROM ({checklists}) d
+    {REGION_PERIODS}
+    GROUP BY 1, 2, 3, 4"""
+
+
+# Adds up the batch's differences, leaving out the keys where they cancel out, and drops the rows left at zero.
+APPLY_SQL = (
+    """INSERT INTO aggregate_species (
+        species_id, region_level, region_code, period, period_start, detections, complete_detections)
+    SELECT species_id, region_level, region_code, period, period_start, sum(detections), sum(complete_detections)
+    FROM aggregate_species_delta
+    GROUP BY 1, 2, 3, 4, 5
+    HAVING sum(detections) <> 0 OR sum(complete_detections) <> 0
+    ON CONFLICT (species_id, region_level, region_code, period, period_start) DO UPDATE SET
+        detections = aggregate_species.detections + EXCLUDED.detections,
+        complete_detections = aggregate_species.complete_detections + EXCLUDED.complete_detections""",
+    """INSERT INTO aggregate_region (
+        region_level, region_code, period, period_start, checklists, complete_checklists)
+    SELECT region_level, region_code, period, period_start, sum(checklists), sum(complete_checklists)
+    FROM aggregate_region_delta
+    GROUP BY 1, 2, 3, 4
+    HAVING sum(checklists) <> 0 OR sum(complete_checklists) <> 0
+    ON CONFLICT (region_level, region_code, period, period_start) DO UPDATE SET
+        checklists = aggregate_region.checklists + EXCLUDED.checklists,
+        complete_checklists = aggregate_region.complete_checklists + EXCLUDED.complete_checklists""",
+    """DELETE FROM aggregate_species a USING aggregate_species_delta d
+    WHERE a.species_id = d.species_id AND a.region_level = d.region_level AND a.region_code = d.region_code
+        AND a.period = d.period AND a.period_start = d.period_start AND a.detections = 0""",
+    """DELETE FROM aggregate_region a USING aggregate_region_delta d
+    WHERE a.region_level = d.region_level AND a.region_code = d.region_code AND a.period = d.period
+        AND a.period_start = d.period_start AND a.checklists = 0""",
+)
+
+# Run once the batch's checklists are in aggregate_batch, before and after it's merged.
+BEFORE_SQL = (LOCK_BATCH_SQL, species_sql(BATCH_DETECTIONS, "aggregate_species_delta", -1),
+              region_sql(BATCH_CHECKLISTS, "aggregate_region_delta", -1))
+AFTER_SQL = (species_sql(BATCH_DETECTIONS, "aggregate_species_delta"),
+             region_sql(BATCH_CHECKLISTS, "aggregate_region_delta")) + APPLY_SQL
+
+BUILD_SQL = ("TRUNCATE aggregate_species, aggregate_region",
+             species_sql(ALL_DETECTIONS), region_sql(ALL_CHECKLISTS))
+
+
+def with_updates(merge_sql):
+    """
+    Adds keeping the rollups up to date to the bulk loader's merge statements.
+    """
+    return CREATE_BATCH_TABLES_SQL + (RECORD_BATCH_SQL,) + BEFORE_SQL + tuple(merge_sql) + AFTER_SQL
+
+
+def before_orm(session, checklist_ids):
+    """
+    Takes what the checklists a batch is about to insert into add to the rollups off, in the session's transaction.
+    Args:
+        session (Session): SQLAlchemy session.
+        checklist_ids (list(int)): the batch's checklists.
+    """
+    for statement in CREATE_BATCH_TABLES_SQL:
+        session.execute(text(statement))
+    session.execute(text("INSERT INTO aggregate_batch (checklist) SELECT DISTINCT unnest(CAST(:ids AS bigint[]))"),
+                    {"ids": list(checklist_ids)})
+    for statement in BEFORE_SQL:
+        session.execute(text(statement))
+
+
+def after_orm(session):
+    """
+    Adds the checklists from before_orm() back to the rollups, once the batch has been flushed.
+    """
+    for statement in AFTER_SQL:
+        session.execute(text(statement))
+
+
+def is_built(engine):
+    """
+    Whether the rollups have been built, and so should be kept up to date.
+    """
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT EXISTS (SELECT 1 FROM aggregate_region)")).scalar()
+
+
+def build(engine):
+    """
+    Works out the rollups from everything in the database, replacing whatever was there.
+    """
+    with engine.begin() as conn:
+        for statement in BUILD_SQL:
+            conn.execute(text(statement))
+
+
+def frequency(session, species, region_code, level="county", period="week", since=None, until=None):
+    """
+    How often a species was reported in a region, period by period.
+    Args:
+        session (Session): SQLAlchemy session.
+        species (str): scientific name of the species.
+        region_code (str): county or state code, such as US-NY-061 or US-NY.
+        level (str, optional): county or state.
+        period (str, optional): week or month.
+        since (date, optional): first period to include.
+        until (date, optional): last period to include.
+    Returns:
+        A list of (period start, detections, checklists, frequency, complete frequency) tuples, with every period that
+        had checklists, even where the species wasn't reported.
+    """
+    region = AggregateRegion
+    counts = AggregateSpecies
+    query = (select(region.period_start, counts.detections, counts.complete_detections, region.checklists,
+                    region.complete_checklists)
+             .outerjoin(counts, (counts.region_level == region.region_level) & (counts.region_code == region.region_code)
+                        & (counts.period == region.period) & (counts.period_start == region.period_start)
+                        & (counts.species_id == species))
+             .where(region.region_level == level, region.region_code == region_code, region.period == period)
+             .order_by(region.period_start))
+    if since is not None:
+        query = query.where(region.period_start >= since)
+    if until is not None:
+        query = query.where(region.period_start <= until)
+    rows = []
+    for start, detections, complete_detections, checklists, complete_checklists in session.execute(query):
+        detections = detections or 0
+        complete_detections = complete_detections or 0
+        rows.append((start, detections, checklists, detections / checklists if checklists else 0.0,
+                     complete_detections / complete_checklists if complete_checklists else 0.0))
+    return rows
+
+
+def top_species(session, region_code, period_start, level="county", period="week", limit=20):
+    """
+    The most often reported species in a region in one period.
+    Args:
+        session (Session): SQLAlchemy session.
+        region_code (str): county or state code.
+        period_start (date): first day of the week (a Monday) or month.
+        level (str, optional): county or state.
+        period (str, optional): week or month.
+        limit (int, optional): number of species.
+    Returns:
+        A list of (scientific name, detections, frequency) tuples, most reported first.
+    """
+    checklists = session.execute(
+        select(AggregateRegion.checklists).where(
+            AggregateRegion.region_level == level, AggregateRegion.region_code == region_code,
+            AggregateRegion.period == period, AggregateRegion.period_start == period_start)).scalar() or 0
+    query = (select(AggregateSpecies.species_id, AggregateSpecies.detections)
+             .where(AggregateSpecies.region_level == level, AggregateSpecies.region_code == region_code,
+                    AggregateSpecies.period == period, AggregateSpecies.period_start == period_start)
+             .order_by(AggregateSpecies.detections.desc(), AggregateSpecies.species_id)
+             .limit(limit))
+    return [(name, detections, detections / checklists if checklists else 0.0)
+            for name, detections in session.execute(query)]
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Build and query the species by region and period rollups.")
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
+                        required=True)
+    parser.add_argument('--build', dest="build", help="Work the rollups out again from scratch.", action="store_true")
+    parser.add_argument('--species', dest="species", help="Print this species' frequency, by scientific name.",
+                        metavar="NAME", default=None)
+    parser.add_argument('--region', dest="region_code", help="County or state code to query.", metavar="CODE",
+                        default=None)
+    parser.add_argument('--level', dest="level", help="Whether --region is a county or a state.", choices=LEVELS,
+                        default="county")
+    parser.add_argument('--period', dest="period", help="Group by week or month.", choices=PERIODS, default="week")
+    parser.add_argument('--top', dest="period_start", help="Print the top species in the period starting on this date.",
+                        metavar="YYYY-MM-DD", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    engine = create_engine(options.connection_url)
+    if options.build:
+        build(engine)
+        print("Rollups built.")
+    with Session(engine) as session:
+        if options.species is not None and options.region_code is not None:
+            for start, detections, checklists, freq, complete_freq in frequency(
+                    session, options.species, options.region_code, options.level, options.period):
+                print(f"{start}  {detections:>6} / {checklists:<6} {freq:6.1%}  complete {complete_freq:6.1%}")
+        if options.period_start is not None and options.region_code is not None:
+            for name, detections, freq in top_species(session, options.region_code, options.period_start,
+                                                      options.level, options.period):
+                print(f"{name:<40} {detections:>6} {freq:6.1%}")
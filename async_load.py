@@ -0,0 +1,434 @@
+"""
+Loads the eBird dataset with reading, parsing and writing all happening at the same time, using asyncio and asyncpg.
+
+The pipeline has three stages joined by bounded queues, so whichever stage is slowest holds back the others rather
+than letting data pile up in memory:
+    reader: a thread reading (and decompressing) line aligned chunks of the file.
+    parser: a pool of processes turning chunks into batches of parsed rows, see parallel_parse.parse_chunk().
+    writers: several asyncpg connections, each staging and merging a batch at a time just like bulk_load.BulkLoader.
+
+The writers share one event loop, so the little they do through SQLAlchemy, creating partitions and adding new lookup
+values, runs in a thread instead, and the other writers carry on in the meantime.
+
+Batches can commit out of order, so a checkpoint only ever records the end of the batches that have all been
+committed, and the rest get loaded again (harmlessly, as the merges ignore rows that are already there) on resume.
+"""
+import asyncio
+import io
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from sqlalchemy import create_engine
+import batching
+import bulk_load
+import checkpoint
+import input_stream
+import metrics
+import parallel_parse
+import parquet_stage
+import partitioning
+import quarantine
+import query_service
+import row_filter
+from lookups import LookupCache
+
+# Parsed batches that can be waiting for a writer, per writer.
+BATCHES_PER_WRITER = 2
+
+# Chunks the reader can get ahead of the parser, per parsing process.
+CHUNKS_PER_WORKER = 2
+
+
+def import_asyncpg():
+    try:
+        import asyncpg
+    except ImportError:
+        raise ImportError("Loading with --async requires the asyncpg package: pip install asyncpg")
+    return asyncpg
+
+
+def asyncpg_dsn(connection_url):
+    """
+    asyncpg takes plain postgresql:// URLs, without SQLAlchemy's +driver part.
+    """
+    from sqlalchemy.engine import make_url
+    return make_url(connection_url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class BatchDimensions:
+    """
+    The view of the shared DimensionCache that one batch sees while it's being written.
+    Only keys from committed batches count as being in the database. A key another writer has staged but not yet
+    committed is staged again, as otherwise this batch's merge wouldn't be able to see it; the ON CONFLICT clauses take
+    care of the duplicate.
+    Args:
+        shared (DimensionCache): keys of everything committed so far.
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.pending = []
+        self.seen = set()
+
+    def is_new(self, dimension, key):
+        if key in self.shared.keys[dimension]:
+            self.shared.hits[dimension] += 1
+            return False
+        if (dimension, key) in self.seen:
+            return False
+        self.shared.misses[dimension] += 1
+        self.seen.add((dimension, key))
+        self.pending.append((dimension, key))
+        return True
+
+    def commit(self):
+        for dimension, key in self.pending:
+            self.shared.keys[dimension].add(key)
+        self.pending = []
+        self.seen = set()
+
+    def rollback(self):
+        self.pending = []
+        self.seen = set()
+
+
+class Watermark:
+    """
+    Tracks which batches have been committed, to work out how far the load has got without any gaps.
+    Batches are numbered from 0 in file order.
+    Args:
+        identity (str): file identity for the checkpoints.
+        offset (int): offset the load started at.
+        row_count (int): rows loaded before the load started.
+    """
+
+    def __init__(self, identity, offset, row_count):
+        self.identity = identity
+        self.next = 0
+        self.committed = {}
+        self.checkpoint = checkpoint.Checkpoint(identity, offset, row_count)
+
+    def candidate(self, seq, end_offset, row_count):
+        """
+        The checkpoint to save along with batch seq, assuming it commits: as far as the batches run without a gap.
+        """
+        done = dict(self.committed)
+        done[seq] = (end_offset, row_count)
+        n = self.next
+        latest = self.checkpoint
+        while n in done:
+            latest = checkpoint.Checkpoint(self.identity, *done[n])
+            n += 1
+        return latest if n > self.next else None
+
+    def commit(self, seq, end_offset, row_count):
+        self.committed[seq] = (end_offset, row_count)
+        while self.next in self.committed:
+            self.checkpoint = checkpoint.Checkpoint(self.identity, *self.committed.pop(self.next))
+            self.next += 1
+
+
+class AsyncLoader:
+    """
+    Runs the pipeline for one load.
+    Args:
+        connection_url (str): SQLAlchemy connection URL of the database.
+        dimensions (DimensionCache): warmed cache of the dimension keys in the database.
+        writers (int): number of database connections writing at once.
+        parse_workers (int): number of parsing processes.
+        merge_sql (sequence(str), optional): statements that move the staged rows into the real tables.
+        partitions (PartitionManager, optional): creates yearly partitions, if the tables are partitioned.
+        sizer (BatchSizer, optional): picks how many rows go in each batch, see batching.
+        filters (dict, optional): only load the rows that pass these filters, see row_filter.
+        lookups (LookupCache, optional): codes of the dictionary encoded columns' values, warmed here if not given.
+    """
+
+    def __init__(self, connection_url, dimensions, writers, parse_workers, merge_sql=bulk_load.MERGE_SQL,
+                 partitions=None, sizer=None, filters=None, lookups=None):
+        self.dsn = asyncpg_dsn(connection_url)
+        self.dimensions = dimensions
+        self.writers = writers
+        self.parse_workers = max(parse_workers, 1)
+        self.merge_sql = merge_sql
+        self.partitions = partitions
+        self.sizer = sizer if sizer is not None else batching.BatchSizer()
+        self.filters = filters
+        if lookups is None:
+            # New values are added through SQLAlchemy, as they're so rare it's not worth doing it over asyncpg.
+            lookups = LookupCache(create_engine(connection_url))
+            lookups.warm()
+        self.lookups = lookups
+        self.stopping = threading.Event()
+        # Only one thread creates partitions at a time, so two writers don't both create the same one.
+        self.partition_lock = None
+
+    def load(self, file_path, start_row, decoder_class, species_sci_names, subspecies_sci_names, batch_size,
+             identity, start_offset=0, row_count=0, row_class=None, checklist_class=None):
+        """
+        Loads a file, or a Parquet dataset from parquet_stage. It's parsed batch_size rows at a time, and the rows
+        joined up into batches of the sizer's current size for writing.
+        Returns:
+            The total row count, including rows loaded before this load started.
+        """
+        return asyncio.run(self.run(file_path, start_row, decoder_class, species_sci_names, subspecies_sci_names,
+                                    batch_size, identity, start_offset, row_count, row_class, checklist_class))
+
+    async def run(self, file_path, start_row, decoder_class, species_sci_names, subspecies_sci_names, batch_size,
+                  identity, start_offset, row_count, row_class, checklist_class):
+        asyncpg = import_asyncpg()
+        batches = asyncio.Queue(maxsize=self.writers * BATCHES_PER_WRITER)
+        from_dataset = parquet_stage.is_dataset(file_path)
+        watermark = Watermark(identity, start_offset, row_count)
+        loop = asyncio.get_running_loop()
+        self.partition_lock = asyncio.Lock()
+        connections = [await asyncpg.connect(self.dsn) for _ in range(self.writers)]
+        tasks = [asyncio.create_task(self.writer(asyncpg, connections, i, batches, watermark))
+                 for i in range(self.writers)]
+        try:
+            if from_dataset:
+                # Datasets are already parsed, so the reader hands batches straight to the writers.
+                producer = loop.run_in_executor(None, self.read_dataset, loop, batches, file_path, row_class,
+                                                checklist_class, batch_size, max(start_row, start_offset), row_count)
+                tasks.append(asyncio.ensure_future(producer))
+            else:
+                tasks.append(asyncio.create_task(self.parse(
+                    loop, batches, file_path, start_row, start_offset, row_count, decoder_class, species_sci_names,
+                    subspecies_sci_names, batch_size)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self.stopping.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Anything committed out of order after the last checkpoint was saved.
+            if watermark.checkpoint.row_count > row_count and not connections[0].is_closed():
+                await self.save_checkpoint(connections[0], watermark.checkpoint)
+            for conn in connections:
+                await conn.close()
+        return watermark.checkpoint.row_count
+
+    def put(self, loop, queue, item):
+        """
+        Puts an item on an asyncio queue from another thread, waiting while it's full.
+        """
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while not self.stopping.is_set():
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                continue
+        future.cancel()
+
+    def read_dataset(self, loop, batches, file_path, row_class, checklist_class, batch_size, start, row_count):
+        seq = 0
+        _, ds = parquet_stage.import_pyarrow()
+        dataset = parquet_stage.read_dataset(file_path, row_class, checklist_class, batch_size, start,
+                                             row_filter.dataset_expression(ds, **(self.filters or {})))
+        for batch, rows_read in batching.regroup(dataset, self.sizer):
+            if self.stopping.is_set():
+                return
+            self.put(loop, batches, (seq, batch, rows_read, rows_read))
+            seq += 1
+        for _ in range(self.writers):
+            self.put(loop, batches, None)
+
+    def read_chunks(self, loop, chunks, f, begin):
+        """
+        The reader stage, run in a thread.
+        """
+        for chunk, chunk_begin in parallel_parse.stream_chunks(f, begin):
+            if self.stopping.is_set():
+                return
+            metrics.count("bytes_read", len(chunk))
+            self.put(loop, chunks, (chunk, chunk_begin))
+        self.put(loop, chunks, None)
+
+    async def parse(self, loop, batches, file_path, start_row, start_offset, row_count, decoder_class,
+                    species_sci_names, subspecies_sci_names, batch_size):
+        """
+        The parser stage: farms chunks out to worker processes and passes the results on in file order.
+        """
+        chunks = asyncio.Queue(maxsize=self.parse_workers * CHUNKS_PER_WORKER)
+        with input_stream.open_ebird_file(file_path) as f:
+            header, begin = input_stream.read_header(f, start_row, start_offset)
+            decoder_class(header, species_sci_names, subspecies_sci_names)
+            quarantine_path = quarantine.current.file_path if quarantine.current is not None else None
+            init_args = (header, decoder_class, species_sci_names, subspecies_sci_names, quarantine_path,
+                         self.filters)
+            with ProcessPoolExecutor(max_workers=self.parse_workers, initializer=parallel_parse.init_worker,
+                                     initargs=init_args) as pool:
+                reader = loop.run_in_executor(None, self.read_chunks, loop, chunks, f, begin)
+                pending = deque()
+                seq = 0
+                count = row_count
+                rows = []
+                end_offset = begin
+
+                async def send():
+                    nonlocal seq, count, rows
+                    count += len(rows)
+                    with metrics.stage("queue_wait"):
+                        await batches.put((seq, rows, end_offset, count))
+                    seq += 1
+                    rows = []
+
+                async def pass_on(future):
+                    nonlocal end_offset
+                    with metrics.stage("parse_wait"):
+                        parsed = parallel_parse.collect(await future)
+                    for batch, end_offset in parsed:
+                        rows.extend(batch)
+                        if len(rows) >= self.sizer.size:
+                            await send()
+
+                while True:
+                    item = await chunks.get()
+                    if item is None:
+                        break
+                    chunk, chunk_begin = item
+                    pending.append(loop.run_in_executor(pool, parallel_parse.parse_chunk, chunk, chunk_begin,
+                                                        batch_size))
+                    if len(pending) >= self.parse_workers * CHUNKS_PER_WORKER:
+                        await pass_on(pending.popleft())
+                while pending:
+                    await pass_on(pending.popleft())
+                if rows:
+                    await send()
+                await reader
+        for _ in range(self.writers):
+            await batches.put(None)
+
+    async def writer(self, asyncpg, connections, i, batches, watermark):
+        """
+        A writer: stages and merges one batch at a time on its own connection, connections[i].
+        """
+        retryable = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, asyncpg.DeadlockDetectedError,
+                     asyncpg.SerializationError, OSError)
+        loop = asyncio.get_running_loop()
+        await self.create_staging_tables(connections[i])
+        while True:
+            item = await batches.get()
+            if item is None:
+                return
+            seq, batch, end_offset, row_count = item
+            if self.partitions is not None:
+                years = partitioning.batch_years(batch)
+                if not years <= self.partitions.years:
+                    with metrics.stage("partitions"):
+                        async with self.partition_lock:
+                            await loop.run_in_executor(None, self.partitions.ensure, years)
+            done = watermark.candidate(seq, end_offset, row_count)
+            try:
+                start = loop.time()
+                await self.attempt(asyncpg, connections, i, retryable, batch, done)
+                self.sizer.observe(len(batch), loop.time() - start)
+            except retryable:
+                raise
+            except Exception as ex:
+                if quarantine.current is None:
+                    raise
+                print(f"{metrics.curr_time()} Batch ending at {end_offset} failed, looking for the rows at fault: {ex}")
+                await self.isolate(asyncpg, connections, i, retryable, batch, row_count - len(batch), ex)
+                if done is not None:
+                    await self.attempt(asyncpg, connections, i, retryable, [], done)
+            watermark.commit(seq, end_offset, row_count)
+            metrics.gauge("batch_size", self.sizer.size)
+            metrics.gauge("resident_bytes", self.sizer.rss)
+            metrics.count("rows", len(batch))
+            metrics.count("batches")
+            metrics.report(self.dimensions)
+
+    async def attempt(self, asyncpg, connections, i, retryable, batch, done):
+        """
+        Writes a batch on connections[i], retrying transient errors with a wait that doubles each time and reconnecting
+        if the connection was lost.
+        """
+        for retry in range(quarantine.MAX_RETRIES + 1):
+            dimensions = BatchDimensions(self.dimensions)
+            try:
+                await self.write_batch(connections[i], batch, dimensions, done)
+                dimensions.commit()
+                return
+            except retryable:
+                dimensions.rollback()
+                if retry == quarantine.MAX_RETRIES:
+                    raise
+                metrics.count("retries")
+                delay = quarantine.backoff(retry)
+                print(f"{metrics.curr_time()} Retrying batch in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                if connections[i].is_closed():
+                    connections[i] = await asyncpg.connect(self.dsn)
+                    await self.create_staging_tables(connections[i])
+            except Exception:
+                dimensions.rollback()
+                raise
+
+    async def isolate(self, asyncpg, connections, i, retryable, rows, count, error):
+        """
+        Splits rows that failed together in half until the ones at fault are on their own, and quarantines them.
+        """
+        if len(rows) == 1:
+            quarantine.current.add_rows(rows, count + 1, error)
+            metrics.count("quarantined")
+            return
+        middle = len(rows) // 2
+        for part, part_count in ((rows[:middle], count), (rows[middle:], count + middle)):
+            try:
+                await self.attempt(asyncpg, connections, i, retryable, part, None)
+            except retryable:
+                raise
+            except Exception as ex:
+                await self.isolate(asyncpg, connections, i, retryable, part, part_count, ex)
+
+    async def create_staging_tables(self, conn):
+        for table, columns in bulk_load.STAGING_TABLES.items():
+            cols = ", ".join(f"{name} {sql_type}" for name, sql_type in columns)
+            await conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} ({cols}) ON COMMIT DELETE ROWS")
+
+    async def write_batch(self, conn, batch, dimensions, done=None):
+        """
+        The same as BulkLoader.write_batch(), over asyncpg.
+        """
+        missing = self.lookups.missing(batch)
+        if missing:
+            with metrics.stage("lookups"):
+                await asyncio.get_running_loop().run_in_executor(None, self.add_lookups, missing)
+        with metrics.stage("staging_rows"):
+            staged = bulk_load.staging_rows(batch, dimensions, self.lookups)
+            # Text COPY, the same as the bulk loader, so values are interpreted in exactly the same way.
+            buffers = {table: io.BytesIO(bulk_load.rows_to_copy_buffer(rows).getvalue().encode('utf-8'))
+                       for table, rows in staged.items() if rows}
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            with metrics.stage("copy"):
+                for table, buffer in buffers.items():
+                    columns = [name for name, _ in bulk_load.STAGING_TABLES[table]]
+                    await conn.copy_to_table(table, source=buffer, columns=columns, format='text')
+            with metrics.stage("merge"):
+                for statement in self.merge_sql:
+                    await conn.execute(statement)
+            if done is not None:
+                await conn.execute(checkpoint.ASYNC_SAVE_SQL, *done)
+            scopes = query_service.batch_scopes(batch)
+            if scopes:
+                await conn.execute(query_service.ASYNC_BUMP_SQL, scopes)
+        except BaseException:
+            if not conn.is_closed():
+                await transaction.rollback()
+            raise
+        with metrics.stage("commit"):
+            await transaction.commit()
+
+    def add_lookups(self, missing):
+        """
+        Adds new lookup values through SQLAlchemy, run in a thread.
+        """
+        for name, value in missing:
+            self.lookups.add(name, value)
+
+    async def save_checkpoint(self, conn, done):
+        await conn.execute(checkpoint.ASYNC_SAVE_SQL, *done)
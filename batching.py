@@ -0,0 +1,125 @@
+"""
+Picks how many rows go in each batch while a load is running, instead of always using the same number.
+
+Bigger batches spread the cost of each commit over more rows, but past a point they only make each commit slower, hold
+more rows in memory and lose more work when one fails. Where that point is depends on the database (a local server
+against one across a network) and on the data (checklists with a few observations against ones with hundreds), so
+BatchSizer measures how long each batch takes to write and aims for a target time per batch, within fixed bounds. If
+the process uses more memory than allowed, batches are halved until it doesn't.
+
+Batches are parsed min_size rows at a time and regroup() joins them up into batches of the current size, so the size
+can change from one batch to the next whatever is doing the parsing.
+"""
+import os
+
+# Bounds of the batch size, in rows.
+MIN_BATCH = 1000
+MAX_BATCH = 100000
+
+# Batch size to start with, before there's anything to go on.
+START_BATCH = 10000
+
+# Seconds each batch should take to write and commit.
+TARGET_SECONDS = 1.0
+
+# The most a batch can grow or shrink by from one batch to the next.
+MAX_STEP = 2.0
+
+# Weight of the latest batch in the running average of seconds per row.
+SMOOTHING = 0.3
+
+# Batches only grow while memory use is below this fraction of the limit.
+MEMORY_HEADROOM = 0.8
+
+
+def resident_bytes():
+    """
+    This process' resident memory in bytes, or None if it can't be found out.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Not the current size but the peak, which is the best there is without /proc. macOS gives bytes, Linux KiB.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class BatchSizer:
+    """
+    Adjusts the batch size after every batch, to aim for a target time per batch and stay under a memory limit.
+    Args:
+        min_size (int, optional): smallest batch, also the size batches are parsed in.
+        max_size (int, optional): largest batch.
+        target_seconds (float, optional): how long writing and committing a batch should take.
+        max_rss (int, optional): most resident memory, in bytes, for the loading process to use, or None for no limit.
+        start_size (int, optional): size of the first batch.
+    """
+
+    def __init__(self, min_size=MIN_BATCH, max_size=MAX_BATCH, target_seconds=TARGET_SECONDS, max_rss=None,
+                 start_size=START_BATCH):
+        if not 0 < min_size <= max_size:
+            raise ValueError(f"Batch size bounds have to be 0 < min <= max, not {min_size} and {max_size}.")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_rss = max_rss
+        self.size = self.clamp(start_size)
+        self.seconds_per_row = None
+        self.rss = None
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def observe(self, rows, seconds):
+        """
+        Takes into account how long a batch took, and picks the size of the next one.
+        Args:
+            rows (int): number of rows in the batch.
+            seconds (float): time it took to write and commit.
+        Returns:
+            The new batch size.
+        """
+        if rows and seconds > 0:
+            latest = seconds / rows
+            if self.seconds_per_row is None:
+                self.seconds_per_row = latest
+            else:
+                self.seconds_per_row = SMOOTHING * latest + (1 - SMOOTHING) * self.seconds_per_row
+            ideal = self.target_seconds / self.seconds_per_row
+            size = min(max(ideal, self.size / MAX_STEP), self.size * MAX_STEP)
+        else:
+            size = self.size
+        if self.max_rss is not None:
+            self.rss = resident_bytes()
+            if self.rss is not None and self.rss > self.max_rss:
+                size = self.size / 2
+            elif self.rss is not None and self.rss > self.max_rss * MEMORY_HEADROOM:
+                size = min(size, self.size)
+        self.size = self.clamp(size)
+        return self.size
+
+
+def regroup(batches, sizer):
+    """
+    Joins up consecutive batches until they have at least sizer.size rows, checking the size again for each batch.
+    Args:
+        batches (iterable): (batch, end offset) tuples of rows in file order.
+        sizer (BatchSizer): picks the size.
+    Returns:
+        A generator of (batch, end offset) tuples.
+    """
+    rows = []
+    end_offset = None
+    for batch, end_offset in batches:
+        rows.extend(batch)
+        if len(rows) >= sizer.size:
+            yield rows, end_offset
+            rows = []
+    if rows:
+        yield rows, end_offset
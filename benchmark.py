@@ -0,0 +1,261 @@
+"""
+Benchmarks for the loader, so the effect of a change on throughput can be measured rather than guessed.
+
+There are three kinds:
+    micro: the field converters and the row decoder, on their own.
+    parse: reading and decoding a whole synthetic file, sequentially and with parallel_parse.
+    load: end to end loads of a synthetic file into a throwaway PostgreSQL database, with each of the loaders.
+
+load needs a PostgreSQL server with PostGIS installed that isn't part of this repository, given with -s. Every load
+gets a database of its own on it, created and dropped again by throwaway_database(), so any server that a user can
+create databases on will do, such as a local one started just for benchmarking.
+
+Results are appended to a JSON lines file along with the git commit they were measured at, and --compare prints how
+two commits' results differ.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import timeit
+import uuid
+from datetime import datetime
+import database_setup
+import ebird_data_parse
+import input_stream
+import parallel_parse
+import synthetic_ebd
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+DEFAULT_RESULTS = "benchmark_results.jsonl"
+
+# Least time to spend timing each micro-benchmark.
+MICRO_SECONDS = 0.5
+
+
+def git_commit():
+    """
+    The commit being benchmarked, with a + on the end if there are uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("+" if dirty else "")
+
+
+class Results:
+    """
+    Collects results and appends them to the results file.
+    Args:
+        file_path (str): JSON lines file to append to.
+        rows (int): size of the synthetic data set.
+    """
+
+    def __init__(self, file_path, rows):
+        self.file_path = file_path
+        self.rows = rows
+        self.commit = git_commit()
+        self.when = datetime.now().isoformat(timespec='seconds')
+
+    def add(self, name, value, unit):
+        print(f"{name:<40} {value:>14,.1f} {unit}")
+        record = {"commit": self.commit, "time": self.when, "name": name, "value": value, "unit": unit,
+                  "rows": self.rows, "python": platform.python_version()}
+        with open(self.file_path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def per_second(function):
+    """
+    How many times a second function can be called, using timeit's autorange to pick the number of calls.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(number * MICRO_SECONDS / 0.2))
+    return number / min(timer.repeat(repeat=3, number=number))
+
+
+def micro_benchmarks(results, data_path, species, subspecies):
+    """
+    Times the converters and RowDecoder on rows from the synthetic data.
+    """
+    with input_stream.open_ebird_file(data_path) as f:
+        header = f.readline().decode('utf-8').rstrip('\r\n').split('\t')
+        lines = [f.readline().decode('utf-8') for _ in range(1000)]
+    lines = [line for line in lines if line]
+    decoder = ebird_data_parse.RowDecoder(header, species, subspecies)
+    observation_values = [decoder.observation_getter(line.rstrip('\r\n').split('\t')) for line in lines]
+    checklist_values = [decoder.checklist_getter(line.rstrip('\r\n').split('\t')) for line in lines]
+    checklist = ebird_data_parse.convert_checklist(checklist_values[0])
+
+    def decode():
+        d = ebird_data_parse.RowDecoder(header, species, subspecies)
+        for line in lines:
+            d.decode(line)
+
+    def convert_checklists():
+        for values in checklist_values:
+            ebird_data_parse.convert_checklist(values)
+
+    def convert_observations():
+        for values in observation_values:
+            ebird_data_parse.convert_observation(values, checklist, species, subspecies)
+
+    n = len(lines)
+    results.add("micro.decode_row", per_second(decode) * n, "rows/s")
+    results.add("micro.convert_checklist", per_second(convert_checklists) * n, "calls/s")
+    results.add("micro.convert_observation", per_second(convert_observations) * n, "calls/s")
+    results.add("micro.parse_start_duration",
+                per_second(lambda: ebird_data_parse.parse_start_duration('2019-05-01', '07:30:00', '45')), "calls/s")
+    results.add("micro.decimal_or_none", per_second(lambda: ebird_data_parse.decimal_or_none('1.609')), "calls/s")
+    results.add("micro.protocol_words_to_code",
+                per_second(lambda: ebird_data_parse.protocol_words_to_code('Traveling')), "calls/s")
+
+
+def parse_benchmarks(results, data_path, species, subspecies, workers):
+    """
+    Times reading and decoding the whole file, without writing anything.
+    """
+    start = time.perf_counter()
+    rows = sum(len(batch) for batch, _ in ebird_data_parse.read_batches(data_path, 0, species, subspecies))
+    results.add("parse.sequential", rows / (time.perf_counter() - start), "rows/s")
+    if workers > 1:
+        start = time.perf_counter()
+        rows = sum(len(batch) for batch, _ in parallel_parse.parallel_batches(
+            data_path, 0, workers, ebird_data_parse.RowDecoder, species, subspecies, ebird_data_parse.COMMIT_BATCH))
+        results.add(f"parse.parallel_{workers}", rows / (time.perf_counter() - start), "rows/s")
+
+
+@contextlib.contextmanager
+def throwaway_database(connection_url):
+    """
+    Creates a new, empty database with PostGIS on the server in connection_url, and drops it afterwards.
+    Args:
+        connection_url (str): SQLAlchemy URL of a database on the server that can be used to create others.
+    Returns:
+        The URL of the new database.
+    """
+    url = make_url(connection_url)
+    name = f"ebird_benchmark_{uuid.uuid4().hex[:8]}"
+    admin = create_engine(url, isolation_level="AUTOCOMMIT")
+    with admin.connect() as conn:
+        conn.exec_driver_sql(f"CREATE DATABASE {name}")
+    database_url = url.set(database=name)
+    try:
+        engine = create_engine(database_url)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS postgis")
+        engine.dispose()
+        yield database_url.render_as_string(hide_password=False)
+    finally:
+        ebird_data_parse.DBSession.remove()
+        if ebird_data_parse.engine is not None:
+            ebird_data_parse.engine.dispose()
+        with admin.connect() as conn:
+            conn.exec_driver_sql(f"DROP DATABASE IF EXISTS {name}")
+        admin.dispose()
+
+
+def load_benchmarks(results, data_path, taxonomy_path, connection_url, modes, workers):
+    """
+    Times complete loads of the synthetic data, each into its own new database.
+    """
+    for mode in modes:
+        with throwaway_database(connection_url) as url:
+            ebird_data_parse.init_sqlalchemy(url, reset=False, bare=(mode == "fresh"))
+            ebird_data_parse.parsed_taxa_csv_to_db(taxonomy_path)
+            start = time.perf_counter()
+            # The loader's progress output would swamp the results.
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                ebird_data_parse.parse_ebird_dump(data_path, 0, bulk=(mode != "orm"), workers=workers,
+                                                  incremental_load=(mode == "incremental"))
+                if mode == "fresh":
+                    database_setup.build_deferred(ebird_data_parse.engine)
+            seconds = time.perf_counter() - start
+            results.add(f"load.{mode}", results.rows / seconds, "rows/s")
+
+
+def read_results(file_path):
+    """
+    The latest value of each benchmark for each commit, as {commit: {name: (value, unit)}}.
+    """
+    by_commit = {}
+    with open(file_path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            by_commit.setdefault(record["commit"], {})[record["name"]] = (record["value"], record["unit"])
+    return by_commit
+
+
+def compare(file_path, base, head):
+    """
+    Prints the results for two commits side by side, with how much faster or slower head is than base.
+    """
+    by_commit = read_results(file_path)
+    for commit in (base, head):
+        if commit not in by_commit:
+            raise ValueError(f"No results for {commit} in {file_path}, only for {', '.join(by_commit)}.")
+    print(f"{'benchmark':<40} {base:>14} {head:>14}  change")
+    for name, (head_value, unit) in sorted(by_commit[head].items()):
+        if name not in by_commit[base]:
+            print(f"{name:<40} {'':>14} {head_value:>14,.1f}")
+            continue
+        base_value = by_commit[base][name][0]
+        print(f"{name:<40} {base_value:>14,.1f} {head_value:>14,.1f}  {(head_value / base_value - 1) * 100:+.1f}%")
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Benchmark parsing and loading with synthetic eBird data.")
+    parser.add_argument('-n', '--rows', dest="rows", help="Number of observations in the synthetic data.", metavar="N",
+                        type=int, default=200000)
+    parser.add_argument('--seed', dest="seed", help="Random seed for the synthetic data.", metavar="N", type=int, default=0)
+    parser.add_argument('-k', '--kind', dest="kinds", help="Which benchmarks to run, can be given more than once.",
+                        choices=("micro", "parse", "load"), action="append")
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url",
+                        help="SQLAlchemy URL of a PostgreSQL server to create throwaway databases on, needed for load.",
+                        metavar="URL", default=None)
+    parser.add_argument('-m', '--mode', dest="modes", help="Loaders to benchmark with load, can be given more than once.",
+                        choices=("orm", "bulk", "fresh", "incremental"), action="append")
+    parser.add_argument('-w', '--workers', dest="workers", help="Number of parsing processes.", metavar="N", type=int,
+                        default=os.cpu_count())
+    parser.add_argument('-o', '--results', dest="results_path", help="JSON lines file to append the results to.",
+                        metavar="PATH", default=DEFAULT_RESULTS)
+    parser.add_argument('--compare', dest="compare", help="Compare the results of two commits instead of benchmarking.",
+                        metavar=("BASE", "HEAD"), nargs=2, default=None)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    if options.compare:
+        compare(options.results_path, *options.compare)
+    else:
+        kinds = options.kinds or ["micro", "parse"]
+        if "load" in kinds and options.connection_url is None:
+            raise SystemExit("The load benchmarks need a PostgreSQL server, given with -s.")
+        results = Results(options.results_path, options.rows)
+        with tempfile.TemporaryDirectory() as tmp:
+            data_path = os.path.join(tmp, "ebd_synthetic.txt")
+            taxonomy_path = os.path.join(tmp, "taxonomy_synthetic.csv")
+            synthetic_ebd.write_ebd(data_path, options.rows, options.seed, taxonomy_path)
+            species, subspecies = ebird_data_parse.parse_ebird_taxonomy(taxonomy_path)
+            species_sci_names = {s["scientific_name"] for s in species.values()}
+            subspecies_sci_names = {s["scientific_name"] for s in subspecies.values()}
+            print(f"Commit {results.commit}, {options.rows} rows, seed {options.seed}.")
+            if "micro" in kinds:
+                micro_benchmarks(results, data_path, species_sci_names, subspecies_sci_names)
+            if "parse" in kinds:
+                parse_benchmarks(results, data_path, species_sci_names, subspecies_sci_names, options.workers)
+            if "load" in kinds:
+                load_benchmarks(results, data_path, taxonomy_path, options.connection_url,
+                                options.modes or ["orm", "bulk"], options.workers)
@@ -0,0 +1,303 @@
+"""
+Bulk loading of parsed eBird rows using PostgreSQL's COPY.
+
+Rather than a get_or_create() (SELECT + SAVEPOINT + INSERT) per model per row, each batch is turned into
+one text buffer per staging table, streamed in with COPY FROM STDIN and then moved into the real tables
+with a handful of set based INSERT ... SELECT ... ON CONFLICT DO NOTHING statements.
+Because every insert ignores rows that already exist, loading the same data twice is harmless.
+"""
+import io
+from datetime import datetime
+from psycopg2 import OperationalError as DBAPIOperationalError
+from sqlalchemy.exc import OperationalError
+import checkpoint
+import metrics
+import query_service
+import spatial
+from lookups import LookupCache
+
+# Staging tables and their columns, in the order the COPY buffers are written.
+# These are temporary tables, so they only exist for the connection doing the loading and are emptied on every commit.
+STAGING_TABLES = {
+    "stage_country": (("country_code", "text"), ("country", "text")),
+    "stage_stateprovince": (("state_code", "text"), ("state_province", "text")),
+    "stage_county": (("county_code", "text"), ("county", "text")),
+    "stage_locality": (("locality_id", "bigint"), ("locality_type_id", "smallint"), ("locality_name", "text")),
+    "stage_observer": (("observer_id", "bigint"),),
+    "stage_location": (
+        ("locality_id", "bigint"), ("country_id", "text"), ("state_province_id", "text"), ("county_id", "text"),
+        ("latitude", "double precision"), ("longitude", "double precision"), ("grid_cell", "integer")),
+    "stage_checklist": (
+        ("checklist", "bigint"), ("locality_id", "bigint"), ("start_date_time", "timestamptz"),
+        ("checklist_comments", "text"), ("duration_minutes", "integer"), ("distance", "numeric"), ("area", "numeric"),
+        ("number_of_observers", "integer"), ("complete_checklist", "boolean"), ("group_id", "integer"),
+        ("approved", "boolean"), ("reviewed", "boolean"), ("reason_id", "smallint"), ("protocol", "text"),
+        ("project_id", "smallint")),
+    "stage_observation": (
+        ("observation", "bigint"), ("number_observed", "integer"), ("is_x", "boolean"), ("age_sex_id", "integer"),
+        ("species_comments", "text"), ("date_last_edit", "timestamptz"), ("has_media", "boolean"),
+        ("observation_date", "timestamptz"), ("checklist_id", "bigint"), ("observer_id", "bigint"),
+        ("species_id", "text"), ("subspecies_id", "text")),
+}
+
+# Moves everything from the staging tables into the real ones, in foreign key order.
+# DISTINCT ON keeps a single row per key in case the same entity shows up more than once in a batch.
+DIMENSION_MERGE_SQL = (
+    """INSERT INTO country (country_code, country)
+    SELECT DISTINCT ON (country_code) country_code, country FROM stage_country
+    ON CONFLICT DO NOTHING""",
+    """INSERT INTO stateprovince (state_code, state_province)
+    SELECT DISTINCT ON (state_code) state_code, state_province FROM stage_stateprovince
+    ON CONFLICT DO NOTHING""",
+    """INSERT INTO county (county_code, county)
+    SELECT DISTINCT ON (county_code) county_code, county FROM stage_county
+    ON CONFLICT DO NOTHING""",
+    """INSERT INTO locality (locality_id, locality_type_id, locality_name)
+    SELECT DISTINCT ON (locality_id) locality_id, locality_type_id, locality_name FROM stage_locality
+    ON CONFLICT DO NOTHING""",
+    """INSERT INTO observer (observer_id)
+    SELECT DISTINCT observer_id FROM stage_observer
+    ON CONFLICT DO NOTHING""",
+    """INSERT INTO location (coords, country_id, state_province_id, county_id, locality_id, grid_cell)
+    SELECT DISTINCT ON (locality_id)
+        ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), country_id, state_province_id, county_id, locality_id,
+        grid_cell
+    FROM stage_location
+    ON CONFLICT (locality_id) DO NOTHING""",
+)
+
+# A checklist whose location isn't there gets a NULL location_id, which the table won't take, so the batch fails (or
+# the checklist is quarantined) rather than the checklist and its observations being left out without a word.
+CHECKLIST_MERGE_SQL = """INSERT INTO checklist (
+        checklist, location_id, start_date_time, checklist_comments, duration, distance, area, number_of_observers,
+        complete_checklist, group_id, approved, reviewed, reason_id, protocol, project_id)
+    SELECT DISTINCT ON (s.checklist)
+        s.checklist, l.id, s.start_date_time, s.checklist_comments, make_interval(mins => s.duration_minutes),
+        s.distance, s.area, s.number_of_observers, s.complete_checklist, s.group_id, s.approved, s.reviewed,
+        s.reason_id, s.protocol, s.project_id
+    FROM stage_checklist s LEFT JOIN location l ON l.locality_id = s.locality_id
+    ON CONFLICT (checklist) DO NOTHING"""
+
+OBSERVATION_MERGE_SQL = """INSERT INTO observation (
+        observation, number_observed, is_x, age_sex_id, species_comments, date_last_edit, has_media, observation_date,
+        checklist_id, observer_id, species_id, subspecies_id)
+    SELECT DISTINCT ON (observation)
+        observation, number_observed, is_x, age_sex_id, species_comments, date_last_edit, has_media, observation_date,
+        checklist_id, observer_id, species_id, subspecies_id
+    FROM stage_observation
+    ON CONFLICT (observation) DO NOTHING"""
+
+MERGE_SQL = DIMENSION_MERGE_SQL + (CHECKLIST_MERGE_SQL, OBSERVATION_MERGE_SQL)
+
+
+def staging_rows(batch, dimensions, lookups):
+    """
+    Splits a batch of parsed rows up into the rows for each staging table.
+    Dimension rows are only staged the first time they're seen, and checklists once per batch.
+    Only observations are staged for every row.
+    Args:
+        batch (list(ParsedRow)): rows from RowDecoder.decode().
+        dimensions (DimensionCache): keys of the dimension rows already in the database.
+        lookups (LookupCache): codes of the dictionary encoded columns' values.
+    Returns:
+        A dictionary with the staging table name as the key and a list of tuples, in STAGING_TABLES column order, as the value.
+    """
+    countries = []
+    states = []
+    counties = []
+    localities = []
+    observers = []
+    locations = []
+    checklists = {}
+    observations = []
+    is_new = dimensions.is_new
+    encode = lookups.encode
+    last_checklist = None
+    for p in batch:
+        c = p.checklist
+        # Rows from the same sampling event share their checklist, so all of this only happens once per group.
+        if c is not last_checklist:
+            last_checklist = c
+            if is_new('country', c.country_code):
+                countries.append((c.country_code, c.country))
+            if is_new('state', c.state_code):
+                states.append((c.state_code, c.state_province))
+            if is_new('county', c.county_code):
+                counties.append((c.county_code, c.county))
+            # Locations are one to one with localities, so a new locality also means a new location.
+            if is_new('locality', c.locality_id):
+                localities.append((c.locality_id, encode('locality_type', c.locality_type), c.locality_name))
+                locations.append((c.locality_id, c.country_code, c.state_code, c.county_code, c.lat, c.lon,
+                                  spatial.grid_cell(c.lat, c.lon)))
+            if is_new('observer', c.observer_id):
+                observers.append((c.observer_id,))
+            if c.checklist_id not in checklists:
+                checklists[c.checklist_id] = (
+                    c.checklist_id, c.locality_id, c.start, c.checklist_comments, duration_minutes(c.duration),
+                    c.distance, c.area, c.number_of_observers, c.complete_checklist, c.group_id,
+                    c.approved, c.reviewed, encode('reason', c.reason), c.protocol, encode('project_code', c.project_code))
+        observations.append((
+            p.observation_id, p.number_observed, p.is_x, encode('age_sex', p.age_sex), p.species_comments, p.last_edit, p.has_media,
+            c.start, c.checklist_id, c.observer_id, p.scientific_name, p.subspecies_scientific_name))
+    return {
+        "stage_country": countries,
+        "stage_stateprovince": states,
+        "stage_county": counties,
+        "stage_locality": localities,
+        "stage_observer": observers,
+        "stage_location": locations,
+        "stage_checklist": list(checklists.values()),
+        "stage_observation": observations,
+    }
+
+
+def duration_minutes(duration):
+    """
+    Converts a checklist duration timedelta back into whole minutes, which is what the eBird data has.
+    """
+    if duration is None:
+        return None
+    return int(duration.total_seconds()) // 60
+
+
+def copy_value(value):
+    """
+    Formats a single value for COPY's text format.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, str):
+        # Backslash has to go first so the others don't get double escaped.
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value)
+
+
+def rows_to_copy_buffer(rows):
+    """
+    Writes rows into an in memory buffer in COPY's text format.
+    Args:
+        rows (list(tuple)): rows to write.
+    Returns:
+        A StringIO at position 0, ready to be given to copy_expert().
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join([copy_value(v) for v in row]))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+def create_staging_tables(cursor):
+    """
+    Creates the temporary staging tables on this connection, if they don't already exist.
+    """
+    for table, columns in STAGING_TABLES.items():
+        cols = ", ".join(f"{name} {sql_type}" for name, sql_type in columns)
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} ({cols}) ON COMMIT DELETE ROWS")
+
+
+def copy_into_staging(cursor, table, rows):
+    """
+    COPY rows into a single staging table.
+    """
+    if not rows:
+        return
+    columns = ", ".join(name for name, _ in STAGING_TABLES[table])
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", rows_to_copy_buffer(rows))
+
+
+def merge_staging(cursor, merge_sql=MERGE_SQL):
+    """
+    Moves the staged rows into the real tables.
+    """
+    for statement in merge_sql:
+        cursor.execute(statement)
+
+
+class BulkLoader:
+    """
+    Writes batches of parsed rows with COPY, using its own DBAPI connection from the engine.
+    Args:
+        engine (Engine): SQLAlchemy engine to get the connection from.
+        merge_sql (sequence(str), optional): statements that move the staged rows into the real tables.
+        batch_filter (function, optional): called with a cursor and the batch before staging, returns the rows to keep.
+        lookups (LookupCache, optional): codes of the dictionary encoded columns' values, warmed here if not given.
+        updates (bool, optional): the merge can update rows that are already stored, so the regions they were in before
+            have to be invalidated in the query cache too, see query_service.stored_scopes().
+    """
+
+    def __init__(self, engine, merge_sql=MERGE_SQL, batch_filter=None, lookups=None, updates=False):
+        self.engine = engine
+        self.merge_sql = merge_sql
+        self.batch_filter = batch_filter
+        self.updates = updates
+        if lookups is None:
+            lookups = LookupCache(engine)
+            lookups.warm()
+        self.lookups = lookups
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.engine.raw_connection()
+        return self.connection
+
+    def write_batch(self, batch, dimensions, done=None):
+        """
+        Stage and merge a batch of rows in a single transaction.
+        Args:
+            batch (list(ParsedRow)): rows from RowDecoder.decode().
+            dimensions (DimensionCache): keys of the dimension rows already in the database, rolled back if the batch fails.
+            done (Checkpoint, optional): checkpoint to commit along with the batch.
+        Raises:
+            OperationalError: the connection had problems, the batch has been rolled back and can be retried.
+        """
+        connection = self.connect()
+        try:
+            cursor = connection.cursor()
+            if self.batch_filter is not None:
+                with metrics.stage("filter"):
+                    batch = self.batch_filter(cursor, batch)
+            with metrics.stage("staging_rows"):
+                staged = staging_rows(batch, dimensions, self.lookups)
+            with metrics.stage("copy"):
+                create_staging_tables(cursor)
+                for table, rows in staged.items():
+                    copy_into_staging(cursor, table, rows)
+            with metrics.stage("merge"):
+                stored = query_service.stored_scopes(cursor) if self.updates else ()
+                merge_staging(cursor, self.merge_sql)
+            with metrics.stage("commit"):
+                if done is not None:
+                    checkpoint.save_dbapi(cursor, done)
+                # Last, so the generations are only locked for as long as the commit takes.
+                query_service.bump_dbapi(cursor, query_service.batch_scopes(batch, stored))
+                connection.commit()
+        except DBAPIOperationalError as ex:
+            # The connection is most likely gone, so get a fresh one for the retry.
+            dimensions.rollback()
+            self.invalidate()
+            raise OperationalError("bulk load batch", None, ex)
+        except Exception:
+            dimensions.rollback()
+            connection.rollback()
+            raise
+        dimensions.commit()
+
+    def invalidate(self):
+        if self.connection is not None:
+            self.connection.invalidate()
+            self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
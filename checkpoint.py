@@ -0,0 +1,64 @@
+"""
+Checkpoints that record how far into a data file a load has committed, so it can be resumed by seeking straight there.
+
+A checkpoint is written in the same transaction as the batch it describes, so it never gets ahead of, or falls behind, the data.
+"""
+import os
+from collections import namedtuple
+from models import LoadCheckpoint
+from sqlalchemy import func
+
+Checkpoint = namedtuple("Checkpoint", ["file_identity", "byte_offset", "row_count"])
+
+# Upsert of a checkpoint row, with psycopg2 style parameters for the bulk loader's DBAPI connection.
+SAVE_SQL = """INSERT INTO load_checkpoint (file_identity, byte_offset, row_count, updated)
+    VALUES (%(file_identity)s, %(byte_offset)s, %(row_count)s, now())
+    ON CONFLICT (file_identity) DO UPDATE
+    SET byte_offset = EXCLUDED.byte_offset, row_count = EXCLUDED.row_count, updated = EXCLUDED.updated"""
+
+
+# The same for asyncpg, which takes numbered parameters. Writers can commit out of order, so it never goes backwards.
+ASYNC_SAVE_SQL = """INSERT INTO load_checkpoint (file_identity, byte_offset, row_count, updated)
+    VALUES ($1, $2, $3, now())
+    ON CONFLICT (file_identity) DO UPDATE
+    SET byte_offset = EXCLUDED.byte_offset, row_count = EXCLUDED.row_count, updated = EXCLUDED.updated
+    WHERE load_checkpoint.row_count < EXCLUDED.row_count"""
+
+def file_identity(file_path):
+    """
+    Identifies a data file by its name and size, which changes with every eBird release.
+    A converted Parquet dataset is a directory, and its size is that of all of the files in it.
+    """
+    if os.path.isdir(file_path):
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(file_path) for name in names)
+        return f"{os.path.basename(os.path.normpath(file_path))}:{size}"
+    return f"{os.path.basename(file_path)}:{os.path.getsize(file_path)}"
+
+
+def save_orm(session, checkpoint):
+    """
+    Adds the checkpoint to the session's current transaction.
+    """
+    session.merge(LoadCheckpoint(file_identity=checkpoint.file_identity, byte_offset=checkpoint.byte_offset,
+                                 row_count=checkpoint.row_count, updated=func.now()))
+
+
+def save_dbapi(cursor, checkpoint):
+    """
+    Runs the checkpoint upsert on a DBAPI cursor, in whatever transaction it's in.
+    """
+    cursor.execute(SAVE_SQL, checkpoint._asdict())
+
+
+def load(session, file_path):
+    """
+    Looks up the last committed checkpoint for a data file.
+    Returns:
+        A Checkpoint, or None if this file has never had a batch committed.
+    """
+    identity = file_identity(file_path)
+    saved = session.query(LoadCheckpoint).filter_by(file_identity=identity).one_or_none()
+    if saved is None:
+        return None
+    return Checkpoint(identity, saved.byte_offset, saved.row_count)
@@ -1,23 +1,175 @@
+import lookups
 import models
-from sqlalchemy import create_engine
+import partitioning
+import schema
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.schema import CreateIndex, CreateTable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 import argparse
+import time
 
-def create_tables(connection_url):
+def create_tables(connection_url, partitioned=False):
     """
-    Simple convenince function that creates the tables specified in the models file.
+    Simple convenince function that creates the tables specified in the models file, unless they're already there.
     Args:
         connection_url (string): Connection URL to use to connect to the database. See https://docs.sqlalchemy.org/en/13/core/engines.html for how to form this string.
+        partitioned (bool, optional): partition checklist and observation by year, see partitioning.
     """
-    engine = create_engine(connection_url, echo=True)
-    models.Base.metadata.create_all(engine)
+    engine = create_engine(connection_url)
+    if schema.check(engine):
+        create_all_tables(engine, partitioned)
+
+def create_all_tables(engine, partitioned=False):
+    """
+    Creates all of the tables, with their indexes and foreign keys, and the views.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        partitioned (bool, optional): partition checklist and observation by year, see partitioning.
+    """
+    if partitioned:
+        create_bare_tables(engine, partitioned=True)
+        build_deferred(engine)
+    else:
+        models.Base.metadata.create_all(engine)
+
+def drop_tables(engine):
+    """
+    Drops all of the tables and views, and everything in them.
+    """
+    models.Base.metadata.drop_all(engine)
+
+def create_bare_tables(engine, partitioned=False):
+    """
+    Creates any missing tables with only their primary keys and unique constraints and indexes, for a fresh load.
+    The unique ones are needed by the bulk loader's ON CONFLICT clauses; everything else is left for build_deferred().
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        partitioned (bool, optional): create checklist and observation as tables partitioned by year, see partitioning.
+    """
+    existing = set(inspect(engine).get_table_names())
+    with engine.begin() as conn:
+        for table in models.metadata.sorted_tables:
+            if table.name in existing:
+                continue
+            if partitioned and table.name in partitioning.PARTITION_COLUMNS:
+                # Their only unique index is the primary key, which includes the partition column.
+                conn.exec_driver_sql(partitioning.table_sql(table, engine.dialect))
+                continue
+            conn.execute(CreateTable(table, include_foreign_key_constraints=[]))
+            for index in table.indexes:
+                if index.unique:
+                    conn.execute(CreateIndex(index))
+        lookups.create_views(conn)
+
+def deferred_indexes():
+    """
+    All of the non-unique indexes declared in the models, including the GiST index on Location.coords.
+    """
+    return [index for table in models.metadata.sorted_tables for index in table.indexes if not index.unique]
+
+def foreign_key_name(fk):
+    """
+    The name PostgreSQL would have given the constraint, so it's the same whichever way the tables were made.
+    """
+    return fk.name or f"{fk.table.name}_{'_'.join(fk.column_keys)}_fkey"
+
+def add_foreign_key_sql(fk, not_valid=True):
+    """
+    ALTER TABLE statement adding a foreign key from the models.
+    By default it's added as NOT VALID, which is instant, so the checking can happen later in VALIDATE CONSTRAINT.
+    """
+    referred = fk.elements[0].column.table.name
+    referred_columns = ", ".join(e.column.name for e in fk.elements)
+    deferrable = ""
+    if fk.deferrable:
+        deferrable = f" DEFERRABLE INITIALLY {fk.initially or 'IMMEDIATE'}"
+    return (f"ALTER TABLE {fk.table.name} ADD CONSTRAINT {foreign_key_name(fk)} "
+            f"FOREIGN KEY ({', '.join(fk.column_keys)}) REFERENCES {referred} ({referred_columns}){deferrable}"
+            f"{' NOT VALID' if not_valid else ''}")
+
+def build_deferred(engine, jobs=4, maintenance_work_mem=None):
+    """
+    Builds the indexes and foreign keys left out by create_bare_tables(), once the data is loaded.
+    Indexes are built jobs at a time, each on its own connection. Foreign keys are then all added as NOT VALID and validated in parallel too.
+    Anything that already exists is skipped, so this can be rerun if it gets interrupted.
+    Partitioned tables can't have NOT VALID foreign keys, so theirs are checked as they are added instead.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        jobs (int, optional): number of statements to run at once.
+        maintenance_work_mem (str, optional): such as '2GB', memory for each index build.
+    """
+    inspector = inspect(engine)
+    existing_fks = set()
+    for table in models.metadata.sorted_tables:
+        existing_fks.update(fk['name'] for fk in inspector.get_foreign_keys(table.name))
+    indexes = deferred_indexes()
+    partitioned = partitioning.is_partitioned(engine)
+    fks = []
+    checked_fks = []
+    for table in models.metadata.sorted_tables:
+        if partitioned and table.name in partitioning.PARTITION_COLUMNS:
+            checked_fks.extend(statement for statement in
+                               partitioning.foreign_key_statements(table, foreign_key_name, add_foreign_key_sql)
+                               if statement[0] not in existing_fks)
+        else:
+            fks.extend(fk for fk in table.foreign_key_constraints if foreign_key_name(fk) not in existing_fks)
+
+    def run(name, statement):
+        start = time.monotonic()
+        with engine.begin() as conn:
+            if maintenance_work_mem is not None:
+                conn.exec_driver_sql(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+            if isinstance(statement, str):
+                conn.exec_driver_sql(statement)
+            else:
+                conn.execute(statement)
+        return name, time.monotonic() - start
+
+    def run_all(description, statements):
+        print(f"{curr_time()} Building {len(statements)} {description} with {jobs} jobs.")
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(run, name, statement) for name, statement in statements]
+            for done, future in enumerate(as_completed(futures), 1):
+                name, seconds = future.result()
+                print(f"{curr_time()} [{done}/{len(statements)}] {name} took {seconds:.1f}s.")
+
+    run_all("indexes", [(index.name, CreateIndex(index, if_not_exists=True)) for index in indexes])
+    # Adding NOT VALID constraints only takes a moment, but needs locks on both tables, so these go one at a time.
+    with engine.begin() as conn:
+        for fk in fks:
+            conn.exec_driver_sql(add_foreign_key_sql(fk))
+    run_all("foreign key validations", [
+        (foreign_key_name(fk), f"ALTER TABLE {fk.table.name} VALIDATE CONSTRAINT {foreign_key_name(fk)}") for fk in fks])
+    if checked_fks:
+        run_all("partitioned table foreign keys", checked_fks)
+
+def curr_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 def parse_command_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--connection', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL", required=True)
+    parser.add_argument('--bare', dest="bare", help="Create the tables without secondary indexes or foreign keys, for a fresh load.", action="store_true")
+    parser.add_argument('--build-deferred', dest="build_deferred", help="Build the indexes and foreign keys left out by --bare.", action="store_true")
+    parser.add_argument('--partitioned', dest="partitioned", help="Partition the checklist and observation tables by year.", action="store_true")
+    parser.add_argument('--detach', dest="detach_year", help="Detach the checklist and observation partitions for a year.", metavar="YEAR", type=int)
+    parser.add_argument('-j', '--jobs', dest="jobs", help="Number of indexes to build at once.", metavar="N", type=int, default=4)
     args = parser.parse_args()
     return args
 
 if __name__ == "__main__":
     options = parse_command_line()
     connection = options.connection_url
-    create_tables(connection)
\ No newline at end of file
+    if options.detach_year is not None:
+        engine = create_engine(connection)
+        partitioning.detach_partition(engine, 'observation', options.detach_year)
+        partitioning.detach_partition(engine, 'checklist', options.detach_year)
+    elif options.bare or options.build_deferred:
+        engine = create_engine(connection)
+        if options.bare:
+            create_bare_tables(engine, options.partitioned)
+        if options.build_deferred:
+            build_deferred(engine, options.jobs)
+    else:
+        create_tables(connection, options.partitioned)
@@ -0,0 +1,136 @@
+"""
+Keeps track of which countries, states, counties, localities and observers are already in the database.
+
+Only the keys are kept, not ORM instances: plain sets for the handful of text codes, and bitmaps for the integer
+locality and observer ids, of which there are millions. The cache is filled with one query per table when a load
+starts, so after that nothing needs to be looked up, and anything not in the cache can simply be inserted.
+"""
+import sys
+from sqlalchemy import select
+from models import Country, County, Locality, Observer, StateProvince
+
+# Rows fetched at a time while warming up.
+WARM_FETCH_ROWS = 100000
+
+
+class IdSet:
+    """
+    A set of non-negative integers, stored as a bitmap. eBird ids are dense enough that this takes a fraction of the
+    memory of a set of ints: a million localities fit in about 125kB.
+    """
+    __slots__ = ("bits", "count")
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self.bits):
+            # Grow geometrically so a steadily increasing id doesn't mean a reallocation every time.
+            self.bits.extend(bytes(max(byte + 1, 2 * len(self.bits)) - len(self.bits)))
+        mask = 1 << (i & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def discard(self, i):
+        byte = i >> 3
+        mask = 1 << (i & 7)
+        if byte < len(self.bits) and self.bits[byte] & mask:
+            self.bits[byte] &= ~mask
+            self.count -= 1
+
+    def nbytes(self):
+        return sys.getsizeof(self.bits)
+
+
+class DimensionCache:
+    """
+    The keys of every dimension table row in the database, plus those added by the batch currently being written.
+    Keys added since the last commit() are forgotten again by rollback(), so a failed batch can be retried.
+    """
+    # Dimension name to the model and its key column.
+    DIMENSIONS = {
+        'country': Country.country_code,
+        'state': StateProvince.state_code,
+        'county': County.county_code,
+        'locality': Locality.locality_id,
+        'observer': Observer.observer_id,
+    }
+
+    def __init__(self):
+        self.keys = {
+            'country': set(),
+            'state': set(),
+            'county': set(),
+            'locality': IdSet(),
+            'observer': IdSet(),
+        }
+        self.pending = []
+        self.hits = dict.fromkeys(self.keys, 0)
+        self.misses = dict.fromkeys(self.keys, 0)
+
+    def warm(self, session):
+        """
+        Loads every key from the database, with one query per dimension.
+        Args:
+            session (Session): SQLalchemy session.
+        """
+        for dimension, column in self.DIMENSIONS.items():
+            keys = self.keys[dimension]
+            result = session.execute(select(column).execution_options(yield_per=WARM_FETCH_ROWS))
+            for key in result.scalars():
+                keys.add(key)
+        self.pending = []
+
+    def is_new(self, dimension, key):
+        """
+        Checks for a key, remembering it if it wasn't there, so only the first caller gets told to insert it.
+        Args:
+            dimension (str): one of the DIMENSIONS.
+            key: the value of the dimension's key column.
+        Returns:
+            True if the key has to be inserted into the database, False if it is already there.
+        """
+        keys = self.keys[dimension]
+        if key in keys:
+            self.hits[dimension] += 1
+            return False
+        self.misses[dimension] += 1
+        keys.add(key)
+        self.pending.append((dimension, key))
+        return True
+
+    def commit(self):
+        self.pending = []
+
+    def rollback(self):
+        for dimension, key in self.pending:
+            self.keys[dimension].discard(key)
+        self.pending = []
+
+    def memory_footprint(self):
+        """
+        Approximate bytes used by each dimension's keys.
+        """
+        footprint = {}
+        for dimension, keys in self.keys.items():
+            if isinstance(keys, IdSet):
+                footprint[dimension] = keys.nbytes()
+            else:
+                footprint[dimension] = sys.getsizeof(keys) + sum(sys.getsizeof(k) for k in keys)
+        return footprint
+
+    def stats(self):
+        """
+        A one line summary of the size, hits and misses of every dimension, for progress output.
+        """
+        return ", ".join(f"{d}: {len(k)} ({self.hits[d]} hits, {self.misses[d]} misses)" for d, k in self.keys.items())
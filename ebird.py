@@ -0,0 +1,245 @@
+"""
+One command line for setting up, loading, checking on and exporting an eBird database:
+
+    python ebird.py init -s URL             create the tables, if the database doesn't have them yet
+    python ebird.py load -s URL -f FILE     load a data file
+    python ebird.py load --dry-run -f FILE  parse a data file without a database, to time the parser or check the data
+    python ebird.py resume -s URL -f FILE   carry on with a load from its last checkpoint
+    python ebird.py status -s URL           schema version, checkpoints and table sizes
+    python ebird.py export -s URL -o FILE   export observations, see export
+
+Nothing here imports SQLAlchemy, or anything else heavy, until a command needs it, and status only needs psycopg2, so
+it starts in well under a second. init and load look at which version of the schema the database has before they
+create anything (see schema): an empty database gets the tables, an up to date one is left as it is, and one from an
+older version has to be upgraded with init --upgrade first. Nothing is ever dropped without --reset.
+"""
+import argparse
+import re
+import sys
+from datetime import date
+import batching
+
+# Tables whose approximate sizes status shows.
+STATUS_TABLES = ("observation", "checklist", "location", "observer", "species", "subspecies")
+
+# Approximate row counts from the planner's statistics, including those of any partitions, so nothing is scanned.
+TABLE_SIZES_SQL = """SELECT t.name, (
+        SELECT sum(greatest(c.reltuples, 0)) FROM pg_class c
+        WHERE c.oid = to_regclass(t.name) OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(t.name))
+    )::bigint
+    FROM unnest(%s::text[]) AS t(name)"""
+
+
+def libpq_dsn(connection_url):
+    """
+    A libpq connection URI from an SQLAlchemy connection URL, which is the same without the +driver part.
+    """
+    return re.sub(r"^postgres(ql)?(\+\w+)?://", "postgresql://", connection_url)
+
+
+def add_connection_argument(parser, required=True):
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
+                        required=required)
+
+
+def add_filter_arguments(parser, verb):
+    """
+    The row_filter filters, as arguments. verb is what's done with the rows that pass, such as load.
+    row_filter.options_filters() turns them back into the filters.
+    """
+    parser.add_argument('--country', dest="countries", help=f"Only {verb} these countries, by code, such as US.",
+                        metavar="CODE", action="extend", nargs="+", required=False, default=None)
+    parser.add_argument('--state', dest="states", help=f"Only {verb} these states or provinces, by code, such as US-NY.",
+                        metavar="CODE", action="extend", nargs="+", required=False, default=None)
+    parser.add_argument('--since', dest="since", help=f"Only {verb} observations on or after this date.", metavar="YYYY-MM-DD",
+                        type=date.fromisoformat, required=False, default=None)
+    parser.add_argument('--until', dest="until", help=f"Only {verb} observations on or before this date.", metavar="YYYY-MM-DD",
+                        type=date.fromisoformat, required=False, default=None)
+    parser.add_argument('--species', dest="species", help=f"Only {verb} these species or subspecies, by scientific or common name.",
+                        metavar="NAME", action="extend", nargs="+", required=False, default=None)
+
+
+def add_schema_arguments(parser):
+    parser.add_argument('--partitioned', dest="partitioned", help="Create the checklist and observation tables partitioned by year.",
+                        action="store_true")
+    parser.add_argument('--reset', dest="reset", help="Drop all of the tables, and everything in them, and create them again.",
+                        action="store_true")
+
+
+def add_load_arguments(parser):
+    """
+    Everything a load takes, apart from whether it's resuming.
+    """
+    parser.add_argument('-f', '--file', dest="input_file", help="Path to ebird datafile, which can be a .txt, .gz, .zst, the release .tar or a directory from parquet_stage.py.", metavar="INFILE",
+                        required=True)
+    parser.add_argument('-r', '--row', dest="start_row", help="Start parsing at this row.", metavar="STARTROW",
+                        type=int, required=False, default=0)
+    parser.add_argument('-c', '--csv', dest="csv_path", help="Path to the ebird taxonomy csv.", metavar="CSVPATH",
+                        required=False, default=None)
+    # Only a dry run can do without one, see check_load_arguments().
+    add_connection_argument(parser, required=False)
+    parser.add_argument('-b', '--bulk', dest="bulk", help="Load with PostgreSQL COPY and set based inserts instead of the ORM.",
+                        action="store_true")
+    parser.add_argument('-i', '--incremental', dest="incremental", help="Keep the existing data and only upsert new or edited rows.",
+                        action="store_true")
+    parser.add_argument('--deleted', dest="deleted_path", help="File of removed observation (OBS...) and checklist (S...) identifiers to delete.",
+                        metavar="PATH", required=False, default=None)
+    parser.add_argument('--fresh', dest="fresh", help="Load into tables without indexes or foreign keys, and build them all at the end.",
+                        action="store_true")
+    add_schema_arguments(parser)
+    parser.add_argument('--index-jobs', dest="index_jobs", help="Number of indexes to build at once with --fresh.", metavar="N",
+                        type=int, required=False, default=4)
+    parser.add_argument('--metrics-log', dest="metrics_log", help="Append load metrics to this JSON lines file after each batch.",
+                        metavar="PATH", required=False, default=None)
+    parser.add_argument('--metrics-textfile', dest="metrics_textfile", help="Write load metrics to this Prometheus textfile (.prom) after each batch.",
+                        metavar="PATH", required=False, default=None)
+    parser.add_argument('--async', dest="async_writers", help="Read, parse and write at the same time, with N asyncpg connections writing.",
+                        metavar="N", type=int, required=False, default=0)
+    parser.add_argument('--quarantine', dest="quarantine_path", help="Write lines and rows that can't be loaded to this file and keep going.",
+                        metavar="PATH", required=False, default=None)
+    parser.add_argument('--batch-size', dest="batch_bounds", help="Smallest and largest batches, in rows; the same twice for a fixed size.",
+                        metavar=("MIN", "MAX"), type=int, nargs=2, required=False, default=(batching.MIN_BATCH, batching.MAX_BATCH))
+    parser.add_argument('--batch-seconds', dest="batch_seconds", help="Seconds each batch should take to write and commit.",
+                        metavar="SECONDS", type=float, required=False, default=batching.TARGET_SECONDS)
+    parser.add_argument('--max-rss', dest="max_rss", help="Make batches smaller when the loader uses more memory than this.",
+                        metavar="MIB", type=int, required=False, default=None)
+    add_filter_arguments(parser, "load")
+    parser.add_argument('--rollups', dest="rollups", help="Keep the species by region and period rollups up to date, building them if need be.",
+                        action="store_true")
+    parser.add_argument('-w', '--workers', dest="workers", help="Number of processes to parse the data file with.", metavar="N",
+                        type=int, required=False, default=1)
+    parser.add_argument('--dry-run', dest="dry_run", help="Parse and stage every row without a database, then report rows per second and errors.",
+                        action="store_true")
+    parser.add_argument('--profile', dest="profile_dir", help="Profile each stage of some of the batches, and write flame graph stacks to DIR/<stage>.folded.",
+                        metavar="DIR", required=False, default=None)
+    parser.add_argument('--profiler', dest="profiler", help="Sample the stack, which costs next to nothing, or trace every call with cProfile.",
+                        choices=("sample", "cprofile"), default="sample")
+    parser.add_argument('--profile-every', dest="profile_every", help="Profile the first batch and every Nth one after it.",
+                        metavar="N", type=int, required=False, default=10)
+
+
+def check_load_arguments(parser, options):
+    """
+    What argparse can't check by itself: everything but a dry run needs a database.
+    """
+    if options.dry_run:
+        if options.resume:
+            parser.error("a dry run can't resume, as the checkpoints are in the database, use -r/--row instead")
+    elif options.connection_url is None:
+        parser.error("the following arguments are required: -s/--sqlalchemy, unless it's a --dry-run")
+
+
+def add_export_arguments(parser):
+    add_connection_argument(parser)
+    parser.add_argument('-o', '--out', dest="out_path", help="File to write, or directory for Parquet.", metavar="PATH",
+                        required=True)
+    parser.add_argument('--format', dest="format", help="tsv, gzipped if --out ends in .gz, or a Parquet directory.",
+                        choices=("tsv", "parquet"), default="tsv")
+    parser.add_argument('-j', '--jobs', dest="jobs", help="Number of connections to export with.", metavar="N",
+                        type=int, default=4)
+    add_filter_arguments(parser, "export")
+
+
+def run_init(options):
+    import database_setup
+    import schema
+    from sqlalchemy import create_engine
+    engine = create_engine(options.connection_url)
+    if options.reset:
+        database_setup.drop_tables(engine)
+    if options.upgrade:
+        start = schema.upgrade(engine)
+        print(f"Upgraded from {schema.describe(start)}.")
+    elif schema.check(engine):
+        if options.bare:
+            database_setup.create_bare_tables(engine, options.partitioned)
+        else:
+            database_setup.create_all_tables(engine, options.partitioned)
+        print("Tables created.")
+    print(f"The database has {schema.describe(schema.version(engine))}.")
+
+
+def run_load(options):
+    import ebird_data_parse
+    ebird_data_parse.main(options)
+
+
+def run_status(options):
+    try:
+        import psycopg2
+    except ImportError:
+        raise ImportError("status requires the psycopg2 package: pip install psycopg2")
+    import schema
+    connection = psycopg2.connect(libpq_dsn(options.connection_url))
+    try:
+        cursor = connection.cursor()
+        version = schema.version_of(cursor)
+        print(f"The database has {schema.describe(version)}.")
+        if version == 0:
+            return
+        cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('checklist')")
+        partitioned = cursor.fetchone()[0]
+        cursor.execute(TABLE_SIZES_SQL, (list(STATUS_TABLES),))
+        sizes = ", ".join(f"{name} {rows if rows is not None else 0:,}" for name, rows in cursor.fetchall())
+        print(f"Approximate rows{' (partitioned by year)' if partitioned else ''}: {sizes}.")
+        if version >= 4:
+            cursor.execute("SELECT version, species_count, subspecies_count, loaded FROM taxonomy_version ORDER BY loaded")
+            for taxonomy, species, subspecies, loaded in cursor.fetchall():
+                print(f"Taxonomy {taxonomy}: {species} species, {subspecies} subspecies, loaded {loaded:%Y-%m-%d %H:%M:%S}.")
+        if version >= 6:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM aggregate_region)")
+            print(f"Rollups {'built' if cursor.fetchone()[0] else 'not built'}.")
+        if version >= 2:
+            cursor.execute("SELECT file_identity, row_count, byte_offset, updated FROM load_checkpoint ORDER BY updated DESC")
+            for identity, rows, offset, updated in cursor.fetchall():
+                print(f"Checkpoint {identity}: {rows:,} rows, byte {offset:,}, at {updated:%Y-%m-%d %H:%M:%S}.")
+    finally:
+        connection.close()
+
+
+def run_export(options):
+    import export
+    export.main(options)
+
+
+def parse_command_line(args=None):
+    parser = argparse.ArgumentParser(description="Set up, load, check on and export an eBird database.")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="COMMAND")
+
+    init_parser = commands.add_parser("init", help="Create the tables, unless the database already has them.")
+    add_connection_argument(init_parser)
+    add_schema_arguments(init_parser)
+    init_parser.add_argument('--bare', dest="bare", help="Create the tables without secondary indexes or foreign keys, for a fresh load.",
+                             action="store_true")
+    init_parser.add_argument('--upgrade', dest="upgrade", help="Upgrade a database made by an older version.",
+                             action="store_true")
+    init_parser.set_defaults(run=run_init)
+
+    load_parser = commands.add_parser("load", help="Load a data file.")
+    add_load_arguments(load_parser)
+    load_parser.set_defaults(run=run_load, resume=False)
+
+    resume_parser = commands.add_parser("resume", help="Carry on loading a data file from its last checkpoint. A .gz, .zst or .tar file has to be decompressed from the start up to the checkpoint again, only a .txt file is skipped ahead in.")
+    add_load_arguments(resume_parser)
+    resume_parser.set_defaults(run=run_load, resume=True)
+
+    status_parser = commands.add_parser("status", help="Show the schema version, checkpoints and table sizes.")
+    add_connection_argument(status_parser)
+    status_parser.set_defaults(run=run_status)
+
+    export_parser = commands.add_parser("export", help="Export observations as an EBD style tsv or Parquet.")
+    add_export_arguments(export_parser)
+    export_parser.set_defaults(run=run_export)
+    options = parser.parse_args(args)
+    if options.run is run_load:
+        check_load_arguments(resume_parser if options.resume else load_parser, options)
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    try:
+        options.run(options)
+    except RuntimeError as ex:
+        print(ex, file=sys.stderr)
+        sys.exit(1)
@@ -1,36 +1,113 @@
 import csv
 import argparse
+import json
 import os
 from datetime import datetime, timedelta
 from decimal import Decimal
 import re
-from functools import lru_cache
-from models import Checklist, Country, County, Locality, Location, Observation, Observer, Species, StateProvince, SubSpecies
+import tempfile
+import time
+from collections import Counter, namedtuple
+from operator import itemgetter
+import batching
+import checkpoint
+import database_setup
+import dimension_cache
+import input_stream
+import lookups
+import metrics
+import parallel_parse
+import partitioning
+import quarantine
+import row_filter
+import schema
+import taxonomy
+from models import Checklist, Country, County, Locality, Location, Observation, Observer, StateProvince
 from sqlalchemy import create_engine 
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql import ClauseElement
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm.exc import  NoResultFound, MultipleResultsFound
 
-Base = declarative_base()
 DBSession = scoped_session(sessionmaker())
 engine = None
 
-# How many TSV lines to batch up together. 10,000 seemed to be a good balance between db and parsing time in testing.
+# How many TSV lines to batch up together when the size isn't being picked by batching.BatchSizer. 10,000 seemed to be a
+# good balance between db and parsing time in testing.
 COMMIT_BATCH = 10000
 
+# Number of different errors a dry run lists at the end, most common first.
+DRY_RUN_ERRORS = 10
+
 # What version of the eBird metadata does this import script support?
 EBIRD_METADATA_VERSION = "1.12"
 
+# Every column in version EBIRD_METADATA_VERSION of the data, in order. The lines end with a tab, hence the empty name at the end.
+EBIRD_COLUMNS = (
+    "GLOBAL UNIQUE IDENTIFIER", "LAST EDITED DATE", "TAXONOMIC ORDER", "CATEGORY", "COMMON NAME", "SCIENTIFIC NAME",
+    "SUBSPECIES COMMON NAME", "SUBSPECIES SCIENTIFIC NAME", "OBSERVATION COUNT", "BREEDING BIRD ATLAS CODE",
+    "BREEDING BIRD ATLAS CATEGORY", "AGE/SEX", "COUNTRY", "COUNTRY CODE", "STATE", "STATE CODE", "COUNTY", "COUNTY CODE",
+    "IBA CODE", "BCR CODE", "USFWS CODE", "ATLAS BLOCK", "LOCALITY", "LOCALITY ID", "LOCALITY TYPE", "LATITUDE",
+    "LONGITUDE", "OBSERVATION DATE", "TIME OBSERVATIONS STARTED", "OBSERVER ID", "SAMPLING EVENT IDENTIFIER",
+    "PROTOCOL TYPE", "PROTOCOL CODE", "PROJECT CODE", "DURATION MINUTES", "EFFORT DISTANCE KM", "EFFORT AREA HA",
+    "NUMBER OBSERVERS", "ALL SPECIES REPORTED", "GROUP IDENTIFIER", "HAS MEDIA", "APPROVED", "REVIEWED", "REASON",
+    "TRIP COMMENTS", "SPECIES COMMENTS", "")
+
+# The columns the importer uses that are different for every observation, in the order convert_observation() expects them.
+OBSERVATION_COLUMNS = (
+    "GLOBAL UNIQUE IDENTIFIER", "LAST EDITED DATE", "CATEGORY", "SCIENTIFIC NAME", "SUBSPECIES SCIENTIFIC NAME",
+    "OBSERVATION COUNT", "AGE/SEX", "HAS MEDIA", "SPECIES COMMENTS")
+
+# The columns the importer uses that are the same for every observation on a checklist, in the order convert_checklist() expects them.
+CHECKLIST_COLUMNS = (
+    "SAMPLING EVENT IDENTIFIER", "COUNTRY", "COUNTRY CODE", "STATE", "STATE CODE", "COUNTY", "COUNTY CODE",
+    "LOCALITY", "LOCALITY ID", "LOCALITY TYPE", "LATITUDE", "LONGITUDE", "OBSERVATION DATE",
+    "TIME OBSERVATIONS STARTED", "OBSERVER ID", "PROTOCOL TYPE", "PROJECT CODE",
+    "DURATION MINUTES", "EFFORT DISTANCE KM", "EFFORT AREA HA", "NUMBER OBSERVERS", "ALL SPECIES REPORTED",
+    "GROUP IDENTIFIER", "APPROVED", "REVIEWED", "REASON", "TRIP COMMENTS")
+
+REQUIRED_COLUMNS = OBSERVATION_COLUMNS + CHECKLIST_COLUMNS
+
+# A single eBird row after all of the field conversions, independent of how it ends up in the database.
+# Consecutive rows from the same sampling event share a single ParsedChecklist.
+ParsedRow = namedtuple("ParsedRow", [
+    "observation_id", "number_observed", "is_x", "age_sex", "species_comments",
+    "scientific_name", "subspecies_scientific_name",
+    "has_media", "last_edit", "checklist"])
 
-def init_sqlalchemy(connection_url):
+# The checklist, location and observer parts of a row, which repeat for every observation on a checklist.
+ParsedChecklist = namedtuple("ParsedChecklist", [
+    "checklist_id",
+    "start", "duration", "checklist_comments", "distance", "area", "number_of_observers", "complete_checklist",
+    "group_id", "approved", "reviewed", "reason", "protocol", "project_code",
+    "observer_id",
+    "lat", "lon", "locality_name", "locality_id", "locality_type",
+    "state_code", "state_province", "county_code", "county", "country_code", "country"])
+
+
+def init_sqlalchemy(connection_url, reset=False, bare=False, partitioned=False):
+    """
+    Sets up the engine and session, and the tables in the database if it doesn't have them yet.
+    Args:
+        connection_url (str): SQLAlchemy connection URL.
+        reset (bool, optional): drop and recreate all of the tables.
+        bare (bool, optional): create tables without their secondary indexes and foreign keys, see database_setup.build_deferred().
+        partitioned (bool, optional): create checklist and observation partitioned by year, see partitioning.
+    Raises:
+        RuntimeError: if the database has an older version of the schema, see schema.
+    """
     global engine
     engine = create_engine(connection_url, echo=False)
     DBSession.remove()
     DBSession.configure(bind=engine, autoflush=False, expire_on_commit=False)
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    if reset:
+        database_setup.drop_tables(engine)
+    # Tables that are already there, and up to date, are left as they are.
+    if not schema.check(engine):
+        return
+    if bare:
+        database_setup.create_bare_tables(engine, partitioned)
+    else:
+        database_setup.create_all_tables(engine, partitioned)
 
 def get_or_create(session, model, defaults=None, **kwargs):
     """
@@ -104,140 +181,537 @@ def parse_ebird_taxonomy(file_path):
 def parsed_taxa_csv_to_db(taxa_csv_file_path):
     """
     Creates species and subspecies instances in the database from the eBird taxonomy CSV file, after performing some much needed fixes.
-    This creation is idempotent through the use of get_or_create() and can be run multiple times.
+    Each table is upserted in one go, and a version of the taxonomy that has already been loaded is skipped, so this can be run multiple times.
     Args:
         taxa_csv_file_path (str):  path of the csv file to open and parse.
+    Returns:
+        True if the taxonomy was loaded, False if this version of it already had been.
     """
     cat = {'issf': 0, 'form': 1, 'domestic': 2, 'slash': 3, 'intergrade': 4, 'spuh': 5, 'hybrid': 6}
 
+    version = taxonomy.taxonomy_version(taxa_csv_file_path)
+    if taxonomy.is_loaded(DBSession, version):
+        return False
     species, subspecies = parse_ebird_taxonomy(taxa_csv_file_path)
-    for k, v in species.items():
-        scientific_name = v['scientific_name']
-        common_name = v['common_name']
-        taxonomic_order = k
-        species_code =  v["species_code"]
-        species_data = {'common_name':common_name, 'taxonomic_order': taxonomic_order, "species_code": species_code}
-        _ = get_or_create(DBSession, Species, species_data, scientific_name=scientific_name)
+    species_rows = [{'scientific_name': v['scientific_name'], 'common_name': v['common_name'], 'taxonomic_order': k,
+                     'species_code': v['species_code']} for k, v in species.items()]
+    subspecies_rows = [{'scientific_name': v['scientific_name'], 'common_name': v['common_name'], 'taxonomic_order': k,
+                        'parent_species_id': v['parent_scientific_name'], 'category': cat[v['category']],
+                        'subspecies_code': v['subspecies_code']} for k, v in subspecies.items()]
+    taxonomy.load(DBSession, version, species_rows, subspecies_rows)
     DBSession.commit()
-
-    for k, v in subspecies.items():
-        scientific_name = v['scientific_name']
-        common_name = v['common_name']
-        parent = v['parent_scientific_name']
-        taxonomic_order = k
-        category = cat[v['category']]
-        subspecies_code =  v["subspecies_code"]
-        supspecies_data = {'common_name': common_name, 'taxonomic_order': taxonomic_order, 'parent_species_id': parent, 'category':  category, "subspecies_code":  subspecies_code}
-        _ = get_or_create(DBSession, SubSpecies, supspecies_data, scientific_name=scientific_name)
-    DBSession.commit()
-
+    return True
 
 
-def parse_ebird_dump(file_path, start_row, taxa_csv_path=None):
-    # Caching some common database ids so we don't have to do a SELECT every time we get them.
-    country_code_cache = {}
+def parse_ebird_dump(file_path, start_row, taxa_csv_path=None, bulk=False, workers=1, resume=False,
+                     incremental_load=False, deleted_path=None, metrics_log=None, metrics_textfile=None,
+                     async_writers=0, quarantine_path=None, batch_sizer=None, filters=None, rollups=False,
+                     profiler=None):
+    """
+    Parse the eBird dataset and load it into the database, in batches sized by batch_sizer.
+    Args:
+        file_path (str): path of the eBird tsv file, or a compressed file or archive containing it, or a Parquet
+            dataset directory written by parquet_stage.
+        start_row (int): skip this many rows before loading.
+        taxa_csv_path (str, optional): path of the eBird taxonomy csv to load first.
+        bulk (bool, optional): use the COPY based loader in bulk_load instead of the ORM.
+        workers (int, optional): number of processes to parse with, more than 1 uses parallel_parse.
+        resume (bool, optional): carry on from the last checkpoint committed for this file.
+        incremental_load (bool, optional): only write rows that are new or edited since they were last loaded, see incremental.
+        deleted_path (str, optional): list of removed records to delete once the load is finished.
+        metrics_log (str, optional): JSON lines file to append the load's metrics to after each batch, see metrics.
+        metrics_textfile (str, optional): Prometheus textfile to write the load's metrics to after each batch.
+        async_writers (int, optional): load with this many concurrent asyncpg connections, see async_load.
+        quarantine_path (str, optional): write lines and rows that can't be loaded to this file and carry on, see quarantine.
+        batch_sizer (BatchSizer, optional): picks the size of each batch, by default a batching.BatchSizer() with its
+            default bounds and target.
+        filters (dict, optional): only load the rows that pass these filters, see row_filter.RowFilter for the keys.
+        rollups (bool, optional): keep the species by region and period rollups up to date, or build them at the end
+            if they haven't been yet, see aggregates.
+        profiler (StageProfiler, optional): profiles the stages of some of the batches, see profiling.
+    """
     print(f"Start time: {curr_time()}")
     # Creates the species and subspecies entries in the database.
     if taxa_csv_path is not None:
-        parsed_taxa_csv_to_db(taxa_csv_path)
-        print(f"{curr_time()} Species and SubSpecies data added to database from taxonomy CSV.")
+        if parsed_taxa_csv_to_db(taxa_csv_path):
+            print(f"{curr_time()} Species and SubSpecies data added to database from taxonomy CSV.")
+        else:
+            print(f"{curr_time()} This version of the taxonomy is already loaded.")
 
-    species_sci_names = {x.scientific_name for x in DBSession.query(Species).all()}
-    subspecies_sci_names = {x.scientific_name for x in DBSession.query(SubSpecies).all()}
+    names = taxonomy.load_names(DBSession)
+    species_sci_names = names.species
+    subspecies_sci_names = names.subspecies
 
-    with open(file_path, 'r') as f:
-        # QUOTE_NONE could be dangerous if there are tabs inside a field. For now, this assumes there isn't.
-        reader = csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
-        count = 0
-        err = None
-        # Batch our database inserts/updates to keep from having a commit() every single call.
-        # This could potentially lead to problems if we need to look up something that hasn't been committed yet, but it seems that the caching takes care of this. This could be a problem, in general.
+    # Knowing which dimension rows already exist means we never have to SELECT them.
+    dimensions = dimension_cache.DimensionCache()
+    dimensions.warm(DBSession)
+    print(f"{curr_time()} Dimension cache warmed, {dimensions.stats()}. Bytes used: {dimensions.memory_footprint()}")
+    encoders = lookups.LookupCache(engine)
+    encoders.warm()
+    print(f"{curr_time()} Lookup values cached, {encoders.stats()}.")
+
+    # Rows are routed to their year's partition by PostgreSQL, the partitions just have to exist first.
+    partitions = None
+    if partitioning.is_partitioned(engine):
+        partitions = partitioning.PartitionManager(engine)
+        print(f"{curr_time()} Loading into partitioned tables, {len(partitions.years)} years so far.")
+
+    if async_writers and incremental_load:
+        raise ValueError("Incremental loads can't be done with the async loader.")
+    # Each of the loaders, and the rollups, is only imported when it's used, so the others' imports aren't paid for.
+    update_rollups = False
+    if rollups:
+        import aggregates
+        # Rollups that haven't been built yet are built once at the end, which is much quicker than batch by batch.
+        update_rollups = aggregates.is_built(engine)
+    merge_sql = None
+    bulk_loader = None
+    if incremental_load:
+        import incremental
+        bulk_loader = incremental.loader(engine, partitioned=partitions is not None, update_aggregates=update_rollups,
+                                        lookups=encoders)
+    elif bulk or async_writers:
+        import bulk_load
+        merge_sql = bulk_load.MERGE_SQL
+        if partitions is not None:
+            merge_sql = partitioning.conflict_targets(merge_sql)
+        if update_rollups:
+            merge_sql = aggregates.with_updates(merge_sql)
+        if not async_writers:
+            bulk_loader = bulk_load.BulkLoader(engine, merge_sql, lookups=encoders)
+
+    identity = checkpoint.file_identity(file_path)
+    start_offset = 0
+    # Skipped rows still count towards the total.
+    count = start_row
+    if resume:
+        saved = checkpoint.load(DBSession, file_path)
+        if saved is not None:
+            start_offset = saved.byte_offset
+            count = saved.row_count
+            print(f"{curr_time()} Resuming {identity} at row {count}, byte {start_offset}.")
+            if start_offset and input_stream.is_compressed(file_path):
+                print(f"{curr_time()} The file is compressed, so everything before byte {start_offset} has to be "
+                      f"decompressed again to get there, which takes about as long as reading it did.")
+    metrics.configure(metrics_log, metrics_textfile, count, profiler)
+    quarantine.configure(quarantine_path)
+    if batch_sizer is None:
+        batch_sizer = batching.BatchSizer()
+    metrics.gauge("batch_size", batch_sizer.size)
+    # Rows are parsed in the smallest batches, and joined up into ones of whatever size the sizer is on at the time.
+    parse_batch = batch_sizer.min_size
+
+    def attempt(batch, count, done):
+        # Transient errors, like a lost connection, are retried after a wait that doubles each time.
+        for retry in range(quarantine.MAX_RETRIES + 1):
+            try:
+                if bulk_loader is None:
+                    row_batch(batch, count, dimensions, encoders, done, update_rollups)
+                else:
+                    bulk_loader.write_batch(batch, dimensions, done)
+                return
+            except OperationalError:
+                DBSession.rollback()
+                dimensions.rollback()
+                if retry == quarantine.MAX_RETRIES:
+                    raise
+                delay = quarantine.backoff(retry)
+                print(f"{curr_time()} Rollback at:  {count}, retrying in {delay:.1f}s.")
+                metrics.count("retries")
+                time.sleep(delay)
+            except Exception:
+                DBSession.rollback()
+                dimensions.rollback()
+                raise
+
+    def isolate(rows, count, error):
+        # Splits rows that failed together in half until the ones at fault are on their own, and quarantines them.
+        if len(rows) == 1:
+            quarantine.current.add_rows(rows, count + 1, error)
+            metrics.count("quarantined")
+            return
+        middle = len(rows) // 2
+        for part, part_count in ((rows[:middle], count), (rows[middle:], count + middle)):
+            try:
+                attempt(part, part_count, None)
+            except OperationalError:
+                raise
+            except Exception as ex:
+                isolate(part, part_count, ex)
+
+    def write_batch(batch, count, end_offset):
+        # The checkpoint is committed along with the batch.
+        done = checkpoint.Checkpoint(identity, end_offset, count + len(batch))
+        if partitions is not None:
+            with metrics.stage("partitions"):
+                partitions.ensure(partitioning.batch_years(batch))
         try:
-            batch = []
-            for r in reader:
-                err = r
-                if count < start_row:
-                    count += 1
-                    continue
-                batch += [r]
-                if len(batch) == COMMIT_BATCH:
-                    while True:
-                        try:
-                            row_batch(batch, count, species_sci_names, subspecies_sci_names, country_code_cache)
-                            count += COMMIT_BATCH
-                            break
-                        except OperationalError:
-                            print(f"{curr_time()} Rollback at:  {count}")
-                    batch = []
-        except KeyError as ex:
-            print(f"Encountered unknown column {ex} in input data.")
-            print(f"This importer only supports version {EBIRD_METADATA_VERSION}, please ensure your data is of this version as eBird makes changes to the dataset frequently.")
-            raise ex
+            start = time.perf_counter()
+            attempt(batch, count, done)
+            batch_sizer.observe(len(batch), time.perf_counter() - start)
+        except OperationalError:
+            raise
+        except Exception as ex:
+            if quarantine.current is None:
+                raise
+            print(f"{curr_time()} Batch after row {count} failed, looking for the rows at fault: {ex}")
+            isolate(batch, count, ex)
+            # Everything else in the batch is in, so the checkpoint can go past it.
+            attempt([], count, done)
+        metrics.gauge("batch_size", batch_sizer.size)
+        metrics.gauge("resident_bytes", batch_sizer.rss)
+        metrics.count("rows", len(batch))
+        metrics.count("batches")
+        metrics.report(dimensions)
+        return count + len(batch)
+
+    import parquet_stage
+    from_dataset = parquet_stage.is_dataset(file_path)
+    if async_writers:
+        import async_load
+        # Reading, parsing and writing all overlap, with their own retries and checkpoints, so the loop below has
+        # nothing left to do.
+        loader = async_load.AsyncLoader(engine.url, dimensions, async_writers, workers, merge_sql, partitions,
+                                        batch_sizer, filters, encoders)
+        batches = iter(())
+        try:
+            count = loader.load(file_path, start_row, RowDecoder, species_sci_names, subspecies_sci_names,
+                                parse_batch, identity, start_offset, count, ParsedRow, ParsedChecklist)
         except KeyboardInterrupt:
             print(f"Breaking due to crtl-c.")
-            DBSession.commit()
-        except Exception as ex:
-            print(f"{curr_time()} Entries: {count}, CSV Line Number: {reader.line_num}.")
-            print(err)
-            DBSession.commit()
-            raise ex
-        # Making sure everything is definitely comitted.
+    else:
+        batches = parsed_batches(file_path, start_row, species_sci_names, subspecies_sci_names, workers, start_offset,
+                                 parse_batch, quarantine_path, filters)
+    batches = batching.regroup(batches, batch_sizer)
+    offset = start_offset
+    try:
+        while True:
+            # Time spent waiting for the next batch is reading, decompressing and parsing.
+            with metrics.stage("parse"):
+                item = next(batches, None)
+            if item is None:
+                break
+            batch, end_offset = item
+            if not from_dataset:
+                metrics.count("bytes_read", end_offset - offset)
+            offset = end_offset
+            count = write_batch(batch, count, end_offset)
+    except KeyboardInterrupt:
+        print(f"Breaking due to crtl-c.")
+        DBSession.commit()
+    except Exception as ex:
+        print(f"{curr_time()} Entries: {count}.")
         DBSession.commit()
-        print(f"Final count: {count}, End time: {curr_time()}")
+        raise ex
+    finally:
+        if bulk_loader is not None:
+            bulk_loader.close()
+    # Making sure everything is definitely comitted.
+    DBSession.commit()
+    if deleted_path is not None:
+        import incremental
+        deleted_observations, deleted_checklists = incremental.apply_deletions(engine, deleted_path)
+        print(f"{curr_time()} Deleted {deleted_observations} observations and {deleted_checklists} checklists.")
+    if rollups and (not update_rollups or deleted_path is not None):
+        # Deletions aren't followed batch by batch.
+        with metrics.stage("rollups"):
+            aggregates.build(engine)
+        print(f"{curr_time()} Species by region and period rollups built.")
+    print(f"Final count: {count}, End time: {curr_time()}")
+    print(f"Time by stage: {metrics.current.summary()}")
+    if quarantine.current is not None and quarantine.current.count:
+        print(f"{quarantine.current.count} rows quarantined in {quarantine_path}.")
 
 
-def row_batch(batch, count, sp_names, ssp_names, ccc):
+def parsed_batches(file_path, start_row, species_sci_names, subspecies_sci_names, workers=1, start_offset=0,
+                   batch_size=COMMIT_BATCH, quarantine_path=None, filters=None):
     """
-    Run a batch of rows.
+    Reads and parses the eBird dataset in whichever way suits the file.
     Args:
-        batch (list(dict)): Rows from csv.dictreader to parse and insert into the db.
+        file_path (str): path of the eBird tsv file, or a compressed file or archive containing it, or a Parquet
+            dataset directory written by parquet_stage.
+        start_row (int): skip this many rows before parsing.
+        species_sci_names (set): all species' scientific names.
+        subspecies_sci_names (set): all subspecies' scientific names.
+        workers (int, optional): number of processes to parse with, more than 1 uses parallel_parse.
+        start_offset (int, optional): byte offset to start parsing at, from a checkpoint, or row for a dataset.
+        batch_size (int, optional): number of rows per batch.
+        quarantine_path (str, optional): quarantine lines that can't be parsed instead of failing, see quarantine.
+        filters (dict, optional): only parse the lines that pass these filters, see row_filter.
+    Returns:
+        A generator of (batch, end offset) tuples.
+    """
+    import parquet_stage
+    if parquet_stage.is_dataset(file_path):
+        # A dataset from parquet_stage is already parsed, and its checkpoints count rows rather than bytes.
+        _, ds = parquet_stage.import_pyarrow()
+        return parquet_stage.read_dataset(file_path, ParsedRow, ParsedChecklist, batch_size,
+                                          max(start_row, start_offset),
+                                          row_filter.dataset_expression(ds, **(filters or {})))
+    if workers > 1:
+        return parallel_parse.parallel_batches(file_path, start_row, workers, RowDecoder,
+                                               species_sci_names, subspecies_sci_names, batch_size, start_offset,
+                                               quarantine_path, filters)
+    return read_batches(file_path, start_row, species_sci_names, subspecies_sci_names, start_offset,
+                        batch_size, filters)
+
+
+def dry_run(file_path, start_row, taxa_csv_path=None, workers=1, metrics_log=None, metrics_textfile=None,
+            quarantine_path=None, batch_sizer=None, filters=None, profiler=None):
+    """
+    Reads, parses and stages the eBird dataset just as a bulk load would, without a database, and throws the rows away.
+    That measures the parser on its own, and shows whether a new version of the data can be loaded before it is.
+    Lines that can't be parsed are counted instead of stopping it, and reported by error at the end.
+    Args:
+        file_path (str): path of the eBird tsv file, or a compressed file or archive containing it, or a Parquet
+            dataset directory written by parquet_stage.
+        start_row (int): skip this many rows before parsing.
+        taxa_csv_path (str, optional): path of the eBird taxonomy csv, which tells domestic and form rows apart.
+        workers (int, optional): number of processes to parse with, more than 1 uses parallel_parse.
+        metrics_log (str, optional): JSON lines file to append the metrics to after each batch, see metrics.
+        metrics_textfile (str, optional): Prometheus textfile to write the metrics to after each batch.
+        quarantine_path (str, optional): also write the lines that can't be parsed to this file, see quarantine.
+        batch_sizer (BatchSizer, optional): size of the batches, which stays at its starting size without writes.
+        filters (dict, optional): only parse the rows that pass these filters, see row_filter.RowFilter for the keys.
+        profiler (StageProfiler, optional): profiles the stages of some of the batches, see profiling.
+    Returns:
+        The number of rows parsed, and of lines that couldn't be.
+    """
+    print(f"Start time: {curr_time()}")
+    if taxa_csv_path is not None:
+        species, subspecies = parse_ebird_taxonomy(taxa_csv_path)
+        species_sci_names = frozenset(v["scientific_name"] for v in species.values())
+        subspecies_sci_names = frozenset(v["scientific_name"] for v in subspecies.values())
+    else:
+        print(f"{curr_time()} No taxonomy csv given, so forms and domestics are all parsed as species.")
+        species_sci_names = subspecies_sci_names = frozenset()
+    import bulk_load
+    import parquet_stage
+    # Nothing is in a database, so every dimension row is new the first time it's seen, and lookup codes are made up.
+    dimensions = dimension_cache.DimensionCache()
+    encoders = lookups.LookupCache(None)
+    # The errors are counted from the quarantine file, which workers write to as well, so there always has to be one.
+    errors_path = quarantine_path
+    if errors_path is None:
+        fd, errors_path = tempfile.mkstemp(prefix="ebird_dry_run_", suffix=".jsonl")
+        os.close(fd)
+    errors_start = os.path.getsize(errors_path) if os.path.exists(errors_path) else 0
+    metrics.configure(metrics_log, metrics_textfile, start_row, profiler)
+    quarantine.configure(errors_path)
+    if batch_sizer is None:
+        batch_sizer = batching.BatchSizer()
+    from_dataset = parquet_stage.is_dataset(file_path)
+    batches = batching.regroup(parsed_batches(file_path, start_row, species_sci_names, subspecies_sci_names, workers,
+                                              0, batch_sizer.min_size, errors_path, filters), batch_sizer)
+    count = start_row
+    offset = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            with metrics.stage("parse"):
+                item = next(batches, None)
+            if item is None:
+                break
+            batch, end_offset = item
+            if not from_dataset:
+                metrics.count("bytes_read", end_offset - offset)
+            offset = end_offset
+            # Everything bulk_load.BulkLoader does before it sends the rows to the database.
+            with metrics.stage("staging_rows"):
+                staged = bulk_load.staging_rows(batch, dimensions, encoders)
+            with metrics.stage("copy_format"):
+                for rows in staged.values():
+                    bulk_load.rows_to_copy_buffer(rows)
+            dimensions.commit()
+            count += len(batch)
+            metrics.gauge("batch_size", batch_sizer.size)
+            metrics.count("rows", len(batch))
+            metrics.count("batches")
+            metrics.report()
+    except KeyboardInterrupt:
+        print(f"Breaking due to crtl-c.")
+    seconds = time.perf_counter() - started
+    errors = Counter()
+    with open(errors_path, 'rb') as f:
+        f.seek(errors_start)
+        for line in f:
+            errors[json.loads(line)["error"]] += 1
+    if quarantine_path is None:
+        os.remove(errors_path)
+    rows = count - start_row
+    print(f"Final count: {count}, End time: {curr_time()}")
+    print(f"Dry run: {rows} rows parsed in {seconds:.2f}s, {rows / max(seconds, 1e-9):.0f} rows/s, "
+          f"{sum(errors.values())} lines couldn't be parsed.")
+    print(f"Time by stage: {metrics.current.summary()}")
+    print(f"Lookup values: {encoders.stats()}.")
+    for error, n in errors.most_common(DRY_RUN_ERRORS):
+        print(f"{n:>10}  {error}")
+    if len(errors) > DRY_RUN_ERRORS:
+        print(f"{len(errors) - DRY_RUN_ERRORS} other errors{f', see {quarantine_path}' if quarantine_path else ''}.")
+    return rows, sum(errors.values())
+
+
+def read_batches(file_path, start_row, species_sci_names, subspecies_sci_names, start_offset=0,
+                 batch_size=COMMIT_BATCH, filters=None):
+    """
+    Reads and parses the eBird dataset in this process.
+    Args:
+        file_path (str): path of the eBird tsv file, or a compressed file or archive containing it.
+        start_row (int): skip this many rows before parsing.
+        species_sci_names (set): all species' scientific names.
+        subspecies_sci_names (set): all subspecies' scientific names.
+        start_offset (int, optional): byte offset to start parsing at, from a checkpoint.
+        batch_size (int, optional): number of rows per batch.
+        filters (dict, optional): only parse the lines that pass these filters, see row_filter.
+    Returns:
+        A generator of (batch, end offset) tuples, with batches of up to batch_size parsed rows.
+    """
+    with input_stream.open_ebird_file(file_path) as f:
+        header, offset = input_stream.read_header(f, start_row, start_offset)
+        decoder = RowDecoder(header, species_sci_names, subspecies_sci_names)
+        keep = row_filter.line_filter(header, filters)
+        # Batch our database inserts/updates to keep from having a commit() every single call.
+        # This could potentially lead to problems if we need to look up something that hasn't been committed yet, but it seems that the caching takes care of this. This could be a problem, in general.
+        batch = []
+        for line in f:
+            if keep is not None and not keep.keep(line):
+                offset += len(line)
+                continue
+            try:
+                batch.append(decoder.decode(line.decode('utf-8')))
+            except Exception as ex:
+                if quarantine.current is None:
+                    print(f"Byte offset: {offset}.")
+                    print(line)
+                    raise
+                quarantine.current.add_line(offset, line, ex)
+                metrics.count("quarantined")
+            offset += len(line)
+            if len(batch) == batch_size:
+                yield batch, offset
+                batch = []
+        # Whatever is left over didn't fill up a whole batch.
+        if batch:
+            yield batch, offset
+
+
+def row_batch(batch, count, dimensions, lookups, done=None, update_rollups=False):
+    """
+    Run a batch of rows through the ORM.
+    Args:
+        batch (list(ParsedRow)): Rows from RowDecoder.decode() to insert into the db.
         count (int): Current count of rows.
-        sp_names (set): species names.
-        ssp_names (set): subspecies names.
-        ccc (dict): country code cache.
+        dimensions (DimensionCache): keys of the dimension rows already in the database.
+        lookups (LookupCache): codes of the dictionary encoded columns' values.
+        done (Checkpoint, optional): checkpoint to commit along with the batch.
+        update_rollups (bool, optional): keep the rollups up to date with the batch, see aggregates.
     """
-    for row in batch:
-        parse_and_insert(row, sp_names, ssp_names, ccc)
-        count += 1
-    DBSession.commit()
-    print(f"{curr_time()} Commit:  {count}")
-    cache_sizes = f"country: {len(ccc)}"
-    print(cache_sizes)
-    lru_cache_stats = f"state: {state_lru_cache_stub.cache_info()}, county: {county_lru_cache_stub.cache_info()}, locality: {locality_lru_cache_stub.cache_info()}, obs: {observer_lru_cache_stub.cache_info()}"
-    print(lru_cache_stats)
+    import query_service
+    if update_rollups:
+        import aggregates
+        with metrics.stage("rollups"):
+            aggregates.before_orm(DBSession, {row.checklist.checklist_id for row in batch})
+    last_checklist = None
+    with metrics.stage("orm_insert"):
+        for row in batch:
+            # Rows from the same sampling event share their checklist, so it only needs inserting once per group.
+            if row.checklist is not last_checklist:
+                insert_checklist(row.checklist, dimensions, lookups)
+                last_checklist = row.checklist
+            insert_observation(row, lookups)
+    if update_rollups:
+        with metrics.stage("rollups"):
+            DBSession.flush()
+            aggregates.after_orm(DBSession)
+    with metrics.stage("commit"):
+        if done is not None:
+            checkpoint.save_orm(DBSession, done)
+        query_service.bump_orm(DBSession, query_service.batch_scopes(batch))
+        DBSession.commit()
+    dimensions.commit()
 
 
-def parse_and_insert(row, species_sci_names, subspecies_sci_names, country_code_cache):
+def check_header(header):
     """
-    Handle the parsing a row of data and inserting it into the database as needed.
+    Makes sure every column we need is in the data, once, before any rows are parsed.
     Args:
-        row (dict): CSV row to be parsed.
+        header (list(str)): column names from the first line of the file.
+    Raises:
+        ValueError: if any of the REQUIRED_COLUMNS are missing.
+    """
+    missing = [c for c in REQUIRED_COLUMNS if c not in header]
+    if missing:
+        raise ValueError(f"Input data is missing the column(s) {missing}. "
+                         f"This importer only supports version {EBIRD_METADATA_VERSION}, please ensure your data is of this version as eBird makes changes to the dataset frequently.")
+    unexpected = [c for c in header if c not in EBIRD_COLUMNS]
+    if unexpected:
+        print(f"Ignoring column(s) {unexpected} which aren't in version {EBIRD_METADATA_VERSION} of the data.")
+
+
+class RowDecoder:
+    """
+    Decodes lines of the eBird tsv into ParsedRows.
+    The positions of the columns we need are worked out once from the header, so each line is just split on tabs
+    and picked apart by position instead of being turned into a dictionary first.
+    The checklist columns are only converted when the sampling event changes, as every observation on a checklist
+    repeats them.
+    """
+    __slots__ = ("header", "width", "observation_getter", "checklist_getter", "event_position",
+                 "species_sci_names", "subspecies_sci_names", "last_event", "last_checklist")
+
+    def __init__(self, header, species_sci_names, subspecies_sci_names):
+        check_header(header)
+        self.header = header
+        self.width = len(header)
+        self.observation_getter = itemgetter(*[header.index(c) for c in OBSERVATION_COLUMNS])
+        self.checklist_getter = itemgetter(*[header.index(c) for c in CHECKLIST_COLUMNS])
+        self.event_position = header.index("SAMPLING EVENT IDENTIFIER")
+        self.species_sci_names = species_sci_names
+        self.subspecies_sci_names = subspecies_sci_names
+        self.last_event = None
+        self.last_checklist = None
+
+    def decode(self, line):
+        """
+        Args:
+            line (str): a single line of the tsv, with or without the line ending.
+        Returns:
+            A ParsedRow.
+        """
+        # QUOTE_NONE could be dangerous if there are tabs inside a field. For now, this assumes there isn't.
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) != self.width:
+            raise ValueError(f"Expected {self.width} columns but found {len(fields)}.")
+        event = fields[self.event_position]
+        if event != self.last_event:
+            self.last_checklist = convert_checklist(self.checklist_getter(fields))
+            self.last_event = event
+        return convert_observation(self.observation_getter(fields), self.last_checklist,
+                                   self.species_sci_names, self.subspecies_sci_names)
+
+
+def convert_observation(values, checklist, species_sci_names, subspecies_sci_names):
+    """
+    Converts the raw strings of the observation specific part of a row into their database types.
+    Args:
+        values (sequence(str)): the raw values of the OBSERVATION_COLUMNS, in that order.
+        checklist (ParsedChecklist): the checklist the observation is on.
         species_sci_names (set): all species' scientific names.
         subspecies_sci_names (set): all subspecies' scientific names.
-        country_code_cache (dict): {"Canada": "CA"} mappins so we don't need to do a db lookup each time.
+    Returns:
+        A ParsedRow.
     """
-    # Observation
+    (global_id, edit, species_category, scientific_name, subspecies_scientific_name, obs_count, age_sex,
+     has_media, species_comments) = values
     # ID in the data has the form of URN:CornellLabOfOrnithology:EBIRD:OBS######, and we want just the #s at the end for the id.
-    observation_id = int(row['GLOBAL UNIQUE IDENTIFIER'].split(':')[-1][3:])
-    # ID in the data has form 'S########' and we want just the #s at the end.
-    checklist_id = int(row['SAMPLING EVENT IDENTIFIER'][1:])
-    obs_count = row['OBSERVATION COUNT']
+    observation_id = int(global_id.split(':')[-1][3:])
     if obs_count == 'X':
         number_observed = None
         is_x = True
     else:
-        number_observed = obs_count
+        number_observed = int(obs_count)
         is_x = False
-    age_sex = row['AGE/SEX']
-    species_comments = row['SPECIES COMMENTS']
-    # breeding_atlas_code = row['BREEDING BIRD ATLAS CODE']
     # Species
-    # taxonomic_order = decimal_or_none(row['TAXONOMIC ORDER'])
-    species_category = row['CATEGORY']
-    # common_name = row['COMMON NAME']
-    scientific_name = row['SCIENTIFIC NAME']
-    # subspecies_common_name = row['SUBSPECIES COMMON NAME']
-    subspecies_scientific_name = row['SUBSPECIES SCIENTIFIC NAME']
     if subspecies_scientific_name == '':
         subspecies_scientific_name = None
     # Conceptually, anything that isn't a 'species' is stored in the the SubSpecies model.
@@ -250,140 +724,142 @@ def parse_and_insert(row, species_sci_names, subspecies_sci_names, country_code_
         if scientific_name in subspecies_sci_names:
             # subspecies_scientific_name = scientific_name
             scientific_name = None
-    # Checklist
-    checklist_date = row['OBSERVATION DATE']
-    checklist_time = row['TIME OBSERVATIONS STARTED']
-    checklist_duration = row['DURATION MINUTES']
+    has_media = bool(int(has_media))
+    if edit != '':
+        # This is "%Y-%m-%d %H:%M:%S", but fromisoformat() is many times faster than strptime().
+        last_edit = datetime.fromisoformat(edit)
+    else:
+        last_edit = None
+    return ParsedRow(
+        observation_id, number_observed, is_x, age_sex, species_comments,
+        scientific_name, subspecies_scientific_name,
+        has_media, last_edit, checklist)
+
+
+def convert_checklist(values):
+    """
+    Converts the raw strings of the checklist, location and observer part of a row into their database types.
+    Args:
+        values (sequence(str)): the raw values of the CHECKLIST_COLUMNS, in that order.
+    Returns:
+        A ParsedChecklist.
+    """
+    (sampling_event_id, country, country_code, state_province, state_code, county, county_code,
+     locality_name, locality_id, locality_type, lat, lon,
+     checklist_date, checklist_time, observer_id, protocol, project_code,
+     checklist_duration, distance, area, number_of_observers, complete_checklist, group_id,
+     approved, reviewed, reason, checklist_comments) = values
+    # ID in the data has form 'S########' and we want just the #s at the end.
+    checklist_id = int(sampling_event_id[1:])
     start, duration = parse_start_duration(checklist_date, checklist_time, checklist_duration)
-    checklist_comments = row['TRIP COMMENTS']
-    distance = decimal_or_none(row['EFFORT DISTANCE KM'])
-    area = decimal_or_none(row['EFFORT AREA HA'])
-    number_of_observers = int_or_none(row['NUMBER OBSERVERS'])
-    complete_checklist = bool(int(row['ALL SPECIES REPORTED']))
+    distance = decimal_or_none(distance)
+    area = decimal_or_none(area)
+    number_of_observers = int_or_none(number_of_observers)
+    complete_checklist = bool(int(complete_checklist))
     # group id in the form of 'G######' but we want just #s.
-    group_id = int_or_none(row['GROUP IDENTIFIER'][1:])
-    approved = bool(int(row['APPROVED']))
-    reviewed = bool(int(row['REVIEWED']))
-    reason = row['REASON']
-    protocol = row['PROTOCOL TYPE']
+    group_id = int_or_none(group_id[1:])
+    approved = bool(int(approved))
+    reviewed = bool(int(reviewed))
     proto = protocol_words_to_code(protocol)
-    project_code = row['PROJECT CODE']
     # Observer
     # The is is in the form of 'obsr######' but we want just the #s.
-    observer_id = int(row['OBSERVER ID'][4:])
+    observer_id = int(observer_id[4:])
     # Location
-    lat = float(row['LATITUDE'])
-    lon = float(row['LONGITUDE'])
-    coords = coords_to_EWKT(lat=lat, lon=lon, srid=4326)
-    locality_name = row['LOCALITY']
+    lat = float(lat)
+    lon = float(lon)
     # In data in the form of 'L#######' but we want just #s.
-    locality_id = int(row['LOCALITY ID'][1:])
-    locality_type = row['LOCALITY TYPE']
-    state_code = row['STATE CODE']
-    county_code = row['COUNTY CODE']
-    county = row['COUNTY']
-    state_province = row['STATE']
-    country = row['COUNTRY']
-    country_code = row['COUNTRY CODE']
-    has_media = bool(int(row['HAS MEDIA']))
-    edit = row['LAST EDITED DATE']
-    if edit != '':
-        last_edit = datetime.strptime(edit, "%Y-%m-%d %H:%M:%S")
-    else:
-        last_edit = None
-    # Start with the models that don't depend on other models and have single attributes.
-    # All of these fields can potentially be blank.
-    sp, _ = state_lru_cache_stub(state_province, state_code)
-
-    cnty, _ = county_lru_cache_stub(county, county_code)
+    locality_id = int(locality_id[1:])
+    return ParsedChecklist(
+        checklist_id,
+        start, duration, checklist_comments, distance, area, number_of_observers, complete_checklist,
+        group_id, approved, reviewed, reason, proto, project_code,
+        observer_id,
+        lat, lon, locality_name, locality_id, locality_type,
+        state_code, state_province, county_code, county, country_code, country)
 
-    local, _ = locality_lru_cache_stub(locality_id, locality_type, locality_name)
 
-    fn = get_or_create
-    kwargs = {'session': DBSession, 'model': Country, 'defaults': {'country': country}, 'country_code': country_code}
-    cntry = create_or_cache(country_code_cache, fn, kwargs, country_code)
-
-    if observer_id == '':
-        obs = None
-    else:
-        obs, _ = observer_lru_cache_stub(observer_id)
+def insert_checklist(c, dimensions, lookups):
+    """
+    Insert a checklist and the location, observer and regions it refers to into the database as needed.
+    Args:
+        c (ParsedChecklist): checklist part of a parsed row.
+        dimensions (DimensionCache): keys of the dimension rows already in the database.
+        lookups (LookupCache): codes of the dictionary encoded columns' values.
+    """
+    import spatial
+    coords = spatial.point_ewkb(c.lat, c.lon)
+    # Start with the models that don't depend on other models and have single attributes.
+    # All of these fields can potentially be blank.
+    # The dimension cache knows everything that's in the database, so these can be added without checking first.
+    if dimensions.is_new('state', c.state_code):
+        DBSession.add(StateProvince(state_code=c.state_code, state_province=c.state_province))
+    if dimensions.is_new('county', c.county_code):
+        DBSession.add(County(county_code=c.county_code, county=c.county))
+    if dimensions.is_new('locality', c.locality_id):
+        DBSession.add(Locality(locality_id=c.locality_id, locality_type_id=lookups.encode('locality_type', c.locality_type),
+                               locality_name=c.locality_name))
+    if dimensions.is_new('country', c.country_code):
+        DBSession.add(Country(country_code=c.country_code, country=c.country))
+    if dimensions.is_new('observer', c.observer_id):
+        DBSession.add(Observer(observer_id=c.observer_id))
     # Then continue with the models that only depend on the ones we've got.
     # Coordinates aren't unique.
     try:
         loc, _ = get_or_create(DBSession, Location,
-            defaults={'country_id': country_code, 'state_province_id': state_code, 'county_id': county_code, "coords": coords},
-            locality_id=locality_id)
+            defaults={'country_id': c.country_code, 'state_province_id': c.state_code, 'county_id': c.county_code, "coords": coords,
+                      "grid_cell": spatial.grid_cell(c.lat, c.lon)},
+            locality_id=c.locality_id)
     except MultipleResultsFound as ex:
             print(f"Multiple results.")
-            print(f"country: {country_code}, state: {state_code}, county: {county_code}, coords: {coords}, locality: {locality_id}")
-            test = DBSession.query(Location).filter_by(locality_id=locality_id)
-            test_res = DBSession.query(Location).filter_by(locality_id=locality_id).all()
+            print(f"country: {c.country_code}, state: {c.state_code}, county: {c.county_code}, coords: {coords}, locality: {c.locality_id}")
+            test = DBSession.query(Location).filter_by(locality_id=c.locality_id)
+            test_res = DBSession.query(Location).filter_by(locality_id=c.locality_id).all()
             print(f"Test: {test}.\nResults: {test_res}")
             raise ex            
     # Next the checklist model
-    check, _ = get_or_create(
+    get_or_create(
         DBSession,
         Checklist,
         defaults={
-            'location_id': loc.id, 'start_date_time': start, 'checklist_comments': checklist_comments,
-            'duration': duration, 'distance': distance, 'area': area,
-            'number_of_observers': number_of_observers, 'complete_checklist': complete_checklist,
-            'group_id': group_id, 'approved': approved, 'reviewed': reviewed, 'reason': reason,
-            'protocol': proto,
-            'project_code': project_code},
-        checklist=checklist_id
+            'location_id': loc.id, 'start_date_time': c.start, 'checklist_comments': c.checklist_comments,
+            'duration': c.duration, 'distance': c.distance, 'area': c.area,
+            'number_of_observers': c.number_of_observers, 'complete_checklist': c.complete_checklist,
+            'group_id': c.group_id, 'approved': c.approved, 'reviewed': c.reviewed,
+            'reason_id': lookups.encode('reason', c.reason),
+            'protocol': c.protocol,
+            'project_id': lookups.encode('project_code', c.project_code)},
+        checklist=c.checklist_id
         )
+
+
+def insert_observation(p, lookups):
+    """
+    Insert an observation into the database, if it isn't already there. Its checklist has to have been inserted first.
+    Args:
+        p (ParsedRow): row parsed by RowDecoder.decode().
+        lookups (LookupCache): codes of the dictionary encoded columns' values.
+    Returns:
+        True if it was inserted, False if it was already there.
+    """
     # Finally the remaining models that depend on all the previous ones.
-    # We don't care about the result here because get_or_create is being used to be idempotent.
-    _, _ = get_or_create(
+    _, created = get_or_create(
         DBSession,
         Observation,
         defaults={
-            'number_observed': number_observed,
-            'is_x': is_x,
-            'age_sex': age_sex,
-            'species_comments': species_comments,
-            'species_id': scientific_name,
-            'subspecies_id': subspecies_scientific_name, #'breeding_atlas_code': breeding_atlas_code,
-            'date_last_edit': last_edit,
-            'has_media': has_media,
-            'checklist_id': check.checklist,
-            'observer_id': obs.observer_id},
-        observation=observation_id,
+            'number_observed': p.number_observed,
+            'is_x': p.is_x,
+            'age_sex_id': lookups.encode('age_sex', p.age_sex),
+            'species_comments': p.species_comments,
+            'species_id': p.scientific_name,
+            'subspecies_id': p.subspecies_scientific_name, #'breeding_atlas_code': breeding_atlas_code,
+            'date_last_edit': p.last_edit,
+            'has_media': p.has_media,
+            'observation_date': p.checklist.start,
+            'checklist_id': p.checklist.checklist_id,
+            'observer_id': p.checklist.observer_id},
+        observation=p.observation_id,
         )
-
-
-
-@lru_cache(maxsize=65536)
-def state_lru_cache_stub(state, code):
-    """
-    This is just a wrapper around the get_or_create for State to be able to use lru_cache to cache the result. 
-    """
-    return get_or_create(DBSession, StateProvince, defaults={"state_province": state}, state_code=code)
-
-
-@lru_cache(maxsize=65536)
-def county_lru_cache_stub(county, code):
-    """
-    This is just a wrapper around the get_or_create for County to be able to use lru_cache to cache the result. 
-    """
-    return get_or_create(DBSession, County, defaults={"county": county}, county_code=code)
-
-
-@lru_cache(maxsize=262144)
-def locality_lru_cache_stub(l_id, l_type, name):
-    """
-    This is just a wrapper around the get_or_create for Locality to be able to use lru_cache to cache the result. 
-    """
-    return get_or_create(DBSession, Locality, defaults={'locality_type': l_type, 'locality_name': name}, locality_id=l_id)
-
-
-@lru_cache(maxsize=262144)
-def observer_lru_cache_stub(observer_id):
-    """
-    This is just a wrapper around the get_or_create for Observer to be able to use lru_cache to cache the result. 
-    """
-    return get_or_create(DBSession, Observer, defaults={}, observer_id=observer_id)
+    return created
 
 
 def curr_time():
@@ -395,36 +871,6 @@ def curr_time():
     return now.strftime(now_format)
 
 
-def create_or_cache_or_none(cache, fn, kwargs, val):
-    """
-    Takes a cache, a get_or_create call and the value we want to create or get the id for.
-    Returns the object's primary key either from the cache or from a newly created object.
-    Will return None if val is ''.
-    """
-    if val == '':
-        return None
-    else:
-        return create_or_cache(cache, fn, kwargs, val)
-
-
-def create_or_cache(cache, fn, kwargs, val):
-    """
-    Takes a cache, a get_or_create call and the value we want to create or get the id for.
-    Returns the object's primary key either from the cache or from a newly created object.
-    """
-    try:
-        obj_id = cache[val]
-    except KeyError:
-        t, _ = fn(**kwargs)
-        if len(kwargs) == 1:
-            pk_attr = str(list(kwargs.keys())[0])
-        else:
-            pk_attr = [x for x in kwargs.keys() if x not in ("defaults", "model", "session")][0]
-        obj_id = getattr(t, pk_attr)
-        cache[val] = obj_id
-    return obj_id
-
-
 def parse_start_duration(checklist_date, checklist_time, checklist_duration):
     """
     Parses a checklist's start date and time and duration in minutes.
@@ -481,6 +927,55 @@ def int_or_none(i):
         return int(i)
 
 
+# eBird protocol names to the (arbitrary) 2 letter codes stored in Checklist.protocol.
+PROTOCOL_CODES = {
+    'Incidental': '20',
+    'Stationary': '21',
+    'Traveling': '22',
+    'Area': '23',
+    'Transect': '25',  # Not in metadata document.
+    'Trail Tracker': '30',
+    'Banding': '33',
+    'Waterbird Count': '34',
+    'RMBO Early Winter Waterbird Count': '34',  # This is apparently an alias.
+    'My Yard Counts': '35',
+    'LoonWatch': '39',
+    'Standardized Yard Count': '40',
+    'Rusty Blackbird Spring Migration Blitz': '41',
+    'Yellow-billed Magpie Survey - General Observations': '44',
+    'Yellow-billed Magpie Survey - Traveling Count': '45',
+    'CWC Point Count': '46',
+    'CWC Area Search': '47',
+    'Random': '48',
+    'Coastal Shorebird Survey': '49',
+    'Caribbean Martin Survey': '50',
+    'Greater Gulf Refuge Waterbird Count': '51',
+    'Oiled Birds': '52',
+    'Nocturnal Flight Call Count': '54',
+    'Heron Stationary Count': '55',
+    'Heron Area Count': '56',
+    'Great Texas Birding Classic': '57',
+    'Audubon Coastal Bird Survey': '58',
+    'TNC California Waterbird Count': '59',
+    'eBird Pelagic Protocol': '60',
+    'IBA Canada (protocol)': '61',
+    'Historical': '62',
+    'Traveling - Property Specific': '64',
+    'Breeding Bird Atlas': '65',
+    "Birds 'n' Bogs Survey": '66',
+    'CAC--Common Bird Survey': '67',
+    'RAM--Iberian Seawatch Network': '68',
+    'California Brown Pelican Survey': '69',
+    'BirdLife Australia 20min-2ha survey': '70',
+    'BirdLife Australia 500m radius search': '71',
+    'BirdLife Australia 5 km radius search': '72',
+    'PROALAS': '73',
+    'International Shorebird Survey (ISS)': '74',
+    'Tricolored Blackbird Winter Survey': '75',
+    'CWC Traveling Count': '80',  # Not in metadata document.
+}
+
+
 def protocol_words_to_code(protocol):
     """
     Converts a protocol in words to the (arbitrary) 2 letter codes in the Django choices field.
@@ -489,82 +984,51 @@ def protocol_words_to_code(protocol):
     Returns:
         A two character string that is used as the key for the choices field, for example 'HI'.
     """
-    conversion = {
-        'Incidental': '20',
-        'Stationary': '21',
-        'Traveling': '22',
-        'Area': '23',
-        'Transect': '25',  # Not in metadata document.
-        'Trail Tracker': '30',
-        'Banding': '33',
-        'Waterbird Count': '34',
-        'RMBO Early Winter Waterbird Count': '34',  # This is apparently an alias.
-        'My Yard Counts': '35',
-        'LoonWatch': '39',
-        'Standardized Yard Count': '40',
-        'Rusty Blackbird Spring Migration Blitz': '41',
-        'Yellow-billed Magpie Survey - General Observations': '44',
-        'Yellow-billed Magpie Survey - Traveling Count': '45',
-        'CWC Point Count': '46',
-        'CWC Area Search': '47',
-        'Random': '48',
-        'Coastal Shorebird Survey': '49',
-        'Caribbean Martin Survey': '50',
-        'Greater Gulf Refuge Waterbird Count': '51',
-        'Oiled Birds': '52',
-        'Nocturnal Flight Call Count': '54',
-        'Heron Stationary Count': '55',
-        'Heron Area Count': '56',
-        'Great Texas Birding Classic': '57',
-        'Audubon Coastal Bird Survey': '58',
-        'TNC California Waterbird Count': '59',
-        'eBird Pelagic Protocol': '60',
-        'IBA Canada (protocol)': '61',
-        'Historical': '62',
-        'Traveling - Property Specific': '64',
-        'Breeding Bird Atlas': '65',
-        "Birds 'n' Bogs Survey": '66',
-        'CAC--Common Bird Survey': '67',
-        'RAM--Iberian Seawatch Network': '68',
-        'California Brown Pelican Survey': '69',
-        'BirdLife Australia 20min-2ha survey': '70',
-        'BirdLife Australia 500m radius search': '71',
-        'BirdLife Australia 5 km radius search': '72',
-        'PROALAS': '73',
-        'International Shorebird Survey (ISS)': '74',
-        'Tricolored Blackbird Winter Survey': '75',
-        'CWC Traveling Count': '80',  # Not in metadata document.
-        }
-    return conversion[protocol]
-
-
-def coords_to_EWKT(lat, lon, srid=4326):
-    """
-    Converts lat/lon coordinates to eWKT representation for geoalchemy.
-    Note that WKT is lon/lat in that order, which both PostGIS and GeoAlchemy expect.
-    """
-    return f"SRID=4326; Point({lon} {lat})"
+    return PROTOCOL_CODES[protocol]
 
 
 def parse_command_line():
+    # Imported here, as ebird.py imports this module to run a load, and only needs it for the arguments when run on its own.
+    import ebird
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--file', dest="input_file", help="Path to ebird datafile.", metavar="INFILE",
-                        required=True)
-    parser.add_argument('-r', '--row', dest="start_row", help="Start parsing at this row.", metavar="STARTROW",
-                        required=False, default=0)
-    parser.add_argument('-c', '--csv', dest="csv_path", help="Path to the ebird taxonomy csv.", metavar="CSVPATH",
-                        required=False, default=None)
-    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
-                        required=True)
+    ebird.add_load_arguments(parser)
+    parser.add_argument('--resume', dest="resume", help="Resume from the last checkpoint committed for this file. A .gz, .zst or .tar file is decompressed from the start up to it again.",
+                        action="store_true")
     args = parser.parse_args()
+    ebird.check_load_arguments(parser, args)
     return args
 
 
+def main(options):
+    """
+    Runs a load, or a dry run, from the options of parse_command_line() or of ebird.py's load and resume.
+    """
+    profiler = None
+    if options.profile_dir is not None:
+        import profiling
+        profiler = profiling.StageProfiler(options.profile_dir, options.profiler, options.profile_every)
+    min_batch, max_batch = options.batch_bounds
+    batch_sizer = batching.BatchSizer(min_batch, max_batch, options.batch_seconds,
+                                      options.max_rss * 2 ** 20 if options.max_rss is not None else None,
+                                      start_size=COMMIT_BATCH)
+    try:
+        if options.dry_run:
+            dry_run(options.input_file, options.start_row, options.csv_path, options.workers, options.metrics_log,
+                    options.metrics_textfile, options.quarantine_path, batch_sizer, row_filter.options_filters(options), profiler)
+            return
+        # Resuming or adding to existing data needs the tables left as they are, whatever else was asked for.
+        init_sqlalchemy(options.connection_url, reset=options.reset and not (options.resume or options.incremental),
+                        bare=options.fresh, partitioned=options.partitioned)
+        parse_ebird_dump(options.input_file, options.start_row, options.csv_path, options.bulk, options.workers,
+                         options.resume, options.incremental, options.deleted_path, options.metrics_log,
+                         options.metrics_textfile, options.async_writers, options.quarantine_path, batch_sizer,
+                         row_filter.options_filters(options), options.rollups, profiler)
+    finally:
+        if profiler is not None:
+            profiler.write()
+    if options.fresh:
+        database_setup.build_deferred(engine, options.index_jobs)
+
+
 if __name__ == "__main__":
-    options = parse_command_line()
-    input_file = options.input_file
-    start_row = int(options.start_row)
-    csv_path = options.csv_path
-    connection_url = options.connection_url
-    init_sqlalchemy(connection_url)
-    parse_ebird_dump(input_file, start_row, csv_path)
+    main(parse_command_line())
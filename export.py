@@ -0,0 +1,286 @@
+"""
+Exports observations from the database as an EBD style tsv, or as Parquet, without loading them into Python objects.
+
+The observations are joined up with their checklists, locations, regions and taxa in one query, which puts every
+column back the way it was in the eBird data, and the database writes the result out itself with COPY ... TO STDOUT,
+so memory use doesn't depend on how much is exported. The range of observation ids is split between several
+connections, each of which COPYs its share to its own part file at the same time as the others. All of them read from
+the same snapshot, so the export is consistent even if something is loading at the time. The parts are then joined
+into a single tsv, or each converted to a Parquet file of the same name, with pyarrow reading them a block at a time.
+
+The filters are the same as the loader's, see row_filter, and are applied in the query. Rows come out in no
+particular order, and anything the database doesn't keep, such as the atlas and IBA codes, is left blank. Checklists
+loaded without a start time come back with one of 00:00:00.
+"""
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from sqlalchemy import create_engine
+import metrics
+import parquet_stage
+import row_filter
+from ebird_data_parse import EBIRD_COLUMNS, PROTOCOL_CODES
+
+# Bytes copied at a time when joining the parts together.
+COPY_BUFFER_BYTES = 1 << 20
+
+# Bytes of a part read at a time when converting it to Parquet, which is also about the size of each row group.
+PARQUET_BLOCK_BYTES = 16 << 20
+
+# SubSpecies.category back to the words in the data, see ebird_data_parse.parsed_taxa_csv_to_db().
+CATEGORY_NAMES = ('issf', 'form', 'domestic', 'slash', 'intergrade', 'spuh', 'hybrid')
+
+# Stored protocol codes back to their names; the first name wins for codes with aliases.
+PROTOCOL_NAMES = {}
+for _name, _code in PROTOCOL_CODES.items():
+    PROTOCOL_NAMES.setdefault(_code, _name)
+
+
+def trimmed(expression):
+    """
+    A numeric as text without trailing zeros, the way it appears in the data. Zero, and anything without a decimal
+    point, would lose digits that matter to the rtrim(), so they're left as they are.
+    """
+    return (f"CASE WHEN ({expression}) = 0 THEN '0' WHEN strpos(({expression})::text, '.') > 0 "
+            f"THEN rtrim(rtrim(({expression})::text, '0'), '.') ELSE ({expression})::text END")
+
+
+def flag(expression):
+    return f"CASE WHEN {expression} THEN '1' ELSE '0' END"
+
+
+# The SQL for each of EBIRD_COLUMNS, in order.
+# Spuhs, slashes and hybrids are stored as subspecies with no species, and are top level taxa in the data.
+COLUMN_SQL = {
+    "GLOBAL UNIQUE IDENTIFIER": "'URN:CornellLabOfOrnithology:EBIRD:OBS' || o.observation",
+    "LAST EDITED DATE": "to_char(o.date_last_edit, 'YYYY-MM-DD HH24:MI:SS')",
+    "TAXONOMIC ORDER": f"COALESCE({trimmed('ss.taxonomic_order')}, sp.taxonomic_order::text)",
+    "CATEGORY": "CASE WHEN ss.scientific_name IS NULL THEN 'species' ELSE (ARRAY["
+                + ", ".join(f"'{c}'" for c in CATEGORY_NAMES) + "])[ss.category + 1] END",
+    "COMMON NAME": "COALESCE(sp.common_name, ss.common_name)",
+    "SCIENTIFIC NAME": "COALESCE(sp.scientific_name, ss.scientific_name)",
+    "SUBSPECIES COMMON NAME": "CASE WHEN sp.scientific_name IS NOT NULL THEN ss.common_name END",
+    "SUBSPECIES SCIENTIFIC NAME": "CASE WHEN sp.scientific_name IS NOT NULL THEN ss.scientific_name END",
+    "OBSERVATION COUNT": "CASE WHEN o.is_x THEN 'X' ELSE o.number_observed::text END",
+    "AGE/SEX": "o.age_sex",
+    "COUNTRY": "co.country",
+    "COUNTRY CODE": "l.country_id",
+    "STATE": "st.state_province",
+    "STATE CODE": "l.state_province_id",
+    "COUNTY": "cy.county",
+    "COUNTY CODE": "l.county_id",
+    "LOCALITY": "lo.locality_name",
+    "LOCALITY ID": "'L' || l.locality_id",
+    "LOCALITY TYPE": "lo.locality_type",
+    "LATITUDE": "ST_Y(l.coords)",
+    "LONGITUDE": "ST_X(l.coords)",
+    "OBSERVATION DATE": "to_char(c.start_date_time, 'YYYY-MM-DD')",
+    "TIME OBSERVATIONS STARTED": "to_char(c.start_date_time, 'HH24:MI:SS')",
+    "OBSERVER ID": "'obsr' || o.observer_id",
+    "SAMPLING EVENT IDENTIFIER": "'S' || c.checklist",
+    "PROTOCOL TYPE": "p.name",
+    "PROTOCOL CODE": "'P' || c.protocol",
+    "PROJECT CODE": "c.project_code",
+    "DURATION MINUTES": "(extract(epoch FROM c.duration) / 60)::integer",
+    "EFFORT DISTANCE KM": trimmed("c.distance"),
+    "EFFORT AREA HA": trimmed("c.area"),
+    "NUMBER OBSERVERS": "c.number_of_observers",
+    "ALL SPECIES REPORTED": flag("c.complete_checklist"),
+    "GROUP IDENTIFIER": "'G' || c.group_id",
+    "HAS MEDIA": flag("o.has_media"),
+    "APPROVED": flag("c.approved"),
+    "REVIEWED": flag("c.reviewed"),
+    "REASON": "c.reason",
+    "TRIP COMMENTS": "c.checklist_comments",
+    "SPECIES COMMENTS": "o.species_comments",
+}
+
+# The views have the dictionary encoded columns decoded, see lookups.
+FROM_SQL = """FROM observation_view o
+    JOIN checklist_view c ON c.checklist = o.checklist_id
+    JOIN location l ON l.id = c.location_id
+    JOIN locality_view lo ON lo.locality_id = l.locality_id
+    JOIN country co ON co.country_code = l.country_id
+    JOIN stateprovince st ON st.state_code = l.state_province_id
+    JOIN county cy ON cy.county_code = l.county_id
+    LEFT JOIN species sp ON sp.scientific_name = o.species_id
+    LEFT JOIN subspecies ss ON ss.scientific_name = o.subspecies_id
+    LEFT JOIN (VALUES {protocols}) AS p(code, name) ON p.code = c.protocol"""
+
+
+def select_sql(cursor, filters=None):
+    """
+    The export query, less the observation id range, with the filters' values filled in.
+    Args:
+        cursor (cursor): DBAPI cursor, used to quote the values.
+        filters (dict, optional): row_filter.RowFilter's keyword arguments.
+    """
+    # Blank rather than NULL, see copy_range().
+    columns = ",\n    ".join(f"COALESCE(({COLUMN_SQL.get(name, 'NULL')})::text, '')" for name in EBIRD_COLUMNS)
+    protocols = ", ".join(cursor.mogrify("(%s, %s)", item).decode('utf-8') for item in PROTOCOL_NAMES.items())
+    # The query is filled in again by copy_range(), so any % in the names has to survive that.
+    protocols = protocols.replace('%', '%%')
+    conditions = ["o.observation BETWEEN %(first)s AND %(last)s"]
+    filters = filters or {}
+    if filters.get("countries"):
+        conditions.append("l.country_id = ANY(%(countries)s)")
+    if filters.get("states"):
+        conditions.append("l.state_province_id = ANY(%(states)s)")
+    if filters.get("species"):
+        conditions.append("(sp.scientific_name = ANY(%(species)s) OR sp.common_name = ANY(%(species)s) "
+                          "OR ss.scientific_name = ANY(%(species)s) OR ss.common_name = ANY(%(species)s))")
+    # Ranges on the start time rather than on its date, so an index on it can be used.
+    if filters.get("since") is not None:
+        conditions.append("c.start_date_time >= %(since)s")
+    if filters.get("until") is not None:
+        conditions.append("c.start_date_time < %(until_end)s")
+    return (f"SELECT\n    {columns}\n{FROM_SQL.format(protocols=protocols)}\n"
+            f"WHERE {' AND '.join(conditions)}")
+
+
+def query_values(filters, first, last):
+    filters = filters or {}
+    values = {"first": first, "last": last}
+    for key in ("countries", "states", "species"):
+        if filters.get(key):
+            values[key] = [v.strip() for v in filters[key]]
+    if filters.get("since") is not None:
+        values["since"] = filters["since"]
+    if filters.get("until") is not None:
+        values["until_end"] = filters["until"] + timedelta(days=1)
+    return values
+
+
+def id_ranges(first, last, parts):
+    """
+    Splits the ids from first to last into up to parts contiguous (first, last) ranges.
+    """
+    if first is None:
+        return []
+    size = max((last - first + 1 + parts - 1) // parts, 1)
+    return [(start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+
+
+class Exporter:
+    """
+    Exports observations over several connections at once, all reading the same snapshot.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        jobs (int, optional): number of connections to export with.
+        filters (dict, optional): row_filter.RowFilter's keyword arguments.
+    """
+
+    def __init__(self, engine, jobs=4, filters=None):
+        self.engine = engine
+        self.jobs = max(jobs, 1)
+        self.filters = filters
+
+    def export_parts(self, directory):
+        """
+        COPYs the observations to tsv files in directory, one per id range.
+        Returns:
+            The paths of the parts, in id order.
+        """
+        # This connection holds the snapshot open until the others have all started from it.
+        leader = self.engine.raw_connection()
+        try:
+            cursor = leader.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+            cursor.execute("SELECT min(observation), max(observation) FROM observation")
+            ranges = id_ranges(*cursor.fetchone(), self.jobs)
+            sql = select_sql(cursor, self.filters)
+            paths = [os.path.join(directory, f"part-{i:04d}.tsv") for i in range(len(ranges))]
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                rows = sum(pool.map(lambda args: self.copy_range(snapshot, sql, *args), zip(ranges, paths)))
+        finally:
+            leader.rollback()
+            leader.close()
+        print(f"{metrics.curr_time()} Exported {rows} observations.")
+        return paths
+
+    def copy_range(self, snapshot, sql, id_range, path):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+            query = cursor.mogrify(sql, query_values(self.filters, *id_range)).decode('utf-8')
+            # CSV with a quote character that can't be in the data, so nothing gets quoted or escaped: fields came
+            # from tab separated lines, so they can't contain tabs or line breaks either. CSV quotes any value that
+            # matches the NULL string, which is normally an empty one, so that's set to something that can't be in the
+            # data either, and select_sql() turns every NULL into a blank, the way the data has them.
+            with open(path, 'wb') as f:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\t', QUOTE E'\\x01', "
+                                   f"NULL E'\\x02')", f)
+            return cursor.rowcount
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def to_tsv(self, out_path):
+        """
+        Exports to a single tsv, gzipped if the name ends in .gz, with the header line from the data.
+        """
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_path))) as directory:
+            paths = self.export_parts(directory)
+            opener = gzip.open if out_path.endswith('.gz') else open
+            with opener(out_path, 'wb') as out:
+                out.write(('\t'.join(EBIRD_COLUMNS) + '\n').encode('utf-8'))
+                for path in paths:
+                    with open(path, 'rb') as part:
+                        shutil.copyfileobj(part, out, COPY_BUFFER_BYTES)
+
+    def to_parquet(self, out_path):
+        """
+        Exports to a directory of Parquet files, one for each part, with every column as a string like in the tsv.
+        """
+        pyarrow, _ = parquet_stage.import_pyarrow()
+        import pyarrow.csv
+        import pyarrow.parquet
+        os.makedirs(out_path, exist_ok=True)
+        # The unnamed column after the last tab is always empty.
+        names = [name for name in EBIRD_COLUMNS if name]
+        read_options = pyarrow.csv.ReadOptions(column_names=list(EBIRD_COLUMNS), block_size=PARQUET_BLOCK_BYTES)
+        parse_options = pyarrow.csv.ParseOptions(delimiter='\t', quote_char=False)
+        convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in EBIRD_COLUMNS},
+                                                     include_columns=names)
+        with tempfile.TemporaryDirectory(dir=out_path) as directory:
+            for path in self.export_parts(directory):
+                reader = pyarrow.csv.open_csv(path, read_options, parse_options, convert_options)
+                part_path = os.path.join(out_path, os.path.basename(path)[:-len(".tsv")] + ".parquet")
+                with pyarrow.parquet.ParquetWriter(part_path, reader.schema) as writer:
+                    for record_batch in reader:
+                        writer.write_batch(record_batch)
+                os.remove(path)
+
+
+def parse_command_line():
+    # Imported here, as ebird.py imports this module to run an export.
+    import ebird
+    parser = argparse.ArgumentParser(description="Export observations from the database as an EBD style tsv or Parquet.")
+    ebird.add_export_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def main(options):
+    """
+    Runs an export, from the options of parse_command_line() or of ebird.py's export.
+    """
+    exporter = Exporter(create_engine(options.connection_url), options.jobs, row_filter.options_filters(options))
+    print(f"Start time: {metrics.curr_time()}")
+    if options.format == "parquet":
+        exporter.to_parquet(options.out_path)
+    else:
+        exporter.to_tsv(options.out_path)
+    print(f"End time: {metrics.curr_time()}")
+
+
+if __name__ == "__main__":
+    main(parse_command_line())
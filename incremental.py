@@ -0,0 +1,172 @@
+"""
+Incremental loading of a new eBird release on top of an existing database.
+
+Rather than reloading everything, each batch is compared against what is already stored: observations whose
+LAST EDITED DATE isn't newer than Observation.date_last_edit are dropped before anything is staged, and what is left
+is upserted with the bulk loader. A release diff can be applied by loading only the changed rows and passing the
+list of removed identifiers to apply_deletions().
+
+A checklist whose date has been edited takes all of its observations with it, including those that aren't in the
+batch, since Observation.observation_date is a copy of the checklist's date. The partitioned tables need this done
+before the upserts: their keys include the date (see partitioning), so an edited date wouldn't conflict with the row
+that's there, and a second copy of the checklist and its observations would be inserted next to the old one.
+"""
+import aggregates
+import bulk_load
+import partitioning
+import query_service
+
+# Same as the bulk loader's, except checklists and observations that already exist are updated rather than left alone.
+# The WHERE clauses make sure an older copy of a row never overwrites a newer one. A checklist without a location fails
+# the same way as in bulk_load.CHECKLIST_MERGE_SQL.
+CHECKLIST_UPSERT_SQL = """INSERT INTO checklist (
+        checklist, location_id, start_date_time, checklist_comments, duration, distance, area, number_of_observers,
+        complete_checklist, group_id, approved, reviewed, reason_id, protocol, project_id)
+    SELECT DISTINCT ON (s.checklist)
+        s.checklist, l.id, s.start_date_time, s.checklist_comments, make_interval(mins => s.duration_minutes),
+        s.distance, s.area, s.number_of_observers, s.complete_checklist, s.group_id, s.approved, s.reviewed,
+        s.reason_id, s.protocol, s.project_id
+    FROM stage_checklist s LEFT JOIN location l ON l.locality_id = s.locality_id
+    ON CONFLICT (checklist) DO UPDATE SET
+        location_id = EXCLUDED.location_id, start_date_time = EXCLUDED.start_date_time,
+        checklist_comments = EXCLUDED.checklist_comments, duration = EXCLUDED.duration,
+        distance = EXCLUDED.distance, area = EXCLUDED.area, number_of_observers = EXCLUDED.number_of_observers,
+        complete_checklist = EXCLUDED.complete_checklist, group_id = EXCLUDED.group_id,
+        approved = EXCLUDED.approved, reviewed = EXCLUDED.reviewed, reason_id = EXCLUDED.reason_id,
+        protocol = EXCLUDED.protocol, project_id = EXCLUDED.project_id
+    WHERE (checklist.location_id, checklist.start_date_time, checklist.checklist_comments, checklist.duration,
+           checklist.distance, checklist.area, checklist.number_of_observers, checklist.complete_checklist,
+           checklist.group_id, checklist.approved, checklist.reviewed, checklist.reason_id, checklist.protocol,
+           checklist.project_id)
+        IS DISTINCT FROM
+          (EXCLUDED.location_id, EXCLUDED.start_date_time, EXCLUDED.checklist_comments, EXCLUDED.duration,
+           EXCLUDED.distance, EXCLUDED.area, EXCLUDED.number_of_observers, EXCLUDED.complete_checklist,
+           EXCLUDED.group_id, EXCLUDED.approved, EXCLUDED.reviewed, EXCLUDED.reason_id, EXCLUDED.protocol,
+           EXCLUDED.project_id)"""
+
+OBSERVATION_UPSERT_SQL = """INSERT INTO observation (
+        observation, number_observed, is_x, age_sex_id, species_comments, date_last_edit, has_media, observation_date,
+        checklist_id, observer_id, species_id, subspecies_id)
+    SELECT DISTINCT ON (observation)
+        observation, number_observed, is_x, age_sex_id, species_comments, date_last_edit, has_media, observation_date,
+        checklist_id, observer_id, species_id, subspecies_id
+    FROM stage_observation
+    ORDER BY observation, date_last_edit DESC NULLS LAST
+    ON CONFLICT (observation) DO UPDATE SET
+        number_observed = EXCLUDED.number_observed, is_x = EXCLUDED.is_x, age_sex_id = EXCLUDED.age_sex_id,
+        species_comments = EXCLUDED.species_comments, date_last_edit = EXCLUDED.date_last_edit,
+        has_media = EXCLUDED.has_media, observation_date = EXCLUDED.observation_date,
+        checklist_id = EXCLUDED.checklist_id, observer_id = EXCLUDED.observer_id, species_id = EXCLUDED.species_id,
+        subspecies_id = EXCLUDED.subspecies_id
+    WHERE EXCLUDED.date_last_edit > observation.date_last_edit
+        OR (observation.date_last_edit IS NULL AND EXCLUDED.date_last_edit IS NOT NULL)"""
+
+# Moves checklists whose date has changed, and every observation on them, to the new date, matching on the ids alone.
+# With partitioned tables this moves the rows to the new date's partitions, which plain UPDATEs can do but upserts can't.
+CHECKLIST_MOVE_SQL = """UPDATE checklist c SET start_date_time = s.start_date_time
+    FROM (SELECT DISTINCT ON (checklist) checklist, start_date_time FROM stage_checklist) s
+    WHERE c.checklist = s.checklist AND c.start_date_time IS DISTINCT FROM s.start_date_time"""
+
+OBSERVATION_DATES_SQL = """UPDATE observation o SET observation_date = c.start_date_time
+    FROM checklist c
+    WHERE c.checklist = o.checklist_id AND c.checklist IN (SELECT checklist FROM stage_checklist)
+        AND o.observation_date IS DISTINCT FROM c.start_date_time"""
+
+# The same for an edited observation that's moved to a checklist with another date, as long as the edit is newer.
+OBSERVATION_MOVE_SQL = """UPDATE observation o SET observation_date = s.observation_date, checklist_id = s.checklist_id
+    FROM (SELECT DISTINCT ON (observation) observation, observation_date, checklist_id, date_last_edit
+          FROM stage_observation ORDER BY observation, date_last_edit DESC NULLS LAST) s
+    WHERE o.observation = s.observation AND o.observation_date IS DISTINCT FROM s.observation_date
+        AND (s.date_last_edit > o.date_last_edit OR (o.date_last_edit IS NULL AND s.date_last_edit IS NOT NULL))"""
+
+MERGE_SQL = bulk_load.DIMENSION_MERGE_SQL + (CHECKLIST_MOVE_SQL, OBSERVATION_DATES_SQL, CHECKLIST_UPSERT_SQL,
+                                             OBSERVATION_MOVE_SQL, OBSERVATION_UPSERT_SQL)
+
+STORED_EDITS_SQL = "SELECT observation, date_last_edit FROM observation WHERE observation = ANY(%s)"
+
+
+def changed_rows(cursor, batch):
+    """
+    Drops the rows of a batch that are already in the database and haven't been edited since, with a single query.
+    Args:
+        cursor (cursor): DBAPI cursor, in the batch's transaction.
+        batch (list(ParsedRow)): rows from RowDecoder.decode().
+    Returns:
+        The rows that are new, or newer than what's stored.
+    """
+    cursor.execute(STORED_EDITS_SQL, ([p.observation_id for p in batch],))
+    # Timestamps come back in the session's time zone, which is also how the naive parsed ones were stored.
+    stored = {obs: edit.replace(tzinfo=None) if edit is not None else None for obs, edit in cursor.fetchall()}
+    changed = []
+    for p in batch:
+        if p.observation_id not in stored:
+            changed.append(p)
+            continue
+        stored_edit = stored[p.observation_id]
+        if p.last_edit is not None and (stored_edit is None or p.last_edit > stored_edit):
+            changed.append(p)
+    return changed
+
+
+def loader(engine, partitioned=False, update_aggregates=False, lookups=None):
+    """
+    A BulkLoader which upserts changed rows and skips unchanged ones.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        partitioned (bool, optional): the tables are partitioned by year, see partitioning.
+        update_aggregates (bool, optional): keep the rollups up to date with the edits, see aggregates.
+        lookups (LookupCache, optional): codes of the dictionary encoded columns' values.
+    """
+    merge_sql = MERGE_SQL
+    if partitioned:
+        merge_sql = partitioning.conflict_targets(merge_sql)
+    if update_aggregates:
+        merge_sql = aggregates.with_updates(merge_sql)
+    return bulk_load.BulkLoader(engine, merge_sql=merge_sql, batch_filter=changed_rows, lookups=lookups, updates=True)
+
+
+def read_deleted_ids(file_path):
+    """
+    Reads a list of removed records, one identifier per line, as they appear in the data:
+    observations as URN:CornellLabOfOrnithology:EBIRD:OBS###### (or just OBS######) and checklists as S######.
+    Returns:
+        Two lists of ints, the observation ids and the checklist ids.
+    """
+    observations = []
+    checklists = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            identifier = line.strip().split(':')[-1]
+            if identifier.startswith('OBS'):
+                observations.append(int(identifier[3:]))
+            elif identifier.startswith('S'):
+                checklists.append(int(identifier[1:]))
+            elif identifier:
+                raise ValueError(f"Don't know how to delete {line.strip()}.")
+    return observations, checklists
+
+
+def apply_deletions(engine, file_path):
+    """
+    Deletes the observations and checklists listed in a file, along with the observations on deleted checklists.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        file_path (str): list of removed identifiers, see read_deleted_ids().
+    Returns:
+        The number of observations and checklists deleted.
+    """
+    observations, checklists = read_deleted_ids(file_path)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM observation WHERE observation = ANY(%s) OR checklist_id = ANY(%s)",
+                       (observations, checklists))
+        deleted_observations = cursor.rowcount
+        cursor.execute("DELETE FROM checklist WHERE checklist = ANY(%s)", (checklists,))
+        deleted_checklists = cursor.rowcount
+        # Which regions the deleted rows were in isn't known without looking them up first, so every cached query goes.
+        query_service.bump_all(cursor)
+        connection.commit()
+    finally:
+        connection.close()
+    return deleted_observations, deleted_checklists
@@ -0,0 +1,208 @@
+"""
+Opens the eBird dataset straight from the release archive, without unpacking it to disk first.
+
+eBird ships the EBD as a tar containing a gzipped tsv, so this handles plain .txt files, .gz and .zst files and .tar
+archives containing any of those. Decompression happens in a background thread, which lets it overlap with parsing.
+
+Compressed data can't be seeked in, so starting part of the way through it, such as resuming from a checkpoint, means
+decompressing everything before that point and throwing it away: it takes about as long as reading that much did in
+the first place. Only a plain .txt file is skipped over with a seek.
+"""
+import gzip
+import io
+import os
+import queue
+import tarfile
+import threading
+from contextlib import contextmanager, ExitStack
+
+# Size of each chunk handed over from the decompression thread.
+READ_CHUNK_BYTES = 4 * 1024 * 1024
+
+# How many decompressed chunks can be waiting to be parsed.
+READ_AHEAD_CHUNKS = 8
+
+COMPRESSED_EXTENSIONS = ('.gz', '.zst')
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Reads from another binary stream in a separate thread, keeping up to READ_AHEAD_CHUNKS chunks ready.
+    """
+
+    def __init__(self, raw, chunk_bytes=READ_CHUNK_BYTES, read_ahead=READ_AHEAD_CHUNKS):
+        super().__init__()
+        self.raw = raw
+        self.chunk_bytes = chunk_bytes
+        self.chunks = queue.Queue(maxsize=read_ahead)
+        self.current = memoryview(b'')
+        self.done = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.fill, name="ebird-decompress", daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stopping.is_set():
+                chunk = self.raw.read(self.chunk_bytes)
+                if not chunk:
+                    break
+                self.put(chunk)
+        except Exception as ex:
+            # Pass any errors along so they are raised in the reading thread.
+            self.put(ex)
+            return
+        self.put(b'')
+
+    def put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.current and not self.done:
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if item == b'':
+                self.done = True
+            self.current = memoryview(item)
+        n = min(len(b), len(self.current))
+        b[:n] = self.current[:n]
+        self.current = self.current[n:]
+        return n
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        super().close()
+
+
+def is_compressed(file_path):
+    """
+    Whether or not the data has to be read as a stream, rather than seeking around in a plain file.
+    """
+    return file_path.endswith(COMPRESSED_EXTENSIONS) or file_path.endswith('.tar')
+
+
+def find_data_member(tar):
+    """
+    Finds the observation data inside an EBD release tar, which also contains the metadata, terms of use and so on.
+    Args:
+        tar (TarFile): opened release archive.
+    Returns:
+        The TarInfo of the data file.
+    """
+    candidates = []
+    for member in tar.getmembers():
+        name = os.path.basename(member.name)
+        if member.isfile() and name.endswith(('.txt',) + tuple('.txt' + ext for ext in COMPRESSED_EXTENSIONS)):
+            candidates.append(member)
+    # The data file is named along the lines of ebd_relMay-2020.txt.gz.
+    ebd = [m for m in candidates if os.path.basename(m.name).startswith('ebd_')]
+    if ebd:
+        candidates = ebd
+    if not candidates:
+        raise ValueError(f"Couldn't find the eBird data file in {tar.name}.")
+    return max(candidates, key=lambda m: m.size)
+
+
+def decompressor(stream, name):
+    """
+    Wraps a binary stream with the decompressor matching the file name.
+    """
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if name.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst files requires the zstandard package: pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_size=READ_CHUNK_BYTES)
+    return stream
+
+
+@contextmanager
+def open_ebird_file(file_path, threaded=True):
+    """
+    Opens the eBird data for reading, no matter how it's packaged.
+    Args:
+        file_path (str): path to a .txt, .gz, .zst or .tar file.
+        threaded (bool, optional): decompress in a background thread.
+    Returns:
+        A binary file-like object of the uncompressed tsv.
+    """
+    with ExitStack() as stack:
+        name = file_path
+        stream = stack.enter_context(open(file_path, 'rb'))
+        if file_path.endswith('.tar'):
+            tar = stack.enter_context(tarfile.open(fileobj=stream, mode='r:'))
+            member = find_data_member(tar)
+            name = member.name
+            stream = tar.extractfile(member)
+        if not is_compressed(file_path):
+            yield stream
+            return
+        stream = stack.enter_context(decompressor(stream, name))
+        if threaded:
+            stream = stack.enter_context(io.BufferedReader(BackgroundReader(stream), READ_CHUNK_BYTES))
+        yield stream
+
+
+def read_header(f, start_row=0, start_offset=0):
+    """
+    Reads the header line from the start of the binary stream, then skips ahead to where parsing should start.
+    Args:
+        f (file): binary stream from open_ebird_file().
+        start_row (int, optional): skip this many rows after the header.
+        start_offset (int, optional): skip ahead to this byte offset, such as one saved in a checkpoint.
+    Returns:
+        The list of column names and the byte offset, in the uncompressed data, of the first row to parse.
+    """
+    header_line = f.readline()
+    header = header_line.decode('utf-8').rstrip('\r\n').split('\t')
+    offset = len(header_line)
+    for _ in range(start_row):
+        offset += len(f.readline())
+    if start_offset > offset:
+        offset = skip_to(f, offset, start_offset)
+    return header, offset
+
+
+def skip_to(f, offset, target):
+    """
+    Moves a binary stream forwards from offset to target, seeking if we can and reading and discarding if not.
+    A decompressing stream can't seek, so for one this reads, and decompresses, everything up to target.
+    Returns:
+        The new offset.
+    """
+    if f.seekable():
+        f.seek(target)
+        return target
+    while offset < target:
+        skipped = len(f.read(min(READ_CHUNK_BYTES, target - offset)))
+        if skipped == 0:
+            raise ValueError(f"Can't skip to byte {target}, the data ends at byte {offset}.")
+        offset += skipped
+    return offset
+
+
+def line_aligned_chunks(stream, chunk_bytes):
+    """
+    Reads a binary stream in chunks of about chunk_bytes which always end at the end of a line.
+    Returns:
+        A generator of bytes.
+    """
+    while True:
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            return
+        if not chunk.endswith(b'\n'):
+            chunk += stream.readline()
+        yield chunk
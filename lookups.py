@@ -0,0 +1,174 @@
+"""
+Dictionary encoding of the text columns with only a few distinct values: Checklist.reason, Checklist.project_code,
+Observation.age_sex and Locality.locality_type.
+
+Each has a small lookup table of its values, and rows store a code from it instead of the text, like
+Checklist.protocol does with a fixed list of codes. These columns repeat on every checklist or observation, so that
+saves a lot of space, and of reading, in the biggest tables. The views in models.DECODED_VIEWS join the text back in,
+so queries can use them much as they would the tables.
+
+The loader keeps every value's code in a LookupCache, loaded with one query per lookup table when a load starts, so
+values are encoded without going to the database. A value that isn't there yet is added to its lookup table straight
+away, in a transaction of its own, so its code never gets rolled back along with a batch that fails and the cache
+stays right whichever loader is using it. There are only ever a handful of these. Without an engine, for a dry run,
+new values are just numbered in memory.
+"""
+import argparse
+import threading
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.dialects.postgresql import insert
+from models import DECODED_VIEWS, AgeSex, LocalityType, Project, Reason
+
+# Lookup name, which is also the encoded column's name, to the lookup table's code and value columns.
+LOOKUPS = {
+    'locality_type': (LocalityType.locality_type_id, LocalityType.locality_type),
+    'reason': (Reason.reason_id, Reason.reason),
+    'project_code': (Project.project_id, Project.project_code),
+    'age_sex': (AgeSex.age_sex_id, AgeSex.age_sex),
+}
+
+# The table each lookup's column was in, and the column the code replaces it with, for encode_existing().
+ENCODED_COLUMNS = {
+    'locality_type': ('locality', 'locality_type_id'),
+    'reason': ('checklist', 'reason_id'),
+    'project_code': ('checklist', 'project_id'),
+    'age_sex': ('observation', 'age_sex_id'),
+}
+
+
+class LookupCache:
+    """
+    The code of every value in the lookup tables, adding values that aren't there yet.
+    Args:
+        engine (Engine): SQLAlchemy engine, used to add new values, or None to number them here without a database.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.codes = {name: {} for name in LOOKUPS}
+        # The async loader and the ORM path encode from the same process, so adding a value has to happen only once.
+        self.lock = threading.Lock()
+
+    def warm(self):
+        """
+        Loads every value from the database, with one query per lookup table.
+        """
+        with self.engine.connect() as conn:
+            for name, (code_column, value_column) in LOOKUPS.items():
+                self.codes[name].update((value, code) for code, value in conn.execute(select(code_column, value_column)))
+
+    def encode(self, name, value):
+        """
+        Args:
+            name (str): one of the LOOKUPS.
+            value (str): the text to encode.
+        Returns:
+            The value's code in the lookup table.
+        """
+        try:
+            return self.codes[name][value]
+        except KeyError:
+            return self.add(name, value)
+
+    def missing(self, batch):
+        """
+        The values in a batch of parsed rows that aren't cached yet, so they can be added before it's encoded, such as
+        from a thread by the async loader.
+        Returns:
+            A set of (name, value) pairs.
+        """
+        codes = self.codes
+        found = set()
+        last_checklist = None
+        for p in batch:
+            if p.age_sex not in codes['age_sex']:
+                found.add(('age_sex', p.age_sex))
+            c = p.checklist
+            if c is not last_checklist:
+                last_checklist = c
+                for name, value in (('locality_type', c.locality_type), ('reason', c.reason),
+                                    ('project_code', c.project_code)):
+                    if value not in codes[name]:
+                        found.add((name, value))
+        return found
+
+    def add(self, name, value):
+        """
+        Adds a value to its lookup table, committing it immediately, unless something else already has.
+        """
+        with self.lock:
+            codes = self.codes[name]
+            if value in codes:
+                return codes[value]
+            code_column, value_column = LOOKUPS[name]
+            if self.engine is None:
+                code = len(codes) + 1
+            else:
+                with self.engine.begin() as conn:
+                    conn.execute(insert(code_column.table).values({value_column.name: value})
+                                 .on_conflict_do_nothing(index_elements=[value_column.name]))
+                    code = conn.execute(select(code_column).where(value_column == value)).scalar_one()
+            codes[value] = code
+            return code
+
+    def stats(self):
+        """
+        A one line summary of the number of values of each lookup, for progress output.
+        """
+        return ", ".join(f"{name}: {len(codes)}" for name, codes in self.codes.items())
+
+
+def create_views(conn):
+    """
+    Creates, or replaces, the views with the encoded columns decoded.
+    Args:
+        conn (Connection): SQLAlchemy connection.
+    """
+    for name, query in DECODED_VIEWS.items():
+        conn.execute(text(f"CREATE OR REPLACE VIEW {name} AS {query}"))
+
+
+def encode_existing(engine):
+    """
+    Replaces the text columns of a database loaded before they were dictionary encoded with codes, then adds the
+    views. This rewrites the tables, so it takes about as long as building their indexes again.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+    """
+    with engine.begin() as conn:
+        for name, (code_column, value_column) in LOOKUPS.items():
+            table, encoded = ENCODED_COLUMNS[name]
+            code_column.table.create(conn, checkfirst=True)
+            exists = conn.execute(text("SELECT 1 FROM information_schema.columns WHERE table_name = :table AND "
+                                       "column_name = :column"), {"table": table, "column": name}).scalar()
+            if not exists:
+                continue
+            lookup = code_column.table.name
+            conn.execute(text(f"INSERT INTO {lookup} ({value_column.name}) SELECT DISTINCT {name} FROM {table} "
+                              f"ON CONFLICT DO NOTHING"))
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {encoded} {code_column.type.compile(engine.dialect)}"))
+            conn.execute(text(f"UPDATE {table} t SET {encoded} = k.{code_column.name} FROM {lookup} k "
+                              f"WHERE k.{value_column.name} = t.{name}"))
+            conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {encoded} SET NOT NULL, DROP COLUMN {name}"))
+            print(f"{table}.{name} encoded.")
+        create_views(conn)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Dictionary encoded columns and their lookup tables.")
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
+                        required=True)
+    parser.add_argument('--encode-existing', dest="encode_existing", action="store_true",
+                        help="Encode the columns of a database loaded before they were encoded.")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    engine = create_engine(options.connection_url)
+    if options.encode_existing:
+        encode_existing(engine)
+    cache = LookupCache(engine)
+    cache.warm()
+    print(f"Lookup values: {cache.stats()}.")
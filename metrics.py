@@ -0,0 +1,255 @@
+"""
+Timing and counting of each stage of a load, so it's possible to see where the time goes.
+
+Code being measured wraps each stage in `with metrics.stage('name'):` and counts events with metrics.count(). After
+every batch, report() prints a progress line, and can also append everything measured so far to a JSON lines log and
+write it as a Prometheus textfile, for node_exporter's textfile collector to pick up. The stages can be profiled as
+well, see profiling.
+
+All of the numbers are cumulative since configure() was last called, like Prometheus counters.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Upper bounds, in seconds, of the batch commit latency histogram's buckets.
+COMMIT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Prefix of every Prometheus metric name.
+PROMETHEUS_PREFIX = "ebird_load"
+
+# Help text of the values set with gauge(), which are only exported once they've been set.
+GAUGES = {
+    "batch_size": "Rows in the next batch, picked by batching.BatchSizer.",
+    "resident_bytes": "Resident memory of the loading process.",
+}
+
+
+class Metrics:
+    """
+    Cumulative stage timers, counters and the commit latency histogram for one load.
+    Args:
+        log_path (str, optional): JSON lines file to append a record to on each report().
+        textfile_path (str, optional): Prometheus textfile to rewrite on each report(), which should end in .prom.
+        profiler (StageProfiler, optional): profiles the stages of some of the batches, see profiling.
+    """
+
+    def __init__(self, log_path=None, textfile_path=None, profiler=None):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+        self.profiler = profiler
+        # Counters and stages are updated from the reader, executor and writer threads as well as the main one.
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        # Calls of each stage in progress, and when the stage last went from none to one.
+        self.running = {}
+        self.busy_since = {}
+        self.counters = {"rows": 0, "batches": 0, "retries": 0, "bytes_read": 0, "quarantined": 0}
+        self.gauges = {}
+        self.commit_buckets = [0] * len(COMMIT_BUCKETS)
+        self.commit_count = 0
+        self.commit_sum = 0.0
+        self.last_report = self.started
+        self.last_report_rows = 0
+        self.start_rows = 0
+
+    @contextmanager
+    def stage(self, name):
+        profiled = self.profiler is not None and self.profiler.start(name)
+        start = time.perf_counter()
+        # The async loader's writers can be in the same stage at once, and only the time any of them was in it counts,
+        # so a stage never adds up to more than the load took.
+        with self.lock:
+            if not self.running.get(name):
+                self.busy_since[name] = start
+            self.running[name] = self.running.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.running[name] -= 1
+                busy_seconds = end - self.busy_since[name] if self.running[name] == 0 else 0.0
+            self.add_time(name, end - start, busy_seconds)
+            if profiled:
+                self.profiler.stop(name)
+
+    def add_time(self, name, seconds, busy_seconds=None):
+        """
+        Records one call of a stage.
+        Args:
+            name (str): the stage.
+            seconds (float): how long the call took.
+            busy_seconds (float, optional): how much to add to the stage's time, if not seconds, as with calls that
+                overlapped others.
+        """
+        with self.lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + (seconds if busy_seconds is None else busy_seconds)
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+            if name == "commit":
+                self.commit_count += 1
+                self.commit_sum += seconds
+                for i, bound in enumerate(COMMIT_BUCKETS):
+                    if seconds <= bound:
+                        self.commit_buckets[i] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self, dimensions=None):
+        """
+        Everything measured so far, as a dict that can be dumped as JSON.
+        Args:
+            dimensions (DimensionCache, optional): cache whose hits and misses to include.
+        """
+        now = time.monotonic()
+        elapsed = now - self.started
+        with self.lock:
+            counters = dict(self.counters)
+            record = {
+                "time": datetime.now().isoformat(timespec='seconds'),
+                "elapsed_seconds": round(elapsed, 3),
+                "rows_per_second": round((counters["rows"] - self.start_rows) / elapsed, 1) if elapsed else 0.0,
+                "recent_rows_per_second": round((counters["rows"] - self.last_report_rows) / (now - self.last_report), 1)
+                if now > self.last_report else 0.0,
+                "counters": counters,
+                "gauges": dict(self.gauges),
+                "stage_seconds": {name: round(seconds, 4) for name, seconds in self.stage_seconds.items()},
+                "stage_calls": dict(self.stage_calls),
+                "commit_seconds": {"count": self.commit_count, "sum": round(self.commit_sum, 4),
+                                   "buckets": dict(zip((str(b) for b in COMMIT_BUCKETS), self.commit_buckets))},
+            }
+        if dimensions is not None:
+            record["cache"] = {d: {"size": len(dimensions.keys[d]), "hits": dimensions.hits[d],
+                                   "misses": dimensions.misses[d],
+                                   "hit_rate": round(dimensions.hits[d] / max(dimensions.hits[d] + dimensions.misses[d], 1), 4)}
+                               for d in dimensions.keys}
+        return record
+
+    def prometheus(self, record):
+        """
+        The snapshot() record in the Prometheus text exposition format.
+        """
+        p = PROMETHEUS_PREFIX
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{p}_{name}{labels} {value}")
+
+        metric("rows_total", "counter", "Rows written to the database.", [("", record["counters"]["rows"])])
+        metric("batches_total", "counter", "Batches committed.", [("", record["counters"]["batches"])])
+        metric("retries_total", "counter", "Batches retried after an OperationalError.",
+               [("", record["counters"]["retries"])])
+        metric("quarantined_total", "counter", "Lines and rows written to the quarantine file instead of loaded.",
+               [("", record["counters"]["quarantined"])])
+        metric("bytes_read_total", "counter", "Bytes of uncompressed data read.", [("", record["counters"]["bytes_read"])])
+        metric("rows_per_second", "gauge", "Rows written per second since the last report.",
+               [("", record["recent_rows_per_second"])])
+        for name, value in record["gauges"].items():
+            if value is not None:
+                metric(name, "gauge", GAUGES.get(name, name), [("", value)])
+        metric("stage_seconds_total", "counter", "Time spent in each stage of the load.",
+               [(f'{{stage="{name}"}}', seconds) for name, seconds in record["stage_seconds"].items()])
+        buckets = []
+        for bound, n in record["commit_seconds"]["buckets"].items():
+            buckets.append((f'_bucket{{le="{bound}"}}', n))
+        metric("commit_seconds", "histogram", "Latency of batch commits.",
+               buckets + [('_bucket{le="+Inf"}', record["commit_seconds"]["count"]),
+                          ("_sum", record["commit_seconds"]["sum"]), ("_count", record["commit_seconds"]["count"])])
+        if "cache" in record:
+            metric("cache_hits_total", "counter", "Dimension cache hits.",
+                   [(f'{{dimension="{d}"}}', c["hits"]) for d, c in record["cache"].items()])
+            metric("cache_misses_total", "counter", "Dimension cache misses, which are rows to insert.",
+                   [(f'{{dimension="{d}"}}', c["misses"]) for d, c in record["cache"].items()])
+        metric("last_report_timestamp_seconds", "gauge", "When these metrics were written.", [("", round(time.time(), 3))])
+        return "\n".join(lines) + "\n"
+
+    def report(self, dimensions=None):
+        """
+        Prints progress and writes the JSON lines log and Prometheus textfile, if they're configured.
+        Args:
+            dimensions (DimensionCache, optional): cache whose hit rates to include.
+        """
+        record = self.snapshot(dimensions)
+        print(f"{curr_time()} Commit:  {record['counters']['rows']} ({record['recent_rows_per_second']:.0f} rows/s, "
+              f"commit {self.stage_seconds.get('commit', 0) / max(self.commit_count, 1):.3f}s avg"
+              + (f", next batch {self.gauges['batch_size']}" if "batch_size" in self.gauges else "")
+              + (f", {self.gauges['resident_bytes'] / 2 ** 20:.0f} MiB resident"
+                 if self.gauges.get("resident_bytes") is not None else "") + ")")
+        if dimensions is not None:
+            print(dimensions.stats())
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        if self.textfile_path is not None:
+            # node_exporter could read a half written file, so write a new one and rename it over the old one.
+            temp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(self.prometheus(record))
+            os.replace(temp_path, self.textfile_path)
+        self.last_report = time.monotonic()
+        self.last_report_rows = record["counters"]["rows"]
+        if self.profiler is not None:
+            self.profiler.batch_done()
+
+    def summary(self):
+        """
+        One line of where the time went, biggest stage first.
+        """
+        with self.lock:
+            stages = sorted(self.stage_seconds.items(), key=lambda item: item[1], reverse=True)
+        return ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in stages)
+
+
+# The load currently being measured.
+current = Metrics()
+
+
+def configure(log_path=None, textfile_path=None, start_rows=0, profiler=None):
+    """
+    Starts measuring a new load.
+    Args:
+        log_path (str, optional): JSON lines file to append to after each batch.
+        textfile_path (str, optional): Prometheus textfile to write after each batch.
+        start_rows (int, optional): rows already loaded, such as when resuming.
+        profiler (StageProfiler, optional): profiles the stages of some of the batches, see profiling.
+    """
+    global current
+    current = Metrics(log_path, textfile_path, profiler)
+    current.counters["rows"] = start_rows
+    current.start_rows = start_rows
+    current.last_report_rows = start_rows
+    return current
+
+
+def stage(name):
+    return current.stage(name)
+
+
+def count(name, n=1):
+    current.count(name, n)
+
+
+def gauge(name, value):
+    current.gauge(name, value)
+
+
+def report(dimensions=None):
+    current.report(dimensions)
+
+
+def curr_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -1,4 +1,5 @@
-from sqlalchemy import ARRAY, Boolean, CheckConstraint, Column, DateTime, Float, ForeignKey, Integer, Numeric, SmallInteger, String, Table, Text, UniqueConstraint, text
+from sqlalchemy import ARRAY, BigInteger, Boolean, CheckConstraint, Column, DDL, Date, DateTime, Float, ForeignKey, Integer, Numeric, SmallInteger, String, Table, Text, UniqueConstraint, text
+from sqlalchemy import event
 from sqlalchemy.sql.sqltypes import NullType
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import INTERVAL
@@ -32,11 +33,41 @@ class Locality(Base):
 
     locality_name = Column(Text, nullable=False)
     locality_id = Column(Integer, primary_key=True)
-    locality_type = Column(String(2), nullable=False)
+    locality_type_id = Column(ForeignKey('locality_type.locality_type_id', deferrable=True, initially='DEFERRED'), nullable=False)
 
     locations = relationship("Location", backref="location_locality")
 
 
+class LocalityType(Base):
+    __tablename__ = 'locality_type'
+
+    # The lookup tables hold the values of text columns with only a few distinct values, see lookups.
+    locality_type_id = Column(SmallInteger, primary_key=True)
+    locality_type = Column(Text, nullable=False, unique=True)
+
+
+class Reason(Base):
+    __tablename__ = 'reason'
+
+    reason_id = Column(SmallInteger, primary_key=True)
+    reason = Column(Text, nullable=False, unique=True)
+
+
+class Project(Base):
+    __tablename__ = 'project'
+
+    project_id = Column(SmallInteger, primary_key=True)
+    project_code = Column(Text, nullable=False, unique=True)
+
+
+class AgeSex(Base):
+    __tablename__ = 'age_sex'
+
+    # Counts are part of the value, like "Male, Adult (2)", so there are more of these than of the others.
+    age_sex_id = Column(Integer, primary_key=True)
+    age_sex = Column(Text, nullable=False, unique=True)
+
+
 class Observer(Base):
     __tablename__ = 'observer'
 
@@ -70,11 +101,13 @@ class Location(Base):
     __tablename__ = 'location'
 
     id = Column(Integer, primary_key=True)
-    coords = Column(Geometry(geometry_type='POINT', srid=4326), nullable=False, index=True)
+    coords = Column(Geometry(geometry_type='POINT', srid=4326), nullable=False)
     country_id = Column(ForeignKey('country.country_code', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
     county_id = Column(ForeignKey('county.county_code', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
-    locality_id = Column(ForeignKey('locality.locality_id', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
+    locality_id = Column(ForeignKey('locality.locality_id', deferrable=True, initially='DEFERRED'), nullable=False, unique=True, index=True)
     state_province_id = Column(ForeignKey('stateprovince.state_code', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
+    # See spatial.grid_cell().
+    grid_cell = Column(Integer, index=True)
 
     # country = relationship('Country')
     # county = relationship('County')
@@ -112,10 +145,11 @@ class Checklist(Base):
     group_id = Column(Integer)
     approved = Column(Boolean, nullable=False)
     reviewed = Column(Boolean, nullable=False)
-    reason = Column(Text, nullable=False)
+    # The lookup table codes aren't indexed, there are too few of them for an index to be any use.
+    reason_id = Column(ForeignKey('reason.reason_id', deferrable=True, initially='DEFERRED'), nullable=False)
     protocol = Column(String(2))
     location_id = Column(ForeignKey('location.id', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
-    project_code = Column(Text, nullable=False)
+    project_id = Column(ForeignKey('project.project_id', deferrable=True, initially='DEFERRED'), nullable=False)
 
     # location = relationship('Location')
     observations = relationship("Observation", backref="checklist_observation")
@@ -127,10 +161,12 @@ class Observation(Base):
     observation = Column(Integer, primary_key=True)
     number_observed = Column(Integer)
     is_x = Column(Boolean, nullable=False)
-    age_sex = Column(Text, nullable=False)
+    age_sex_id = Column(ForeignKey('age_sex.age_sex_id', deferrable=True, initially='DEFERRED'), nullable=False)
     species_comments = Column(Text)
     date_last_edit = Column(DateTime(True))
     has_media = Column(Boolean, nullable=False)
+    # Copy of the checklist's start_date_time, so observations can be partitioned by date along with their checklists.
+    observation_date = Column(DateTime(True))
     checklist_id = Column(ForeignKey('checklist.checklist', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
     observer_id = Column(ForeignKey('observer.observer_id', deferrable=True, initially='DEFERRED'), index=True)
     species_id = Column(ForeignKey('species.scientific_name', deferrable=True, initially='DEFERRED'), index=True)
@@ -142,5 +178,72 @@ class Observation(Base):
     # subspecies = relationship('SubSpecies')
 
 
+class TaxonomyVersion(Base):
+    __tablename__ = 'taxonomy_version'
+
+    # Taxonomy file name and a hash of its contents, so each version is only loaded once.
+    version = Column(Text, primary_key=True)
+    species_count = Column(Integer, nullable=False)
+    subspecies_count = Column(Integer, nullable=False)
+    loaded = Column(DateTime(True), nullable=False)
+
+
+class LoadCheckpoint(Base):
+    __tablename__ = 'load_checkpoint'
+
+    # File name and size of the data file, so a checkpoint is never used for a different release.
+    file_identity = Column(Text, primary_key=True)
+    # Offset in the uncompressed data just past the last committed row.
+    byte_offset = Column(BigInteger, nullable=False)
+    row_count = Column(BigInteger, nullable=False)
+    updated = Column(DateTime(True), nullable=False)
+
+
+class CacheGeneration(Base):
+    __tablename__ = 'cache_generation'
+
+    # A state or county code, or * for everywhere, and how many batches have changed it, see query_service.
+    scope = Column(Text, primary_key=True)
+    generation = Column(BigInteger, nullable=False)
+
+
+class AggregateRegion(Base):
+    __tablename__ = 'aggregate_region'
+
+    # See aggregates. level is county or state, period is week or month and period_start its first day.
+    region_level = Column(String(6), primary_key=True)
+    region_code = Column(Text, primary_key=True)
+    period = Column(String(5), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    checklists = Column(Integer, nullable=False)
+    complete_checklists = Column(Integer, nullable=False)
+
+
+class AggregateSpecies(Base):
+    __tablename__ = 'aggregate_species'
+
+    species_id = Column(Text, primary_key=True)
+    region_level = Column(String(6), primary_key=True)
+    region_code = Column(Text, primary_key=True)
+    period = Column(String(5), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    # Checklists the species was reported on.
+    detections = Column(Integer, nullable=False)
+    complete_detections = Column(Integer, nullable=False)
+
+
+# Views of the tables with dictionary encoded columns, with the text put back under the columns' original names.
+DECODED_VIEWS = {
+    'locality_view': "SELECT l.*, t.locality_type FROM locality l JOIN locality_type t USING (locality_type_id)",
+    'checklist_view': "SELECT c.*, r.reason, p.project_code FROM checklist c "
+                      "JOIN reason r USING (reason_id) JOIN project p USING (project_id)",
+    'observation_view': "SELECT o.*, a.age_sex FROM observation o JOIN age_sex a USING (age_sex_id)",
+}
+
+for _name, _query in DECODED_VIEWS.items():
+    event.listen(metadata, 'after_create', DDL(f"CREATE OR REPLACE VIEW {_name} AS {_query}"))
+    event.listen(metadata, 'before_drop', DDL(f"DROP VIEW IF EXISTS {_name}"))
+
+
 # Not implemented fields from the data (yet):
 # IBA CODE, BCR CODE, USFWS CODE, ATLAS BLOCK, BREEDING BIRD ATLAS CODE, BREEDING BIRD ATLAS CATEGORY
\ No newline at end of file
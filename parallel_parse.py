@@ -0,0 +1,181 @@
+"""
+Parses the eBird dataset in a pool of processes while a single writer puts the results in the database.
+
+The file is split into byte ranges that start and end on line boundaries, each of which is parsed by a worker process.
+Results come back to the writer in file order, and only a bounded number of ranges are in flight at once,
+so a slow database holds back the parsers instead of letting parsed rows pile up in memory.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import input_stream
+import metrics
+import quarantine
+import row_filter
+
+# Roughly how much of the file each worker parses at a time.
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# How many chunks can be parsed ahead of the writer, per worker.
+QUEUE_DEPTH_PER_WORKER = 2
+
+# Set in each worker process by init_worker().
+_worker_state = {}
+
+
+def init_worker(header, decoder_class, species_sci_names, subspecies_sci_names, quarantine_path=None, filters=None):
+    """
+    Sets up the row decoder in the worker process, so everything it needs only gets sent over once.
+    Args:
+        header (list(str)): column names from the first line of the file.
+        decoder_class (type): such as ebird_data_parse.RowDecoder.
+        species_sci_names (set): all species' scientific names.
+        subspecies_sci_names (set): all subspecies' scientific names.
+        quarantine_path (str, optional): quarantine lines that can't be parsed here instead of failing.
+        filters (dict, optional): only parse the lines that pass these filters, see row_filter.
+    """
+    _worker_state['decoder'] = decoder_class(header, species_sci_names, subspecies_sci_names)
+    _worker_state['filter'] = row_filter.line_filter(header, filters)
+    quarantine.configure(quarantine_path)
+
+
+def parse_range(file_path, begin, end, batch_size):
+    """
+    Parses the rows between two byte offsets in the file. Runs in a worker process.
+    Args:
+        file_path (str): path of the eBird tsv file.
+        begin (int): offset of the first byte of the first line.
+        end (int): offset just past the end of the last line.
+        batch_size (int): number of rows per returned batch.
+    Returns:
+        The same as parse_chunk().
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    return parse_chunk(data, begin, batch_size)
+
+
+def parse_chunk(data, begin, batch_size):
+    """
+    Parses a chunk of whole lines. Runs in a worker process.
+    Args:
+        data (bytes): the lines to parse.
+        begin (int): byte offset of the start of data in the uncompressed file.
+        batch_size (int): number of rows per returned batch.
+    Returns:
+        A list of (batch, end offset) tuples, where the end offset is the byte just past the batch's last row, and the
+        number of lines quarantined, for the parent process to count, see collect().
+    """
+    decode = _worker_state['decoder'].decode
+    keep = _worker_state.get('filter')
+    offset = begin
+    batches = []
+    batch = []
+    quarantined = 0
+    for line in data.splitlines(keepends=True):
+        if keep is not None and not keep.keep(line):
+            offset += len(line)
+            continue
+        try:
+            batch.append(decode(line.decode('utf-8')))
+        except Exception as ex:
+            if quarantine.current is None:
+                raise
+            quarantine.current.add_line(offset, line, ex)
+            quarantined += 1
+        offset += len(line)
+        if len(batch) == batch_size:
+            batches.append((batch, offset))
+            batch = []
+    if batch:
+        batches.append((batch, offset))
+    return batches, quarantined
+
+
+def collect(result):
+    """
+    Counts the lines a worker quarantined, here in the parent process, and returns its batches.
+    Args:
+        result (tuple): what parse_chunk() or parse_range() returned.
+    Returns:
+        The list of (batch, end offset) tuples.
+    """
+    batches, quarantined = result
+    if quarantined:
+        metrics.count("quarantined", quarantined)
+        if quarantine.current is not None:
+            quarantine.current.add_count(quarantined)
+    return batches
+
+
+def line_aligned_ranges(file_path, begin, chunk_bytes=CHUNK_BYTES):
+    """
+    Splits the file, from begin onwards, into byte ranges which all end on a line boundary.
+    Args:
+        file_path (str): path of the eBird tsv file.
+        begin (int): offset to start at, which has to be the start of a line.
+        chunk_bytes (int): approximate size of each range.
+    Returns:
+        A generator of (begin, end) byte offset tuples.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        while begin < size:
+            f.seek(min(begin + chunk_bytes, size))
+            # Finish off whatever line we landed in the middle of.
+            f.readline()
+            end = min(f.tell(), size)
+            yield begin, end
+            begin = end
+
+
+def stream_chunks(f, begin):
+    """
+    Reads line aligned chunks from a stream, keeping track of where each one starts.
+    Returns:
+        A generator of (chunk, begin offset) tuples.
+    """
+    for chunk in input_stream.line_aligned_chunks(f, CHUNK_BYTES):
+        yield chunk, begin
+        begin += len(chunk)
+
+
+def parallel_batches(file_path, start_row, workers, decoder_class, species_sci_names, subspecies_sci_names, batch_size,
+                     start_offset=0, quarantine_path=None, filters=None):
+    """
+    Parses the file with a pool of worker processes.
+    Args:
+        file_path (str): path of the eBird tsv file, or a compressed file or archive containing it.
+        start_row (int): skip this many rows before parsing.
+        workers (int): number of parsing processes.
+        decoder_class (type): such as ebird_data_parse.RowDecoder.
+        species_sci_names (set): all species' scientific names.
+        subspecies_sci_names (set): all subspecies' scientific names.
+        batch_size (int): number of rows per batch.
+        start_offset (int, optional): byte offset to start parsing at, from a checkpoint.
+        quarantine_path (str, optional): quarantine lines that can't be parsed instead of failing, see quarantine.
+        filters (dict, optional): only parse the lines that pass these filters, see row_filter.
+    Returns:
+        A generator of (batch, end offset) tuples, in the same order as they are in the file.
+    """
+    with input_stream.open_ebird_file(file_path) as f:
+        header, begin = input_stream.read_header(f, start_row, start_offset)
+        # Checking the header here means a bad file fails straight away rather than in every worker.
+        decoder_class(header, species_sci_names, subspecies_sci_names)
+        init_args = (header, decoder_class, species_sci_names, subspecies_sci_names, quarantine_path, filters)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as pool:
+            if input_stream.is_compressed(file_path):
+                # Archives have to be read from start to finish, so this process reads and the workers only parse.
+                tasks = ((parse_chunk, chunk, chunk_begin)
+                         for chunk, chunk_begin in stream_chunks(f, begin))
+            else:
+                tasks = ((parse_range, file_path, chunk_begin, chunk_end)
+                         for chunk_begin, chunk_end in line_aligned_ranges(file_path, begin))
+            pending = deque()
+            for fn, *args in tasks:
+                pending.append(pool.submit(fn, *args, batch_size))
+                if len(pending) >= workers * QUEUE_DEPTH_PER_WORKER:
+                    yield from collect(pending.popleft().result())
+            while pending:
+                yield from collect(pending.popleft().result())
@@ -0,0 +1,293 @@
+"""
+Converts the eBird dataset to a Parquet dataset once, so it can be loaded (and analysed) many times without parsing
+the tsv again.
+
+The rows are stored already converted, exactly as convert_observation() and convert_checklist() produce them: integer
+ids, protocol codes, timestamps and durations. The dataset is hive partitioned by year and country code, so
+year=2019/country_code=US/part-0.parquet and so on, which lets anything reading it skip whole directories, for
+example with pyarrow.dataset.dataset(path, partitioning='hive').to_table(filter=...).
+"""
+import argparse
+import os
+import re
+from datetime import datetime
+
+# Rows in each Parquet row group.
+ROW_GROUP_ROWS = 100000
+
+# Most files open at once while writing, one per year and country being written to.
+MAX_OPEN_FILES = 512
+
+# Observation fields, then checklist fields, as in ParsedRow and ParsedChecklist.
+OBSERVATION_FIELDS = (
+    ("observation_id", "int64"), ("number_observed", "int32"), ("is_x", "bool"), ("age_sex", "string"),
+    ("species_comments", "string"), ("scientific_name", "string"), ("subspecies_scientific_name", "string"),
+    ("has_media", "bool"), ("last_edit", "timestamp"))
+CHECKLIST_FIELDS = (
+    ("checklist_id", "int64"), ("start", "timestamp"), ("duration", "duration"), ("checklist_comments", "string"),
+    ("distance", "decimal"), ("area", "decimal"), ("number_of_observers", "int32"), ("complete_checklist", "bool"),
+    ("group_id", "int64"), ("approved", "bool"), ("reviewed", "bool"), ("reason", "string"), ("protocol", "string"),
+    ("project_code", "string"), ("observer_id", "int64"), ("lat", "float64"), ("lon", "float64"),
+    ("locality_name", "string"), ("locality_id", "int64"), ("locality_type", "string"), ("state_code", "string"),
+    ("state_province", "string"), ("county_code", "string"), ("county", "string"), ("country_code", "string"),
+    ("country", "string"))
+
+# Names of the files in each partition's directory, numbered in the order they're written.
+BASENAME_TEMPLATE = "part-{i}.parquet"
+
+# Partition columns. country_code is one of the CHECKLIST_FIELDS, year comes from the checklist's start.
+PARTITION_FIELDS = (("year", "int16"), ("country_code", "string"))
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is only needed for Parquet.
+    Returns:
+        The pyarrow and pyarrow.dataset modules.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError("Parquet datasets require the pyarrow package: pip install pyarrow")
+    return pyarrow, pyarrow.dataset
+
+
+def arrow_type(pa, name):
+    types = {
+        "int16": pa.int16(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "bool": pa.bool_(),
+        "string": pa.string(),
+        "float64": pa.float64(),
+        # Same as the database's Numeric(16, 6).
+        "decimal": pa.decimal128(16, 6),
+        "timestamp": pa.timestamp('s'),
+        "duration": pa.duration('s'),
+    }
+    return types[name]
+
+
+def arrow_schema(pa):
+    """
+    Schema of the dataset, without the partition columns, which pyarrow keeps in the directory names.
+    """
+    return pa.schema([(name, arrow_type(pa, t)) for name, t in OBSERVATION_FIELDS + CHECKLIST_FIELDS])
+
+
+def batch_to_record_batch(pa, schema, batch):
+    """
+    Turns a batch of parsed rows into an Arrow record batch, with a year column to partition on.
+    Args:
+        pa (module): pyarrow.
+        schema (Schema): from arrow_schema().
+        batch (list(ParsedRow)): rows from RowDecoder.decode().
+    """
+    observation_columns = [[] for _ in OBSERVATION_FIELDS]
+    checklists = []
+    years = []
+    for p in batch:
+        for column, value in zip(observation_columns, p):
+            column.append(value)
+        c = p.checklist
+        checklists.append(c)
+        years.append(c.start.year if c.start is not None else None)
+    # ParsedRow's last field is the checklist, which zip() leaves out.
+    checklist_columns = list(zip(*checklists)) if checklists else [[] for _ in CHECKLIST_FIELDS]
+    arrays = [pa.array(values, type=field.type)
+              for values, field in zip(observation_columns + checklist_columns, schema)]
+    arrays.append(pa.array(years, type=pa.int16()))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema.append(pa.field("year", pa.int16())))
+
+
+def dataset_partitioning(pa, ds):
+    return ds.partitioning(pa.schema([(name, arrow_type(pa, t)) for name, t in PARTITION_FIELDS]), flavor='hive')
+
+
+def convert(batches, out_path):
+    """
+    Writes parsed rows to a Parquet dataset partitioned by year and country code.
+    Args:
+        batches (iterable): (batch, end offset) tuples, from ebird_data_parse.read_batches() or parallel_parse.
+        out_path (str): directory to write the dataset to, which has to be empty or not exist yet.
+    Returns:
+        The number of rows written.
+    Raises:
+        ValueError: out_path already has something in it.
+    """
+    # Files left from an earlier conversion would be read along with the new ones, and their rows loaded twice.
+    if os.path.isdir(out_path) and os.listdir(out_path):
+        raise ValueError(f"{out_path} isn't empty, convert into a new directory or delete the old dataset first.")
+    pa, ds = import_pyarrow()
+    schema = arrow_schema(pa)
+    written_schema = schema.append(pa.field("year", pa.int16()))
+    count = 0
+
+    def record_batches():
+        nonlocal count
+        for batch, _ in batches:
+            count += len(batch)
+            yield batch_to_record_batch(pa, schema, batch)
+            print(f"{curr_time()} Converted: {count}")
+
+    # Rows are written in the order they're parsed in, so the rows of a checklist stay together, see read_dataset().
+    ds.write_dataset(record_batches(), out_path, schema=written_schema, format='parquet',
+                     partitioning=dataset_partitioning(pa, ds), basename_template=BASENAME_TEMPLATE,
+                     use_threads=False, preserve_order=True,
+                     max_rows_per_group=ROW_GROUP_ROWS, min_rows_per_group=ROW_GROUP_ROWS,
+                     max_open_files=MAX_OPEN_FILES, existing_data_behavior='error')
+    return count
+
+
+def is_dataset(path):
+    """
+    Whether a path given to the loader is a converted dataset rather than an eBird data file.
+    """
+    return os.path.isdir(path)
+
+
+def dataset_files(path):
+    """
+    The dataset's files in the order they were written in: by partition, then by their number, where plain sorting
+    would put part-10.parquet before part-2.parquet. A partition gets more than one file when it's closed to stay
+    under MAX_OPEN_FILES, and a checklist can be split across the end of one and the start of the next.
+    """
+    files = []
+    for directory, _, names in os.walk(path):
+        for name in names:
+            if name.endswith(".parquet"):
+                files.append(os.path.join(directory, name))
+    return sorted(files, key=lambda f: (os.path.dirname(f), [int(n) for n in re.findall(r"\d+", os.path.basename(f))]))
+
+
+def column_values(column, arrow_type_name):
+    """
+    The values of an Arrow array as a list of Python objects.
+    Making datetimes is slow, but the rows of a checklist usually share their last edit time, so each distinct
+    timestamp is only converted once.
+    """
+    if arrow_type_name != "timestamp":
+        return column.to_pylist()
+    encoded = column.dictionary_encode()
+    values = encoded.dictionary.to_pylist()
+    values.append(None)
+    return [values[i] for i in encoded.indices.fill_null(len(values) - 1).to_pylist()]
+
+
+def record_batch_to_rows(pc, record_batch, row_class, checklist_class, last_checklist=None):
+    """
+    Turns an Arrow record batch of the dataset back into parsed rows.
+    Only the first row of each checklist has its checklist columns converted to Python objects, as that's where
+    most of the time would go otherwise.
+    Args:
+        pc (module): pyarrow.compute.
+        record_batch (RecordBatch): rows of the dataset.
+        row_class (type): ParsedRow.
+        checklist_class (type): ParsedChecklist.
+        last_checklist (ParsedChecklist, optional): the previous batch's last checklist, which the first rows may be on.
+    Returns:
+        A list of row_class.
+    """
+    n = record_batch.num_rows
+    if n == 0:
+        return []
+    ids = record_batch.column("checklist_id")
+    # Positions of the rows where the checklist changes.
+    starts = [0] + [i + 1 for i in pc.indices_nonzero(pc.not_equal(ids.slice(1), ids.slice(0, n - 1))).to_pylist()]
+    checklist_columns = record_batch.select([name for name, _ in CHECKLIST_FIELDS]).take(starts).to_pydict()
+    checklists = [checklist_class(*values) for values in zip(*checklist_columns.values())]
+    if last_checklist is not None and checklists[0].checklist_id == last_checklist.checklist_id:
+        checklists[0] = last_checklist
+    observations = zip(*(column_values(record_batch.column(name), t) for name, t in OBSERVATION_FIELDS))
+    rows = []
+    for checklist, begin, end in zip(checklists, starts, starts[1:] + [n]):
+        for _ in range(end - begin):
+            rows.append(row_class(*next(observations), checklist))
+    return rows
+
+
+def read_dataset(path, row_class, checklist_class, batch_size, start_row=0, filter=None):
+    """
+    Reads a dataset written by convert() back in as batches of parsed rows, without any text parsing.
+    Rows on the same checklist share one checklist_class instance, like they do coming from the tsv.
+    Args:
+        path (str): dataset directory.
+        row_class (type): ParsedRow, the type of the rows to yield.
+        checklist_class (type): ParsedChecklist, the type of their checklists.
+        batch_size (int): number of rows in each batch.
+        start_row (int, optional): skip this many rows, such as the row count from a checkpoint.
+        filter (Expression, optional): pyarrow.dataset filter, to load only some of the data.
+    Returns:
+        A generator of (batch, rows read) tuples. The row count stands in for the byte offset of a tsv file.
+    """
+    pa, ds = import_pyarrow()
+    import pyarrow.compute as pc
+    dataset = ds.dataset(dataset_files(path), format='parquet', partitioning=dataset_partitioning(pa, ds),
+                         partition_base_dir=path)
+    observation_names = [name for name, _ in OBSERVATION_FIELDS]
+    checklist_names = [name for name, _ in CHECKLIST_FIELDS]
+    skip = start_row
+    count = 0
+    batch = []
+    last_checklist = None
+    # Reading the files in the order they were written, and each one from start to finish, keeps the rows of a checklist
+    # together and makes start_row mean the same thing every time.
+    scanner = dataset.scanner(columns=observation_names + checklist_names, filter=filter, batch_size=batch_size,
+                              use_threads=False)
+    for record_batch in scanner.to_batches():
+        if skip >= record_batch.num_rows:
+            skip -= record_batch.num_rows
+            count += record_batch.num_rows
+            continue
+        if skip:
+            record_batch = record_batch.slice(skip)
+            count += skip
+            skip = 0
+        rows = record_batch_to_rows(pc, record_batch, row_class, checklist_class, last_checklist)
+        if rows:
+            last_checklist = rows[-1].checklist
+        for row in rows:
+            batch.append(row)
+            count += 1
+            if len(batch) == batch_size:
+                yield batch, count
+                batch = []
+    if batch:
+        yield batch, count
+
+
+def curr_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Convert the eBird dataset to a Parquet dataset that the loader can read.")
+    parser.add_argument('-f', '--file', dest="input_file", help="Path to ebird datafile, which can be a .txt, .gz, .zst or the release .tar.",
+                        metavar="INFILE", required=True)
+    parser.add_argument('-o', '--out', dest="out_path", help="Directory to write the Parquet dataset to.", metavar="DIR",
+                        required=True)
+    parser.add_argument('-c', '--csv', dest="csv_path", help="Path to the ebird taxonomy csv.", metavar="CSVPATH",
+                        required=True)
+    parser.add_argument('-w', '--workers', dest="workers", help="Number of processes to parse the data file with.", metavar="N",
+                        type=int, required=False, default=1)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # Imported here, as the loader imports this module to read datasets.
+    import ebird_data_parse
+    import parallel_parse
+    options = parse_command_line()
+    species, subspecies = ebird_data_parse.parse_ebird_taxonomy(options.csv_path)
+    species_sci_names = {s["scientific_name"] for s in species.values()}
+    subspecies_sci_names = {s["scientific_name"] for s in subspecies.values()}
+    print(f"Start time: {curr_time()}")
+    if options.workers > 1:
+        batches = parallel_parse.parallel_batches(options.input_file, 0, options.workers, ebird_data_parse.RowDecoder,
+                                                  species_sci_names, subspecies_sci_names, ebird_data_parse.COMMIT_BATCH)
+    else:
+        batches = ebird_data_parse.read_batches(options.input_file, 0, species_sci_names, subspecies_sci_names)
+    rows = convert(batches, options.out_path)
+    print(f"{curr_time()} Wrote {rows} rows to {options.out_path}.")
@@ -0,0 +1,145 @@
+"""
+Native PostgreSQL range partitioning of the checklist and observation tables by year.
+
+checklist is partitioned on start_date_time and observation on observation_date, which is a copy of its checklist's
+start_date_time, so an observation always lands in the same year as its checklist. PostgreSQL requires the partition
+column to be part of the primary key, so the keys become (checklist, start_date_time) and
+(observation, observation_date), and the observation to checklist foreign key uses both columns.
+Partitions are named like checklist_y2019 and are created by PartitionManager as the loader comes across new years.
+
+Nothing is unique on checklist or observation alone any more, so an upsert of a row whose date has changed doesn't
+conflict with the stored one and inserts a second copy. Incremental loads move rows with an edited date first, see
+incremental; anything else that upserts into these tables has to as well.
+"""
+from sqlalchemy import text
+
+# Partitioned tables and the column they are partitioned on.
+PARTITION_COLUMNS = {
+    'checklist': 'start_date_time',
+    'observation': 'observation_date',
+}
+
+# The observation to checklist foreign key has to include the partition column on both sides.
+CHECKLIST_FOREIGN_KEY = ("observation_checklist_id_fkey",
+                         "ALTER TABLE observation ADD CONSTRAINT observation_checklist_id_fkey "
+                         "FOREIGN KEY (checklist_id, observation_date) REFERENCES checklist (checklist, start_date_time) "
+                         "DEFERRABLE INITIALLY DEFERRED")
+
+
+def is_partitioned(engine):
+    """
+    Whether the checklist table in the database is a partitioned one.
+    """
+    with engine.connect() as conn:
+        relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('checklist')")).scalar()
+    return relkind == 'p'
+
+
+def table_sql(table, dialect):
+    """
+    CREATE TABLE statement for the partitioned version of a table from the models, without indexes or foreign keys.
+    Args:
+        table (Table): checklist or observation table.
+        dialect (Dialect): the engine's dialect, to render the column types.
+    """
+    partition_column = PARTITION_COLUMNS[table.name]
+    columns = []
+    for column in table.columns:
+        not_null = " NOT NULL" if not column.nullable or column.name == partition_column else ""
+        columns.append(f"{column.name} {column.type.compile(dialect=dialect)}{not_null}")
+    primary_key = [c.name for c in table.primary_key.columns] + [partition_column]
+    columns.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+    return f"CREATE TABLE {table.name} ({', '.join(columns)}) PARTITION BY RANGE ({partition_column})"
+
+
+def foreign_key_statements(table, foreign_key_name, add_foreign_key_sql):
+    """
+    The (name, ALTER TABLE statement) pairs for a partitioned table's foreign keys.
+    NOT VALID isn't allowed on partitioned tables, so these are checked as they're added.
+    Args:
+        table (Table): checklist or observation table.
+        foreign_key_name (function): names a foreign key constraint, see database_setup.
+        add_foreign_key_sql (function): renders a foreign key constraint, see database_setup.
+    """
+    statements = []
+    for fk in table.foreign_key_constraints:
+        if fk.elements[0].column.table.name in PARTITION_COLUMNS:
+            statements.append(CHECKLIST_FOREIGN_KEY)
+        else:
+            statements.append((foreign_key_name(fk), add_foreign_key_sql(fk, not_valid=False)))
+    return statements
+
+
+def conflict_targets(merge_sql):
+    """
+    Rewrites the bulk loader's ON CONFLICT clauses to use the partitioned tables' primary keys.
+    These only match rows with the same date, so upserts need incremental.CHECKLIST_MOVE_SQL and the rest first.
+    """
+    return tuple(
+        statement.replace("ON CONFLICT (checklist)", "ON CONFLICT (checklist, start_date_time)")
+                 .replace("ON CONFLICT (observation)", "ON CONFLICT (observation, observation_date)")
+        for statement in merge_sql)
+
+
+def partition_name(table, year):
+    return f"{table}_y{year}"
+
+
+def create_partition_sql(table, year):
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(table, year)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')")
+
+
+def batch_years(batch):
+    """
+    The years of all of the checklists in a batch of parsed rows.
+    """
+    years = set()
+    last_checklist = None
+    for p in batch:
+        if p.checklist is not last_checklist:
+            last_checklist = p.checklist
+            # Checklists without a date can't go in any partition, and will be rejected by the NOT NULL.
+            if p.checklist.start is not None:
+                years.add(p.checklist.start.year)
+    return years
+
+
+class PartitionManager:
+    """
+    Creates the yearly partitions of checklist and observation as they're needed.
+    Partitions are created on a separate connection and committed straight away, so they outlive a failed batch.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.years = set()
+        with engine.connect() as conn:
+            existing = conn.execute(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass('checklist')")).scalars()
+            for name in existing:
+                if name.startswith('checklist_y'):
+                    self.years.add(int(name.rsplit('_y', 1)[1]))
+
+    def ensure(self, years):
+        """
+        Makes sure both tables have a partition for each of the years.
+        """
+        missing = sorted(set(years) - self.years)
+        if not missing:
+            return
+        with self.engine.begin() as conn:
+            for year in missing:
+                for table in PARTITION_COLUMNS:
+                    conn.execute(text(create_partition_sql(table, year)))
+        self.years.update(missing)
+
+
+def detach_partition(engine, table, year):
+    """
+    Detaches a year from a partitioned table, leaving it as a table of its own that can be archived or dropped.
+    Observations have to be detached before their checklists, because of the foreign key.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {partition_name(table, year)}"))
@@ -0,0 +1,203 @@
+"""
+Profiles the stages of a load, see metrics, so it's possible to see what the time in each of them goes on.
+
+A StageProfiler is handed to metrics.configure(), and every stage of the chosen batches, the first and then every Nth
+one after it, is profiled by whatever measures `with metrics.stage('name'):`. Everything profiled for a stage is added
+up across the batches and written to DIR/<stage>.folded when the load finishes, as collapsed stacks: one line per
+distinct call stack, its frames separated by semicolons and followed by a weight in microseconds. That's what
+flamegraph.pl, inferno and speedscope all read, so each stage can be looked at as a flame graph.
+
+There are two ways of profiling:
+    sample      samples the call stack about every SAMPLE_SECONDS of CPU time, from a SIGPROF timer, which hardly
+                slows anything down. Stacks are whole, back to the start of the program. Only the main thread is seen.
+    cprofile    cProfile, which sees every call, but makes lots of small calls several times slower. It only records
+                who called whom, so the stacks in .folded are pieced back together from that; the exact numbers
+                are in DIR/<stage>.prof, for pstats or snakeviz.
+
+Stages that run inside other stages are profiled as part of the outer one. With parallel_parse, parsing happens in
+other processes, so parse only shows the waiting for them; profile the parser with one worker.
+"""
+import cProfile
+import os
+import pstats
+import signal
+from collections import Counter
+
+# CPU seconds between samples.
+SAMPLE_SECONDS = 0.001
+
+# Paths of the cProfile call graph worth less than this many microseconds aren't followed any further.
+MIN_MICROSECONDS = 1
+
+PROFILERS = ("sample", "cprofile")
+
+
+def frame_name(name, file_path, line):
+    """
+    How a function appears in the stacks, which can't have semicolons in them.
+    """
+    if file_path == '~':
+        # cProfile's name for anything built in.
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(file_path)}:{line})"
+    return label.replace(';', ':')
+
+
+class Sampler:
+    """
+    Counts the stacks the main thread is in at each tick of a SIGPROF timer.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        signal.signal(signal.SIGPROF, self.sample)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(frame_name(code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.setitimer(signal.ITIMER_PROF, SAMPLE_SECONDS, SAMPLE_SECONDS)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+def sampled_weights(stacks):
+    """
+    Sampled stacks' weights in microseconds, from how many times each was sampled.
+    """
+    weight = round(SAMPLE_SECONDS * 1e6)
+    return {stack: samples * weight for stack, samples in stacks.items()}
+
+
+class CallProfiler:
+    """
+    cProfile, with its calls added up across everything it's been started for.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def folded(self):
+        """
+        Stacks pieced together from the call graph. A function called from several places has its time split between
+        them in proportion to how much of it came from each, for every function it calls as well.
+        """
+        stats = pstats.Stats(self.profile).stats
+        callees = {}
+        for function, (_, _, _, _, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((function, edge[3]))
+        stacks = Counter()
+
+        def visit(function, stack, share):
+            self_seconds = stats[function][2]
+            stack = stack + [frame_name(function[2], function[0], function[1])]
+            stacks[';'.join(stack)] += self_seconds * share * 1e6
+            for callee, seconds in callees.get(function, ()):
+                path_seconds = seconds * share
+                if path_seconds * 1e6 < MIN_MICROSECONDS or callee in on_stack:
+                    continue
+                on_stack.add(callee)
+                visit(callee, stack, path_seconds / max(stats[callee][3], 1e-9))
+                on_stack.discard(callee)
+
+        for function, (_, _, _, _, callers) in stats.items():
+            # Where the profile started from, which has no callers it saw.
+            if not callers:
+                on_stack = {function}
+                visit(function, [], 1.0)
+        return {stack: round(weight) for stack, weight in stacks.items() if round(weight) > 0}
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class StageProfiler:
+    """
+    Profiles the stages of the first batch and of every Nth one after it, with a profiler of its own for each stage.
+    Args:
+        directory (str): where to write each stage's .folded, and .prof with cprofile.
+        kind (str, optional): one of PROFILERS.
+        every (int, optional): profile every Nth batch, 1 for all of them.
+    """
+
+    def __init__(self, directory, kind="sample", every=10):
+        if kind not in PROFILERS:
+            raise ValueError(f"Unknown profiler {kind}, it can be one of {PROFILERS}.")
+        self.directory = directory
+        self.kind = kind
+        self.every = max(every, 1)
+        self.batch = 0
+        self.profiled_batches = 0
+        self.profilers = {}
+        # The stage being profiled, if any, as only one profiler can be running at a time.
+        self.running = None
+        if kind == "sample":
+            # The timer only ever samples the main thread, so there's only one Sampler, tagging stacks by stage.
+            self.sampler = Sampler()
+
+    def active(self):
+        return self.batch % self.every == 0
+
+    def start(self, name):
+        """
+        Starts profiling stage name, if this batch is being profiled.
+        Returns:
+            True if it was started, in which case stop() has to be called at the end of the stage.
+        """
+        if self.running is not None or not self.active():
+            return False
+        self.running = name
+        if self.kind == "sample":
+            self.sampler.stacks = self.profilers.setdefault(name, Counter())
+            self.sampler.start()
+        else:
+            self.profilers.setdefault(name, CallProfiler()).start()
+        return True
+
+    def stop(self, name):
+        if self.kind == "sample":
+            self.sampler.stop()
+        else:
+            self.profilers[name].stop()
+        self.running = None
+
+    def batch_done(self):
+        if self.active():
+            self.profiled_batches += 1
+        self.batch += 1
+
+    def write(self):
+        """
+        Writes what each stage was doing to the directory.
+        Returns:
+            The paths written.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        for name, profiler in self.profilers.items():
+            if self.kind == "sample":
+                folded = sampled_weights(profiler)
+            else:
+                folded = profiler.folded()
+                paths.append(os.path.join(self.directory, f"{name}.prof"))
+                profiler.dump(paths[-1])
+            paths.append(os.path.join(self.directory, f"{name}.folded"))
+            with open(paths[-1], 'w') as f:
+                for stack, weight in sorted(folded.items()):
+                    f.write(f"{stack} {weight}\n")
+        print(f"Profiles of {self.profiled_batches} batches written to {', '.join(paths) or 'nothing'}.")
+        return paths
@@ -0,0 +1,105 @@
+"""
+Keeps bad rows from stopping a load.
+
+A line that can't be parsed, or a row the database won't accept, is written to a quarantine file along with the error
+and where it came from, and the load carries on. Rows the database rejects are found by splitting the batch they were
+in in half, and in half again, until the rows at fault are on their own. Quarantined rows can be looked at, fixed and
+loaded later.
+
+Errors that are likely to go away, like a dropped connection or a deadlock, are retried instead, waiting twice as long
+each time, up to MAX_RETRIES times.
+"""
+import json
+import os
+import traceback
+
+# Times a batch is retried after a transient error before the load gives up.
+MAX_RETRIES = 8
+
+# Wait before the first retry, doubled for each retry after that, up to MAX_BACKOFF_SECONDS.
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 60
+
+
+def backoff(retry):
+    """
+    Seconds to wait before retry number retry, counting from 0.
+    """
+    return min(BACKOFF_SECONDS * 2 ** retry, MAX_BACKOFF_SECONDS)
+
+
+def row_values(p):
+    """
+    A parsed row and its checklist as a dict, to write to the quarantine file.
+    """
+    values = p._asdict()
+    values['checklist'] = p.checklist._asdict()
+    return values
+
+
+class Quarantine:
+    """
+    A JSON lines file of rejected lines and rows.
+    Args:
+        file_path (str): file to append to. Worker processes can append to the same file at the same time.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.count = 0
+
+    def write(self, record):
+        data = (json.dumps(record, default=str) + "\n").encode('utf-8')
+        # A single write to a file opened for appending, so records from different processes never interleave.
+        fd = os.open(self.file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self.count += 1
+
+    def add_count(self, count):
+        """
+        Counts records that worker processes wrote to the file, as their counts stay in those processes.
+        """
+        self.count += count
+
+    def add_line(self, offset, line, error):
+        """
+        Quarantines a line that couldn't be parsed.
+        Args:
+            offset (int): byte offset of the line in the uncompressed data.
+            line (bytes or str): the line.
+            error (Exception): what went wrong parsing it.
+        """
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        self.write({"kind": "parse", "byte_offset": offset, "error": error_text(error), "line": line})
+
+    def add_rows(self, rows, first_row, error):
+        """
+        Quarantines parsed rows that the database wouldn't accept.
+        Args:
+            rows (list(ParsedRow)): the rows.
+            first_row (int): row number of the first of them in the data file, counting from 1 after the header.
+            error (Exception): what the database said.
+        """
+        for i, p in enumerate(rows):
+            self.write({"kind": "write", "row": first_row + i, "error": error_text(error), "values": row_values(p)})
+
+
+def error_text(error):
+    return "".join(traceback.format_exception_only(type(error), error)).strip()
+
+
+# Where bad rows go in the current load, or None to stop the load on the first one.
+current = None
+
+
+def configure(file_path):
+    """
+    Turns quarantining on, in this process, for file_path, or off if it is None.
+    """
+    global current
+    current = Quarantine(file_path) if file_path is not None else None
+    return current
@@ -0,0 +1,421 @@
+"""
+Answers the questions asked over and over again, such as which species have been seen at a locality, an observer's
+checklists, or the latest sightings in a county, from a cache in front of the database.
+
+Results are kept in memory, least recently used first out, within a number of entries and of bytes, and can also be
+kept on disk in an SQLite file, so they survive restarts and can be shared by several processes on the same machine.
+
+A result is never served once a load has changed what it was worked out from. Every batch a loader commits adds one to
+the generation of each state and county it had rows in, and of the "*" scope, in the cache_generation table, in the
+same transaction, and sends a notification. Each cached result records the generations of the scopes it depends on
+(the county for a locality or a county's sightings, "*" for anything that isn't limited to a region) and is only used
+while they're unchanged. The service listens for the notifications, which PostgreSQL only sends once the batch has
+committed, and reads the generations again when one arrives, so checking a result is still fresh doesn't need to go to
+the database at all. Deletions add one to every scope. An incremental load can move a stored checklist, or an
+observation, somewhere else, so it also adds one to the scopes they were in before the batch, see stored_scopes().
+"""
+import argparse
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.orm import Session
+from models import Checklist, Location, Observation
+
+# Scope of results that can change with a batch from anywhere.
+ALL_REGIONS = "*"
+
+# Channel the loaders notify on when they commit a batch.
+CHANNEL = "cache_generation"
+
+# Limits of the in memory cache.
+MAX_ENTRIES = 10000
+MAX_BYTES = 64 << 20
+
+# Limit of the on disk cache.
+MAX_DISK_BYTES = 1 << 30
+
+# Adds one to the generation of each scope and notifies listeners, who'll only hear of it once the transaction commits.
+# Scopes are locked in order, so writers committing at the same time can't deadlock on them.
+BUMP_SQL = """WITH bumped AS (
+        INSERT INTO cache_generation (scope, generation)
+        SELECT s, 1 FROM unnest(CAST(%(scopes)s AS text[])) AS s ORDER BY s
+        ON CONFLICT (scope) DO UPDATE SET generation = cache_generation.generation + 1
+        RETURNING scope)
+    SELECT pg_notify('cache_generation', '')"""
+
+# The same for asyncpg, which takes numbered parameters.
+ASYNC_BUMP_SQL = BUMP_SQL.replace("%(scopes)s", "$1")
+
+BUMP_ALL_SQL = """WITH bumped AS (
+        UPDATE cache_generation SET generation = generation + 1 RETURNING scope)
+    SELECT pg_notify('cache_generation', '')"""
+
+# The states and counties that the staged checklists, and the checklists of the staged observations, are stored in.
+STORED_SCOPES_SQL = """SELECT DISTINCT unnest(ARRAY[l.state_province_id, l.county_id])
+    FROM checklist c JOIN location l ON l.id = c.location_id
+    WHERE c.checklist IN (
+        SELECT checklist FROM stage_checklist
+        UNION SELECT o.checklist_id FROM observation o JOIN stage_observation s ON s.observation = o.observation)"""
+
+
+def batch_scopes(batch, stored=()):
+    """
+    The scopes a batch of parsed rows changes: the states and counties of its checklists, and ALL_REGIONS.
+    Args:
+        batch (list(ParsedRow)): the rows.
+        stored (iterable, optional): scopes the rows were in before the batch, from stored_scopes().
+    Returns:
+        A sorted list, empty for an empty batch.
+    """
+    if not batch:
+        return []
+    scopes = {ALL_REGIONS}
+    scopes.update(stored)
+    last_checklist = None
+    for p in batch:
+        c = p.checklist
+        if c is not last_checklist:
+            last_checklist = c
+            scopes.add(c.state_code)
+            scopes.add(c.county_code)
+    scopes.discard('')
+    return sorted(scopes)
+
+
+def stored_scopes(cursor):
+    """
+    The states and counties the staged rows' checklists are in before they're merged, for a merge that can move them to
+    another location, so results about where they used to be aren't served either. Run in the batch's transaction.
+    Returns:
+        A list of scopes.
+    """
+    cursor.execute(STORED_SCOPES_SQL)
+    return [scope for scope, in cursor.fetchall()]
+
+
+def bump_orm(session, scopes):
+    """
+    Adds the generation bump to the session's current transaction.
+    """
+    if scopes:
+        session.execute(text(BUMP_SQL.replace("%(scopes)s", ":scopes")), {"scopes": scopes})
+
+
+def bump_dbapi(cursor, scopes):
+    """
+    Runs the generation bump on a DBAPI cursor, in whatever transaction it's in.
+    """
+    if scopes:
+        cursor.execute(BUMP_SQL, {"scopes": scopes})
+
+
+def bump_all(cursor):
+    """
+    Adds one to every generation, for changes that can't easily be pinned down to regions, like deletions.
+    """
+    cursor.execute(BUMP_ALL_SQL)
+
+
+class MemoryCache:
+    """
+    Least recently used cache, limited to a number of entries and a total size.
+    Args:
+        max_entries (int, optional): most entries to keep.
+        max_bytes (int, optional): most bytes of pickled values to keep.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Key to (generations, value, size), least recently used first.
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key):
+        """
+        Returns:
+            The (generations, value) stored for key, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key, generations, value, size):
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = (generations, value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+class DiskCache:
+    """
+    The same as MemoryCache, in an SQLite file, with values pickled.
+    Args:
+        path (str): SQLite database file, created if it doesn't exist.
+        max_bytes (int, optional): most bytes of pickled values to keep.
+    """
+
+    def __init__(self, path, max_bytes=MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, generations BLOB, "
+                                "value BLOB, size INTEGER, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+
+    def get(self, key):
+        row = self.connection.execute("SELECT generations, value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        return pickle.loads(row[0]), pickle.loads(row[1])
+
+    def put(self, key, generations, pickled, size):
+        if size > self.max_bytes:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                (key, pickle.dumps(generations), pickled, size, time.time()))
+        total = self.connection.execute("SELECT sum(size) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Least recently used first, until it's back under the limit.
+        evicted = []
+        for old_key, old_size in self.connection.execute("SELECT key, size FROM entries ORDER BY used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((old_key,))
+            total -= old_size
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def discard(self, key):
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        self.connection.execute("DELETE FROM entries")
+
+
+class QueryService:
+    """
+    Cached queries of the database.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+        max_entries (int, optional): most results to keep in memory.
+        max_bytes (int, optional): most bytes of results to keep in memory.
+        disk_path (str, optional): also keep results in this SQLite file.
+        max_disk_bytes (int, optional): most bytes of results to keep on disk.
+    """
+
+    def __init__(self, engine, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, disk_path=None,
+                 max_disk_bytes=MAX_DISK_BYTES):
+        self.engine = engine
+        self.memory = MemoryCache(max_entries, max_bytes)
+        self.disk = DiskCache(disk_path, max_disk_bytes) if disk_path is not None else None
+        self.lock = threading.Lock()
+        self.listener = None
+        self.generations = {}
+        # A locality's county never changes, so these are kept for good.
+        self.counties = {}
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if self.disk is not None:
+            self.disk.connection.close()
+
+    def refresh(self):
+        """
+        Reads the generations again if a load has committed anything since they were last read.
+        Checking for a notification only looks at what's already arrived on the listening connection.
+        """
+        if self.listener is not None:
+            try:
+                self.listener.driver_connection.poll()
+            except Exception:
+                # Notifications may have been missed while the connection was down, so start again.
+                self.listener.invalidate()
+                self.listener = None
+        if self.listener is None:
+            # Kept checked out of the pool for as long as the service is running.
+            self.listener = self.engine.raw_connection()
+            self.listener.driver_connection.autocommit = True
+            # Listening first means a batch committed while the generations are being read can't be missed.
+            self.listener.cursor().execute(f"LISTEN {CHANNEL}")
+        elif not self.listener.driver_connection.notifies:
+            return
+        self.listener.driver_connection.notifies.clear()
+        cursor = self.listener.cursor()
+        cursor.execute("SELECT scope, generation FROM cache_generation")
+        self.generations = dict(cursor.fetchall())
+
+    def cached(self, name, params, scopes, run):
+        """
+        A result from the cache if it's still current, otherwise from run(), which is then cached.
+        Args:
+            name (str): name of the query.
+            params (tuple): its parameters, which have to have a stable repr().
+            scopes (sequence(str)): the scopes whose generations the result depends on.
+            run (function): called with a Session to work out the result.
+        """
+        key = f"{name}{params!r}"
+        with self.lock:
+            self.refresh()
+            generations = tuple(self.generations.get(scope, 0) for scope in scopes)
+            entry = self.memory.get(key)
+            if entry is None and self.disk is not None:
+                entry = self.disk.get(key)
+                if entry is not None:
+                    pickled = pickle.dumps(entry[1])
+                    self.memory.put(key, entry[0], entry[1], len(pickled))
+            if entry is not None and entry[0] == generations:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # The generations were read before the query ran, so if a batch commits in the meantime, the result is worked
+        # out again next time rather than being taken for newer than it is.
+        with Session(self.engine) as session:
+            value = tuple(tuple(row) for row in run(session))
+        pickled = pickle.dumps(value)
+        with self.lock:
+            self.memory.put(key, generations, value, len(pickled))
+            if self.disk is not None:
+                self.disk.put(key, generations, pickled, len(pickled))
+        return value
+
+    def county_of(self, locality_id):
+        county = self.counties.get(locality_id)
+        if county is None:
+            with Session(self.engine) as session:
+                county = session.execute(select(Location.county_id).where(Location.locality_id == locality_id)).scalar()
+            if county is not None:
+                self.counties[locality_id] = county
+        return county
+
+    def species_at_locality(self, locality_id):
+        """
+        Every species reported at a locality.
+        Returns:
+            A tuple of (scientific name, checklists reporting it, last reported) tuples, most reported first.
+        """
+        def run(session):
+            return session.execute(
+                select(Observation.species_id, func.count(func.distinct(Checklist.checklist)),
+                       func.max(Checklist.start_date_time))
+                .join(Checklist, Checklist.checklist == Observation.checklist_id)
+                .join(Location, Location.id == Checklist.location_id)
+                .where(Location.locality_id == locality_id, Observation.species_id.is_not(None))
+                .group_by(Observation.species_id)
+                .order_by(func.count(func.distinct(Checklist.checklist)).desc(), Observation.species_id))
+
+        county = self.county_of(locality_id)
+        scopes = (county,) if county is not None else (ALL_REGIONS,)
+        return self.cached("species_at_locality", (locality_id,), scopes, run)
+
+    def observer_checklists(self, observer_id, limit=100):
+        """
+        An observer's latest checklists.
+        Returns:
+            A tuple of (checklist, start, locality id, observations) tuples, latest first.
+        """
+        def run(session):
+            return session.execute(
+                select(Checklist.checklist, Checklist.start_date_time, Location.locality_id, func.count())
+                .join(Observation, Observation.checklist_id == Checklist.checklist)
+                .join(Location, Location.id == Checklist.location_id)
+                .where(Observation.observer_id == observer_id)
+                .group_by(Checklist.checklist, Checklist.start_date_time, Location.locality_id)
+                .order_by(Checklist.start_date_time.desc().nulls_last(), Checklist.checklist.desc())
+                .limit(limit))
+
+        return self.cached("observer_checklists", (observer_id, limit), (ALL_REGIONS,), run)
+
+    def latest_sightings(self, county_code, since=None, limit=100):
+        """
+        The latest sighting of each species in a county.
+        Args:
+            county_code (str): county code, such as US-NY-061.
+            since (datetime, optional): only sightings from this time on.
+            limit (int, optional): most species to return.
+        Returns:
+            A tuple of (scientific name, start, checklist, locality id) tuples, latest first.
+        """
+        def run(session):
+            latest = (select(Observation.species_id, Checklist.start_date_time, Checklist.checklist,
+                             Location.locality_id)
+                      .join(Checklist, Checklist.checklist == Observation.checklist_id)
+                      .join(Location, Location.id == Checklist.location_id)
+                      .where(Location.county_id == county_code, Observation.species_id.is_not(None),
+                             Checklist.start_date_time.is_not(None))
+                      .distinct(Observation.species_id)
+                      .order_by(Observation.species_id, Checklist.start_date_time.desc()))
+            if since is not None:
+                latest = latest.where(Checklist.start_date_time >= since)
+            latest = latest.subquery()
+            return session.execute(select(latest).order_by(latest.c.start_date_time.desc()).limit(limit))
+
+        return self.cached("latest_sightings", (county_code, since, limit), (county_code,), run)
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.memory.entries)} in memory ({self.memory.bytes} bytes)"
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Run the cached queries, for trying them out.")
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
+                        required=True)
+    parser.add_argument('--disk', dest="disk_path", help="Also cache results in this SQLite file.", metavar="PATH",
+                        default=None)
+    parser.add_argument('--locality', dest="locality_id", help="Species reported at a locality.", metavar="ID",
+                        type=int, default=None)
+    parser.add_argument('--observer', dest="observer_id", help="An observer's latest checklists.", metavar="ID",
+                        type=int, default=None)
+    parser.add_argument('--county', dest="county_code", help="Latest sightings in a county.", metavar="CODE",
+                        default=None)
+    parser.add_argument('--since', dest="since", help="Only sightings from this date on, with --county.",
+                        metavar="YYYY-MM-DD", type=datetime.fromisoformat, default=None)
+    parser.add_argument('--repeat', dest="repeat", help="Run each query this many times, to time the cache.",
+                        metavar="N", type=int, default=2)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    service = QueryService(create_engine(options.connection_url), disk_path=options.disk_path)
+    queries = []
+    if options.locality_id is not None:
+        queries.append(lambda: service.species_at_locality(options.locality_id))
+    if options.observer_id is not None:
+        queries.append(lambda: service.observer_checklists(options.observer_id))
+    if options.county_code is not None:
+        queries.append(lambda: service.latest_sightings(options.county_code, options.since))
+    for query in queries:
+        for i in range(options.repeat):
+            start = time.perf_counter()
+            rows = query()
+            print(f"{len(rows)} rows in {(time.perf_counter() - start) * 1000:.3f}ms")
+        for row in rows:
+            print("  ".join(str(v) for v in row))
+    print(service.stats())
+    service.close()
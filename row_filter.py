@@ -0,0 +1,152 @@
+"""
+Loads only part of the dataset, such as one state, a range of dates or a list of species, without parsing the rest.
+
+The filters are checked against the raw bytes of each line, before it is decoded or split up into fields, so lines
+that aren't wanted cost very little. When only a few values are wanted, a line that doesn't contain any of them
+anywhere, which is most lines for a single state or species, is thrown out with one substring search. The rest are
+split up to the last column a filter needs and the columns compared as bytes; ISO dates compare correctly as bytes.
+
+Parquet datasets from parquet_stage are filtered by pyarrow instead, with the same filters turned into a dataset
+expression by dataset_expression(), so whole partitions can be skipped.
+"""
+from datetime import datetime, timedelta
+
+# Filters with at most this many values look for them anywhere in the line before splitting it into columns.
+SUBSTRING_VALUES = 8
+
+# The columns each filter checks. A line is kept by the species filter if any of its columns is one of the names.
+COUNTRY_COLUMNS = ("COUNTRY CODE",)
+STATE_COLUMNS = ("STATE CODE",)
+DATE_COLUMN = "OBSERVATION DATE"
+SPECIES_COLUMNS = ("SCIENTIFIC NAME", "COMMON NAME", "SUBSPECIES SCIENTIFIC NAME", "SUBSPECIES COMMON NAME")
+
+
+class RowFilter:
+    """
+    Decides from the raw bytes of a line whether it should be loaded. Every filter given has to match.
+    Args:
+        header (list(str)): column names from the first line of the file.
+        countries (iterable(str), optional): country codes to keep, such as US.
+        states (iterable(str), optional): state or province codes to keep, such as US-NY.
+        since (date, optional): keep observations on or after this date.
+        until (date, optional): keep observations on or before this date.
+        species (iterable(str), optional): scientific or common names, of species or subspecies, to keep.
+    """
+
+    def __init__(self, header, countries=None, states=None, since=None, until=None, species=None):
+        self.countries = encode_values(countries)
+        self.states = encode_values(states)
+        self.species = encode_values(species)
+        self.since = since
+        self.until = until
+        # (column positions, values) for each filter on a set of values.
+        self.checks = []
+        # Substrings a line has to contain, one of each tuple, before it's worth splitting.
+        self.needles = []
+        for columns, values in ((COUNTRY_COLUMNS, self.countries), (STATE_COLUMNS, self.states),
+                                (SPECIES_COLUMNS, self.species)):
+            if values is None:
+                continue
+            self.checks.append((tuple(header.index(c) for c in columns), values))
+            if len(values) <= SUBSTRING_VALUES:
+                self.needles.append(tuple(b"\t" + v + b"\t" for v in values))
+        self.date_position = header.index(DATE_COLUMN)
+        self.since_bytes = since.isoformat().encode('ascii') if since is not None else None
+        self.until_bytes = until.isoformat().encode('ascii') if until is not None else None
+        positions = [p for columns, _ in self.checks for p in columns]
+        if since is not None or until is not None:
+            positions.append(self.date_position)
+        # Splitting stops after the last column any filter needs.
+        self.splits = max(positions) + 1 if positions else 0
+
+    def __bool__(self):
+        return self.splits > 0
+
+    def keep(self, line):
+        """
+        Args:
+            line (bytes): a single line of the tsv.
+        Returns:
+            True if the line passes every filter.
+        """
+        for needles in self.needles:
+            for needle in needles:
+                if needle in line:
+                    break
+            else:
+                return False
+        fields = line.split(b"\t", self.splits)
+        if len(fields) <= self.splits:
+            # Too short to be a row; let the decoder fail on it, so it's reported or quarantined like any other.
+            return True
+        for positions, values in self.checks:
+            for p in positions:
+                if fields[p] in values:
+                    break
+            else:
+                return False
+        if self.since_bytes is not None and fields[self.date_position] < self.since_bytes:
+            return False
+        if self.until_bytes is not None and fields[self.date_position] > self.until_bytes:
+            return False
+        return True
+
+
+def options_filters(options):
+    """
+    The filters from ebird.add_filter_arguments(), as RowFilter's keyword arguments.
+    """
+    return {"countries": options.countries, "states": options.states, "since": options.since,
+            "until": options.until, "species": options.species}
+
+
+def line_filter(header, filters):
+    """
+    Args:
+        header (list(str)): column names from the first line of the file.
+        filters (dict, optional): RowFilter's keyword arguments.
+    Returns:
+        A RowFilter, or None if filters doesn't filter anything, so callers can skip calling it.
+    """
+    if not filters:
+        return None
+    row_filter = RowFilter(header, **filters)
+    return row_filter if row_filter else None
+
+
+def dataset_expression(ds, countries=None, states=None, since=None, until=None, species=None):
+    """
+    The same filters as RowFilter, as a pyarrow.dataset expression for parquet_stage.read_dataset().
+    Common names aren't in the dataset, so species have to be given by their scientific names.
+    Args:
+        ds (module): pyarrow.dataset.
+    Returns:
+        The expression, or None if there's nothing to filter on.
+    """
+    expressions = []
+    if countries is not None:
+        expressions.append(ds.field("country_code").isin(sorted(countries)))
+    if states is not None:
+        expressions.append(ds.field("state_code").isin(sorted(states)))
+    if species is not None:
+        names = sorted(species)
+        expressions.append(ds.field("scientific_name").isin(names) | ds.field("subspecies_scientific_name").isin(names))
+    # The year partitions let pyarrow skip whole directories, as well as the rows outside the dates.
+    if since is not None:
+        expressions.append(ds.field("year") >= since.year)
+        expressions.append(ds.field("start") >= datetime.combine(since, datetime.min.time()))
+    if until is not None:
+        expressions.append(ds.field("year") <= until.year)
+        expressions.append(ds.field("start") < datetime.combine(until + timedelta(days=1), datetime.min.time()))
+    if not expressions:
+        return None
+    expression = expressions[0]
+    for e in expressions[1:]:
+        expression = expression & e
+    return expression
+
+
+def encode_values(values):
+    if values is None:
+        return None
+    return frozenset(v.strip().encode('utf-8') for v in values)
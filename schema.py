@@ -0,0 +1,112 @@
+"""
+Works out which version of the schema a database has from the tables and columns in it, so the loader and the CLI
+can tell an empty database, which can be created from scratch, from one that's up to date, which should be left alone,
+and from one made by an older version, which needs upgrading first.
+
+Every change to the models that a database needs to know about adds a version, identified by a column that was new
+in it. A database is at the last version for which it has that column and the columns of all the versions before it.
+
+Only the standard library is imported here, so checking the version is quick; the upgrades import what they need.
+"""
+
+# (version, table, column that's new in it, what changed), oldest first.
+VERSIONS = (
+    (1, 'observation', 'observation', "initial tables"),
+    (2, 'load_checkpoint', 'byte_offset', "load checkpoints"),
+    (3, 'observation', 'observation_date', "observation dates, for partitioning"),
+    (4, 'taxonomy_version', 'version', "taxonomy versions"),
+    (5, 'location', 'grid_cell', "location grid cells"),
+    (6, 'aggregate_region', 'region_code', "species by region and period rollups"),
+    (7, 'checklist', 'reason_id', "dictionary encoded columns"),
+    (8, 'cache_generation', 'scope', "query cache generations"),
+)
+
+CURRENT = VERSIONS[-1][0]
+
+# Which of the versions' columns are in the database, in the schema it'd be used from.
+COLUMNS_SQL = """SELECT table_name, column_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND (table_name, column_name) IN ({pairs})""".format(
+    pairs=", ".join(f"('{table}', '{column}')" for _, table, column, _ in VERSIONS))
+
+
+def version_of(cursor):
+    """
+    Args:
+        cursor (cursor): DBAPI cursor.
+    Returns:
+        The schema version of the database, 0 if it has none of the tables.
+    """
+    cursor.execute(COLUMNS_SQL)
+    present = set(cursor.fetchall())
+    version = 0
+    for number, table, column, _ in VERSIONS:
+        if (table, column) not in present:
+            break
+        version = number
+    return version
+
+
+def version(engine):
+    """
+    The same as version_of(), for an SQLAlchemy engine.
+    """
+    connection = engine.raw_connection()
+    try:
+        return version_of(connection.cursor())
+    finally:
+        connection.close()
+
+
+def describe(number):
+    if number == 0:
+        return "no schema"
+    return f"schema version {number} of {CURRENT} ({VERSIONS[number - 1][3]})"
+
+
+def check(engine):
+    """
+    Makes sure a database is either empty or up to date, before anything is created in it.
+    Returns:
+        True if the tables have to be created, False if they're already there.
+    Raises:
+        RuntimeError: if the database is at an older version, and has to be upgraded first.
+    """
+    number = version(engine)
+    if number == CURRENT:
+        return False
+    if number == 0:
+        return True
+    raise RuntimeError(f"The database has {describe(number)}, upgrade it with `python ebird.py init --upgrade` first.")
+
+
+def upgrade(engine):
+    """
+    Brings a database made by an older version up to date, one version at a time. Nothing is dropped, apart from the
+    text columns version 7 replaces with codes.
+    Returns:
+        The version it was at before.
+    """
+    import lookups
+    import models
+    import spatial
+    from sqlalchemy import text
+    start = version(engine)
+    if start == 0:
+        raise RuntimeError("There's no schema to upgrade, create one with `python ebird.py init`.")
+    # Tables that are missing are simply created, without the views, which need the upgraded columns.
+    for table in models.metadata.sorted_tables:
+        table.create(engine, checkfirst=True)
+    for number, table, column, description in VERSIONS[start:]:
+        print(f"Upgrading to schema version {number}: {description}.")
+        if number == 3:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE observation ADD COLUMN IF NOT EXISTS observation_date timestamptz"))
+                conn.execute(text("UPDATE observation o SET observation_date = c.start_date_time FROM checklist c "
+                                  "WHERE c.checklist = o.checklist_id"))
+        elif number == 5:
+            spatial.add_grid_cells(engine)
+        elif number == 7:
+            lookups.encode_existing(engine)
+    with engine.begin() as conn:
+        lookups.create_views(conn)
+    return start
@@ -0,0 +1,212 @@
+"""
+Spatial lookups of locations: everything in a bounding box, the nearest hotspots to a point and everything inside a
+polygon.
+
+The box and polygon lookups and the nearest neighbour search all go through the GiST index on Location.coords: the
+box with &&, the polygon with ST_Contains, and the nearest neighbours with the <-> operator in ORDER BY, which walks
+the index in distance order instead of measuring the distance to every location.
+
+Every location also has a grid cell, a fixed square of GRID_DEGREES on a side numbered from the south west corner,
+worked out when it's loaded. Grid cells are plain integers, so they can be grouped by, joined on, compared and cached
+without any geometry at all, and grid_cells() gives the cells covering a box.
+
+The ORM path writes points as EWKB, the format PostGIS stores them in, rather than as WKT. GeoAlchemy2 still sends
+it as hex text through ST_GeomFromEWKT, but that's decoded straight into the point's bytes, with no floating point
+numbers to parse. The bulk loaders COPY plain latitudes and longitudes instead and make the points in SQL.
+"""
+import argparse
+import math
+import struct
+from geoalchemy2 import WKBElement
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.orm import Session
+from models import Locality, LocalityType, Location
+
+SRID = 4326
+
+# Size of a grid cell, in degrees of latitude and longitude.
+GRID_DEGREES = 0.1
+GRID_ROWS = round(180 / GRID_DEGREES)
+GRID_COLUMNS = round(360 / GRID_DEGREES)
+
+# Metres in a degree of latitude, near enough, for turning a radius into a box around a point.
+METRES_PER_DEGREE = 111320
+
+# Locality type of eBird hotspots.
+HOTSPOT = 'H'
+
+# Little endian EWKB point with an SRID: byte order, geometry type with the SRID flag set, SRID, x, y.
+EWKB_POINT = struct.Struct('<BIIdd')
+EWKB_POINT_SRID_TYPE = 0x20000001
+
+# Same as grid_cell(), for locations loaded before grid cells were.
+GRID_CELL_SQL = (f"LEAST(floor((ST_Y(coords) + 90) / {GRID_DEGREES}::float8)::integer, {GRID_ROWS - 1}) * {GRID_COLUMNS} "
+                 f"+ LEAST(floor((ST_X(coords) + 180) / {GRID_DEGREES}::float8)::integer, {GRID_COLUMNS - 1})")
+
+
+def point_ewkb(lat, lon, srid=SRID):
+    """
+    A point as EWKB, ready to be assigned to a Geometry column, which sends it to PostGIS as hex. EWKB is lon/lat,
+    like WKT, and this is byte for byte what ST_AsEWKB() gives for the same point.
+    """
+    return WKBElement(EWKB_POINT.pack(1, EWKB_POINT_SRID_TYPE, srid, lon, lat), srid=srid, extended=True)
+
+
+def grid_cell(lat, lon):
+    """
+    The number of the grid cell a point is in, counting along rows of GRID_COLUMNS cells from -90, -180.
+    """
+    row = min(math.floor((lat + 90) / GRID_DEGREES), GRID_ROWS - 1)
+    column = min(math.floor((lon + 180) / GRID_DEGREES), GRID_COLUMNS - 1)
+    return row * GRID_COLUMNS + column
+
+
+def grid_cells(min_lon, min_lat, max_lon, max_lat):
+    """
+    Every grid cell that overlaps a box, as a list of cell numbers. A box with min_lon greater than max_lon crosses the
+    antimeridian, and covers the cells from min_lon east to 180 and from -180 east to max_lon.
+    """
+    if min_lat > max_lat:
+        raise ValueError(f"The box's min_lat, {min_lat}, is north of its max_lat, {max_lat}.")
+    first = grid_cell(min_lat, min_lon)
+    last = grid_cell(max_lat, max_lon)
+    first_column = first % GRID_COLUMNS
+    last_column = last % GRID_COLUMNS
+    if min_lon > max_lon:
+        columns = list(range(first_column, GRID_COLUMNS)) + list(range(0, last_column + 1))
+    else:
+        columns = range(first_column, last_column + 1)
+    return [row * GRID_COLUMNS + column for row in range(first // GRID_COLUMNS, last // GRID_COLUMNS + 1)
+            for column in columns]
+
+
+def make_point(lat, lon):
+    return func.ST_SetSRID(func.ST_MakePoint(lon, lat), SRID)
+
+
+def in_bbox(session, min_lon, min_lat, max_lon, max_lat, limit=None):
+    """
+    Locations inside a bounding box.
+    Args:
+        session (Session): SQLAlchemy session.
+        min_lon, min_lat, max_lon, max_lat (float): the box, in degrees.
+        limit (int, optional): most locations to return.
+    Returns:
+        A list of Locations.
+    """
+    box = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, SRID)
+    query = select(Location).where(Location.coords.op('&&')(box)).limit(limit)
+    return session.scalars(query).all()
+
+
+def nearest_hotspots(session, lat, lon, k=10, radius=None, hotspots_only=True):
+    """
+    The k locations nearest to a point, nearest first.
+    Args:
+        session (Session): SQLAlchemy session.
+        lat, lon (float): the point.
+        k (int, optional): number of locations to find.
+        radius (float, optional): only look this many metres from the point.
+        hotspots_only (bool, optional): only eBird hotspots, not personal locations.
+    Returns:
+        A list of (Location, distance in metres) tuples.
+    """
+    point = make_point(lat, lon)
+    distance = func.ST_DistanceSphere(Location.coords, point).label("distance")
+    query = select(Location, distance)
+    if hotspots_only:
+        query = (query.join(Locality, Locality.locality_id == Location.locality_id)
+                 .join(LocalityType, LocalityType.locality_type_id == Locality.locality_type_id)
+                 .where(LocalityType.locality_type == HOTSPOT))
+    if radius is not None:
+        # The box lets the index throw out everything far away before any distances are worked out.
+        dy = radius / METRES_PER_DEGREE
+        dx = min(dy / max(math.cos(math.radians(lat)), 1e-6), 180)
+        query = query.where(Location.coords.op('&&')(func.ST_Expand(point, dx, dy))).where(distance <= radius)
+    # <-> is in degrees rather than metres, which is plenty to pick out the nearest few with the index.
+    query = query.order_by(Location.coords.op('<->')(point)).limit(k)
+    return [(location, d) for location, d in session.execute(query)]
+
+
+def in_polygon(session, polygon_wkt, limit=None):
+    """
+    Locations inside a polygon.
+    Args:
+        session (Session): SQLAlchemy session.
+        polygon_wkt (str): the polygon (or multipolygon) as WKT, in lon/lat order.
+        limit (int, optional): most locations to return.
+    Returns:
+        A list of Locations.
+    """
+    polygon = func.ST_GeomFromText(polygon_wkt, SRID)
+    query = select(Location).where(func.ST_Contains(polygon, Location.coords)).limit(limit)
+    return session.scalars(query).all()
+
+
+def in_grid_cells(session, cells, limit=None):
+    """
+    Locations in any of the grid cells.
+    Args:
+        session (Session): SQLAlchemy session.
+        cells (iterable(int)): cell numbers from grid_cell() or grid_cells().
+        limit (int, optional): most locations to return.
+    Returns:
+        A list of Locations.
+    """
+    query = select(Location).where(Location.grid_cell.in_(list(cells))).limit(limit)
+    return session.scalars(query).all()
+
+
+def add_grid_cells(engine):
+    """
+    Adds the grid_cell column and its index to a location table made before there were grid cells, and fills it in.
+    Args:
+        engine (Engine): SQLAlchemy engine.
+    Returns:
+        The number of locations updated.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE location ADD COLUMN IF NOT EXISTS grid_cell integer"))
+        updated = conn.execute(text(f"UPDATE location SET grid_cell = {GRID_CELL_SQL} WHERE grid_cell IS NULL")).rowcount
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_location_grid_cell ON location (grid_cell)"))
+    return updated
+
+
+def describe(location, distance=None):
+    line = f"locality {location.locality_id} ({location.county_id}) cell {location.grid_cell}"
+    return line if distance is None else f"{line} {distance:.0f}m"
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Look up locations by area or distance.")
+    parser.add_argument('-s', '--sqlalchemy', dest="connection_url", help="SQLAlchemy connection URL.", metavar="URL",
+                        required=True)
+    parser.add_argument('--bbox', dest="bbox", help="Locations in a bounding box.", nargs=4, type=float,
+                        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"), default=None)
+    parser.add_argument('--near', dest="near", help="Hotspots nearest to a point.", nargs=2, type=float,
+                        metavar=("LAT", "LON"), default=None)
+    parser.add_argument('-k', dest="k", help="How many hotspots --near finds.", metavar="N", type=int, default=10)
+    parser.add_argument('--radius', dest="radius", help="Only find hotspots this many metres away with --near.",
+                        metavar="METRES", type=float, default=None)
+    parser.add_argument('--polygon', dest="polygon", help="Locations inside a polygon.", metavar="WKT", default=None)
+    parser.add_argument('--add-grid-cells', dest="add_grid_cells", action="store_true",
+                        help="Add grid cells to a database loaded before they existed.")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    engine = create_engine(options.connection_url)
+    if options.add_grid_cells:
+        print(f"Grid cells added to {add_grid_cells(engine)} locations.")
+    with Session(engine) as session:
+        if options.bbox is not None:
+            for location in in_bbox(session, *options.bbox):
+                print(describe(location))
+        if options.near is not None:
+            for location, distance in nearest_hotspots(session, *options.near, k=options.k, radius=options.radius):
+                print(describe(location, distance))
+        if options.polygon is not None:
+            for location in in_polygon(session, options.polygon):
+                print(describe(location))
@@ -0,0 +1,245 @@
+"""
+Generates synthetic eBird Basic Dataset files in the EBD 1.12 layout, along with a matching taxonomy csv, for benchmarking.
+
+The data is random, but shaped like the real thing: checklists have many observations each, drawn from a species list
+where a few species are very common and most are rare, a few localities (hotspots) and observers account for a large
+share of the checklists with a long tail of the rest, and every protocol type turns up. The same seed always gives the
+same files.
+"""
+import argparse
+import csv
+import gzip
+import random
+import string
+from datetime import date, datetime, timedelta
+from ebird_data_parse import EBIRD_COLUMNS, PROTOCOL_CODES
+
+# Rough share of checklists for the common protocols; the rest split what's left between them.
+PROTOCOL_WEIGHTS = {'Traveling': 0.5, 'Stationary': 0.3, 'Incidental': 0.12, 'Area': 0.02}
+
+# Taxonomy categories other than species, with how often each species has one of them after it.
+EXTRA_CATEGORIES = (('issf', 0.15), ('spuh', 0.03), ('slash', 0.03), ('hybrid', 0.02), ('form', 0.02), ('domestic', 0.01),
+                    ('intergrade', 0.01))
+
+LOCALITY_TYPES = ('H', 'P', 'T', 'PC', 'C', 'S')
+
+REASONS = ('Introduced/Exotic', 'Species-Count', 'Species-Date', 'Rare-Date', 'Rare-Location')
+
+FIRST_YEAR = 1990
+LAST_YEAR = 2020
+
+
+def skewed_index(rng, n, skew):
+    """
+    A random index below n, where low indexes are much more likely than high ones, giving a long tail.
+    """
+    return min(int(n * rng.random() ** skew), n - 1)
+
+
+def latin_word(rng, syllables):
+    return ''.join(rng.choice(('ba', 'ca', 'de', 'fi', 'go', 'lu', 'ma', 'ne', 'pi', 'ra', 'so', 'ti', 'vu', 'xe'))
+                   for _ in range(syllables))
+
+
+class Taxonomy:
+    """
+    A made up taxonomy, with the same categories and parent relationships as the eBird one.
+    Args:
+        rng (Random): random number generator.
+        species_count (int): number of species, the other categories are added on top.
+    """
+
+    def __init__(self, rng, species_count):
+        # Rows of TAXON_ORDER, CATEGORY, SPECIES_CODE, PRIMARY_COM_NAME, SCI_NAME, REPORT_AS.
+        self.rows = []
+        # (category, scientific name, parent species' scientific name) for every taxon observations can be of.
+        self.taxa = []
+        used = set()
+        for i in range(species_count):
+            genus = latin_word(rng, 3).capitalize()
+            name = f"{genus} {latin_word(rng, 3)}"
+            while name in used:
+                name += rng.choice(string.ascii_lowercase)
+            used.add(name)
+            code = f"sp{i:05d}"
+            self.rows.append((len(self.rows) + 1, 'species', code, f"Common {name}", name, ''))
+            self.taxa.append(('species', name, None))
+            for category, chance in EXTRA_CATEGORIES:
+                if rng.random() >= chance:
+                    continue
+                if category == 'issf':
+                    extra = f"{name} {latin_word(rng, 2)}"
+                elif category in ('slash', 'hybrid'):
+                    extra = f"{name}/{latin_word(rng, 3)}" if category == 'slash' else f"{name} x {latin_word(rng, 3)}"
+                elif category == 'spuh':
+                    extra = f"{genus} sp."
+                else:
+                    extra = f"{name} ({category} {latin_word(rng, 2)})"
+                if extra in used:
+                    continue
+                used.add(extra)
+                # Spuhs and hybrids never have a parent, slashes and intergrades always do.
+                parent = '' if category in ('spuh', 'hybrid') else code
+                self.rows.append((len(self.rows) + 1, category, f"x{len(self.rows):06d}", f"Common {extra}", extra, parent))
+                self.taxa.append((category, extra, name))
+
+    def write_csv(self, file_path):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('TAXON_ORDER', 'CATEGORY', 'SPECIES_CODE', 'PRIMARY_COM_NAME', 'SCI_NAME', 'ORDER1',
+                             'FAMILY', 'SPECIES_GROUP', 'REPORT_AS'))
+            for order, category, code, common, scientific, parent in self.rows:
+                writer.writerow((order, category, code, common, scientific, '', '', '', parent))
+
+
+class Places:
+    """
+    Countries, states and counties, and the localities in them.
+    Args:
+        rng (Random): random number generator.
+        locality_count (int): number of localities.
+    """
+
+    def __init__(self, rng, locality_count, countries=20, states=8, counties=12):
+        letters = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+        regions = []
+        for country_code in rng.sample(letters, countries):
+            country = f"Country {country_code}"
+            for s in range(1, states + 1):
+                state_code = f"{country_code}-{s:02d}"
+                for c in range(1, counties + 1):
+                    regions.append((country, country_code, f"State {state_code}", state_code,
+                                    f"County {state_code}-{c:03d}", f"{state_code}-{c:03d}",
+                                    rng.uniform(-60, 70), rng.uniform(-180, 180)))
+        self.localities = []
+        for i in range(locality_count):
+            country, country_code, state, state_code, county, county_code, lat, lon = regions[
+                skewed_index(rng, len(regions), 2)]
+            # Lots of localities have an observer's own name for it, anything from a word to a sentence.
+            name = f"{latin_word(rng, rng.randint(2, 5)).capitalize()} {rng.choice(('Park', 'Marsh', 'Trail', 'Yard', 'Lake', 'Road'))}"
+            self.localities.append((country, country_code, state, state_code, county, county_code, '', '', '', '',
+                                    name, f"L{i + 1}", rng.choice(LOCALITY_TYPES),
+                                    f"{lat + rng.uniform(-1, 1):.7f}", f"{lon + rng.uniform(-1, 1):.7f}"))
+
+
+def protocol_weights():
+    protocols = list(dict.fromkeys(PROTOCOL_CODES))
+    rest = (1 - sum(PROTOCOL_WEIGHTS.values())) / (len(protocols) - len(PROTOCOL_WEIGHTS))
+    return protocols, [PROTOCOL_WEIGHTS.get(p, rest) for p in protocols]
+
+
+def generate_rows(rows, seed=0, taxonomy=None, species_count=2000):
+    """
+    Generates rows of EBD data.
+    Args:
+        rows (int): number of rows (observations) to generate.
+        seed (int, optional): random seed.
+        taxonomy (Taxonomy, optional): taxonomy to use, otherwise one is made with species_count species.
+        species_count (int, optional): number of species in the generated taxonomy.
+    Returns:
+        A generator of lists of column values, in EBIRD_COLUMNS order.
+    """
+    rng = random.Random(seed)
+    if taxonomy is None:
+        taxonomy = Taxonomy(rng, species_count)
+    places = Places(rng, max(rows // 40, 10))
+    observer_count = max(rows // 200, 5)
+    protocols, weights = protocol_weights()
+    # Common species are picked much more often than rare ones.
+    taxon_weights = [1 / (rank + 1) ** 1.1 for rank in range(len(taxonomy.taxa))]
+    cumulative = []
+    total = 0
+    for w in taxon_weights:
+        total += w
+        cumulative.append(total)
+    first_day = date(FIRST_YEAR, 1, 1).toordinal()
+    days = date(LAST_YEAR, 12, 31).toordinal() - first_day
+    observation_id = 0
+    checklist_id = 0
+    group_id = 0
+    while observation_id < rows:
+        checklist_id += 1
+        # Every protocol gets used at least once, then they turn up as often as they do in the real data.
+        protocol = protocols[checklist_id - 1] if checklist_id <= len(protocols) else rng.choices(protocols, weights)[0]
+        place = places.localities[skewed_index(rng, len(places.localities), 3)]
+        observer = f"obsr{skewed_index(rng, observer_count, 3) + 1}"
+        # More recent years have far more checklists.
+        day = date.fromordinal(first_day + int(days * (1 - rng.random() ** 2)))
+        start_time = '' if protocol == 'Incidental' and rng.random() < 0.3 else f"{rng.randint(4, 20):02d}:{rng.choice((0, 15, 30, 45)):02d}:00"
+        duration = '' if protocol == 'Incidental' or start_time == '' else str(rng.randint(5, 300))
+        distance = f"{rng.uniform(0.1, 15):.3f}" if protocol == 'Traveling' else ''
+        area = f"{rng.uniform(0.5, 50):.3f}" if protocol == 'Area' else ''
+        complete = '0' if protocol == 'Incidental' else '1'
+        group = ''
+        if rng.random() < 0.08:
+            group_id += 1
+            group = f"G{group_id}"
+        trip_comments = latin_word(rng, 8) if rng.random() < 0.1 else ''
+        edited = datetime.combine(day, datetime.min.time()) + timedelta(days=rng.randint(0, 400), seconds=rng.randint(0, 86399))
+        # Typical checklists have a dozen or two species, a few have very many.
+        species_on_list = min(1 + int(rng.expovariate(1 / 14)), len(taxonomy.taxa))
+        seen = set()
+        for _ in range(species_on_list):
+            if observation_id >= rows:
+                break
+            index = rng.choices(range(len(taxonomy.taxa)), cum_weights=cumulative)[0]
+            if index in seen:
+                continue
+            seen.add(index)
+            observation_id += 1
+            category, name, parent = taxonomy.taxa[index]
+            if category in ('issf', 'intergrade'):
+                scientific_name, subspecies_name = parent, name
+            else:
+                scientific_name, subspecies_name = name, ''
+            count = 'X' if rng.random() < 0.05 else str(max(1, int(rng.expovariate(1 / 6))))
+            approved = '0' if rng.random() < 0.01 else '1'
+            reviewed = '1' if approved == '0' or rng.random() < 0.02 else '0'
+            reason = rng.choice(REASONS) if reviewed == '1' else ''
+            yield ([f"URN:CornellLabOfOrnithology:EBIRD:OBS{observation_id}", edited.isoformat(' '), str(index + 1),
+                    category, f"Common {scientific_name}", scientific_name,
+                    f"Common {subspecies_name}" if subspecies_name else '', subspecies_name, count, '', '',
+                    'Male (1)' if rng.random() < 0.03 else '']
+                   + list(place)
+                   + [day.isoformat(), start_time, observer, f"S{checklist_id}", protocol, f"P{PROTOCOL_CODES[protocol]}",
+                      'EBIRD', duration, distance, area, str(rng.randint(1, 4)), complete, group,
+                      '1' if rng.random() < 0.02 else '0', approved, reviewed, reason, trip_comments,
+                      latin_word(rng, 4) if rng.random() < 0.05 else '', ''])
+
+
+def write_ebd(file_path, rows, seed=0, taxonomy_path=None, species_count=2000):
+    """
+    Writes a synthetic EBD file, gzipped if the name ends in .gz, and optionally its taxonomy csv.
+    Args:
+        file_path (str): where to write the data.
+        rows (int): number of observations.
+        seed (int, optional): random seed.
+        taxonomy_path (str, optional): where to write the matching taxonomy csv.
+        species_count (int, optional): number of species.
+    """
+    taxonomy = Taxonomy(random.Random(seed), species_count)
+    if taxonomy_path is not None:
+        taxonomy.write_csv(taxonomy_path)
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with opener(file_path, 'wt', encoding='utf-8', newline='') as f:
+        f.write('\t'.join(EBIRD_COLUMNS) + '\n')
+        for row in generate_rows(rows, seed, taxonomy):
+            f.write('\t'.join(row) + '\n')
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Write a synthetic eBird Basic Dataset file for benchmarking.")
+    parser.add_argument('-o', '--out', dest="out_path", help="File to write, gzipped if it ends in .gz.", metavar="PATH",
+                        required=True)
+    parser.add_argument('-n', '--rows', dest="rows", help="Number of observations.", metavar="N", type=int, default=100000)
+    parser.add_argument('--seed', dest="seed", help="Random seed.", metavar="N", type=int, default=0)
+    parser.add_argument('-t', '--taxonomy', dest="taxonomy_path", help="Also write the matching taxonomy csv here.",
+                        metavar="PATH", default=None)
+    parser.add_argument('--species', dest="species_count", help="Number of species.", metavar="N", type=int, default=2000)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    write_ebd(options.out_path, options.rows, options.seed, options.taxonomy_path, options.species_count)
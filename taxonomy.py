@@ -0,0 +1,87 @@
+"""
+Bulk loading of the eBird taxonomy, and the species name lookups the parser needs.
+
+The taxonomy is upserted with one statement per table rather than a get_or_create per taxon, and each version of it is
+recorded in taxonomy_version, so loading the same file again is skipped entirely.
+"""
+import hashlib
+import os
+from collections import namedtuple
+from models import Species, SubSpecies, TaxonomyVersion
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+# Scientific names of all species and subspecies, and species codes to scientific names, for both.
+TaxonomyNames = namedtuple("TaxonomyNames", ["species", "subspecies", "codes"])
+
+# Bytes hashed at a time when working out the version.
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def taxonomy_version(file_path):
+    """
+    Identifies a taxonomy csv by its name, such as eBird_Taxonomy_v2019, and a hash of its contents.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return f"{name}:{digest.hexdigest()[:16]}"
+
+
+def is_loaded(session, version):
+    return session.get(TaxonomyVersion, version) is not None
+
+
+def upsert(session, model, rows):
+    """
+    Inserts rows into a taxonomy table in one statement, updating any taxa that are already there.
+    Args:
+        session (Session): SQLAlchemy session.
+        model (class): Species or SubSpecies.
+        rows (list(dict)): column values for each taxon, including scientific_name.
+    """
+    if not rows:
+        return
+    statement = insert(model.__table__)
+    updates = {name: statement.excluded[name] for name in rows[0] if name != 'scientific_name'}
+    session.execute(statement.on_conflict_do_update(index_elements=['scientific_name'], set_=updates), rows)
+
+
+def load(session, version, species_rows, subspecies_rows):
+    """
+    Loads a version of the taxonomy and records that it has been loaded, in the session's transaction.
+    Args:
+        session (Session): SQLAlchemy session.
+        version (str): from taxonomy_version().
+        species_rows (list(dict)): Species column values.
+        subspecies_rows (list(dict)): SubSpecies column values.
+    """
+    # Species first, as subspecies refer to their parent species.
+    upsert(session, Species, species_rows)
+    upsert(session, SubSpecies, subspecies_rows)
+    session.add(TaxonomyVersion(version=version, species_count=len(species_rows),
+                                subspecies_count=len(subspecies_rows), loaded=func.now()))
+
+
+def load_names(session):
+    """
+    Fetches just the names and codes of every taxon, without loading any ORM objects.
+    Args:
+        session (Session): SQLAlchemy session.
+    Returns:
+        A TaxonomyNames.
+    """
+    species = set()
+    subspecies = set()
+    codes = {}
+    for scientific_name, code in session.execute(select(Species.scientific_name, Species.species_code)):
+        species.add(scientific_name)
+        if code is not None:
+            codes[code] = scientific_name
+    for scientific_name, code in session.execute(select(SubSpecies.scientific_name, SubSpecies.subspecies_code)):
+        subspecies.add(scientific_name)
+        if code is not None:
+            codes[code] = scientific_name
+    return TaxonomyNames(frozenset(species), frozenset(subspecies), codes)